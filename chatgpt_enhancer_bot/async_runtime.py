@@ -0,0 +1,96 @@
+"""
+asyncio runtime for the telegram bot
+
+python-telegram-bot v13 dispatches updates to a small pool of worker threads, and a slow completion used to
+hold one of them for the whole OpenAI round-trip. Instead, handlers are now coroutines: the dispatcher thread only
+schedules them on an event loop running in a background thread and returns right away.
+Blocking calls (openai_wrapper, telegram sends) are awaited in a thread pool, the number of conversations
+waiting on OpenAI at the same time is bounded by `max_concurrent_chats`, not by the dispatcher workers.
+"""
+import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_CHATS = 100
+LOCAL_WORKERS = 16  # threads reserved for quick local work - commands like /topics and telegram sends
+
+
+class AsyncRuntime:
+    def __init__(self, max_concurrent_chats=MAX_CONCURRENT_CHATS, local_workers=LOCAL_WORKERS):
+        """
+        :param max_concurrent_chats: max conversations waiting on OpenAI at the same time, the rest wait in line
+        :param local_workers: extra threads for blocking calls that don't go to OpenAI
+        """
+        self.max_concurrent_chats = max_concurrent_chats
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent_chats + local_workers,
+                                           thread_name_prefix='bot-blocking-io')
+        self.loop.set_default_executor(self.executor)
+        self._chat_slots = asyncio.Semaphore(max_concurrent_chats)
+        self._in_flight = 0
+        self._waiting = 0
+        self._tasks = set()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='bot-event-loop', daemon=True)
+        self._thread.start()
+
+    def submit(self, coro):
+        """
+        Schedule a coroutine on the event loop from any thread
+        :return: concurrent.futures.Future
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        self._tasks.add(future)
+        future.add_done_callback(self._tasks.discard)
+        return future
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """
+        Await a blocking call, running it in the thread pool.
+        In a copy of the context of the caller, as asyncio.to_thread does - e.g. the user's turn it holds
+        """
+        context = contextvars.copy_context()
+        return await self.loop.run_in_executor(self.executor, functools.partial(context.run, func, *args, **kwargs))
+
+    async def run_chat(self, func, *args, user_turn=None, **kwargs):
+        """
+        Same as `run_blocking`, but for calls that go to OpenAI - waits for a free chat slot first
+        :param user_turn: async context manager of the user's turn (OpenAIScheduler.user_turn_async) - entered
+            before taking a slot, so a message waiting for the earlier ones of its user doesn't hold a slot
+        """
+        async with user_turn if user_turn is not None else contextlib.nullcontext():
+            self._waiting += 1
+            try:
+                await self._chat_slots.acquire()
+            finally:
+                self._waiting -= 1
+            self._in_flight += 1
+            try:
+                return await self.run_blocking(func, *args, **kwargs)
+            finally:
+                self._in_flight -= 1
+                self._chat_slots.release()
+
+    def stats(self):
+        return {
+            'in_flight_chats': self._in_flight,
+            'waiting_chats': self._waiting,
+            'max_concurrent_chats': self.max_concurrent_chats,
+            'scheduled_handlers': len(self._tasks),
+        }
+
+    def stop(self, timeout=30):
+        """ Wait for the scheduled handlers to finish (up to `timeout` seconds) and stop the loop """
+        for future in list(self._tasks):
+            try:
+                future.result(timeout=timeout)
+            except Exception:
+                pass  # already reported by the handler
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.executor.shutdown(wait=True)
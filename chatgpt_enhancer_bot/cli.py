@@ -0,0 +1,71 @@
+"""
+Command line of the bot - run.py and main.py take the same arguments
+"""
+import argparse
+
+from .async_runtime import MAX_CONCURRENT_CHATS
+from .context_selection import CONTEXT_STRATEGIES, DEFAULT_CONTEXT_STRATEGY
+from .history_flusher import FLUSH_INTERVAL
+from .http_transport import POOL_SIZE, CONNECT_TIMEOUT, READ_TIMEOUT
+from .rate_limiter import REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE
+from .resilience import MAX_RETRIES
+from .webhook_server import WEBHOOK_HOST, WEBHOOK_PORT, MAX_QUEUED_UPDATES
+
+
+def make_argument_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--expensive", action="store_true",
+                        help="use expensive calculation - 'text-davinci-003' model instead of 'text-ada:001' ")
+    parser.add_argument("--history-backend", choices=['json', 'sqlite'], default='json',
+                        help="where to store conversation history - a json file per user or a single sqlite database")
+    parser.add_argument("--history-flush-interval", type=float, default=FLUSH_INTERVAL,
+                        help="max seconds conversation history changes wait before being written to disk")
+    parser.add_argument("--history-fsync", action="store_true",
+                        help="fsync conversation history on every write batch. Safer, but slower")
+    parser.add_argument("--max-concurrent-chats", type=int, default=MAX_CONCURRENT_CHATS,
+                        help="max conversations waiting on OpenAI at the same time, the rest wait in line")
+    parser.add_argument("--requests-per-minute", type=int, default=REQUESTS_PER_MINUTE,
+                        help="OpenAI requests per minute limit of the api key - bursts wait instead of failing")
+    parser.add_argument("--tokens-per-minute", type=int, default=TOKENS_PER_MINUTE,
+                        help="OpenAI tokens per minute limit of the api key - bursts wait instead of failing")
+    parser.add_argument("--no-streaming", action="store_true",
+                        help="send chat responses only when complete, instead of editing the message as text arrives")
+    parser.add_argument("--max-retries", type=int, default=MAX_RETRIES,
+                        help="retries of transient OpenAI errors, with jittered exponential backoff")
+    parser.add_argument("--hedge-requests", action="store_true",
+                        help="send a duplicate of an unusually slow OpenAI request and use the first answer")
+    parser.add_argument("--http-pool-size", type=int, default=POOL_SIZE,
+                        help="keep-alive connections kept open per host, for OpenAI and Telegram calls")
+    parser.add_argument("--http-connect-timeout", type=float, default=CONNECT_TIMEOUT,
+                        help="seconds to establish a connection to OpenAI or Telegram")
+    parser.add_argument("--http-read-timeout", type=float, default=READ_TIMEOUT,
+                        help="seconds to wait for response data from OpenAI or Telegram")
+    parser.add_argument("--semantic-cache-threshold", type=float, default=None,
+                        help="answer prompts similar to an earlier one (0..1, e.g. 0.8) from cache. Off by default")
+    parser.add_argument("--mode", choices=['polling', 'webhook'], default='polling',
+                        help="how to get updates - poll telegram, or receive them on a local HTTP server")
+    parser.add_argument("--webhook-url", default=None,
+                        help="public https url of the webhook server, registered with telegram on start")
+    parser.add_argument("--webhook-host", default=WEBHOOK_HOST, help="interface for the webhook server")
+    parser.add_argument("--webhook-port", type=int, default=WEBHOOK_PORT, help="port for the webhook server")
+    parser.add_argument("--webhook-secret", default=None,
+                        help="token telegram sends with every update. By default - from secrets.txt, or random")
+    parser.add_argument("--webhook-max-queued", type=int, default=MAX_QUEUED_UPDATES,
+                        help="updates waiting to be handled, telegram redelivers the ones above that later")
+    parser.add_argument("--context-strategy", choices=CONTEXT_STRATEGIES, default=DEFAULT_CONTEXT_STRATEGY,
+                        help="past messages sent for context by default - the latest, or the ones related to "
+                             "the new message. Users change it with /set_context_strategy")
+    return parser
+
+
+def get_main_kwargs(args):
+    """ :return: arguments of main.main() from the parsed command line """
+    return dict(expensive=args.expensive, history_backend=args.history_backend,
+                history_flush_interval=args.history_flush_interval, history_fsync=args.history_fsync,
+                max_concurrent_chats=args.max_concurrent_chats, requests_per_minute=args.requests_per_minute,
+                tokens_per_minute=args.tokens_per_minute, streaming=not args.no_streaming,
+                max_retries=args.max_retries, hedge_requests=args.hedge_requests, http_pool_size=args.http_pool_size,
+                http_connect_timeout=args.http_connect_timeout, http_read_timeout=args.http_read_timeout,
+                semantic_cache_threshold=args.semantic_cache_threshold, mode=args.mode, webhook_url=args.webhook_url,
+                webhook_host=args.webhook_host, webhook_port=args.webhook_port, webhook_secret=args.webhook_secret,
+                webhook_max_queued=args.webhook_max_queued, context_strategy=args.context_strategy)
@@ -1,17 +1,146 @@
-from functools import lru_cache
+import bisect
+import inspect
+from collections import namedtuple
+from types import MappingProxyType
+
+from telegram import BotCommand
+
+TRUE_VALUES = ('true', 'yes', 'on', '1')
+FALSE_VALUES = ('false', 'no', 'off', '0')
+
+
+def to_bool(value: str):
+    value = value.strip().lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValueError(f"expected one of {', '.join(TRUE_VALUES + FALSE_VALUES)}")
+
+
+# argument types a command can declare - message arguments are converted with these
+CONVERTERS = {int: int, float: float, bool: to_bool, str: str}
+MAX_BOT_COMMAND_DESCRIPTION = 256  # telegram limit
+
+
+def _convert_positional(convert, value):
+    return value if convert is None or value.__class__ is not str else convert(value)
+
+
+# everything derived from the registered commands - built once, rebuilt after a change
+_CommandIndex = namedtuple('_CommandIndex', ['shortcuts', 'groups', 'sorted_shortcuts', 'help_text',
+                                             'bot_commands'])
+
+
+class Command:
+    """
+    A registered command: the function to call and everything needed to call it with the arguments of a message.
+    The signature is inspected once, at registration - calls only bind and convert
+    """
+    __slots__ = ('name', 'func', 'shortcuts', 'docstring', 'description', 'group', 'signature', 'parameters',
+                 'required', 'converters', 'positional_converters', 'usage')
+
+    def __init__(self, name, func, shortcuts, docstring, description, group):
+        self.name = name
+        self.func = func
+        self.shortcuts = tuple(shortcuts)
+        self.docstring = docstring
+        self.description = description
+        self.group = group
+        self.signature = None
+        self.parameters = None  # names of the parameters, in order. None - bound with the signature (*args etc.)
+        self.required = ()
+        self.converters = {}  # parameter -> (type, converter)
+        self.positional_converters = ()  # converter or None per parameter, in order - for the fast path of bind
+        self.usage = self.shortcuts[0]
+        if func is not None:
+            self.signature = inspect.signature(func)
+            parameters = list(self.signature.parameters.values())[1:]  # skip self
+            if all(parameter.kind == parameter.POSITIONAL_OR_KEYWORD for parameter in parameters):
+                self.parameters = tuple(parameter.name for parameter in parameters)
+                self.required = tuple(parameter.name for parameter in parameters
+                                      if parameter.default is parameter.empty)
+            usage = [self.usage]
+            for parameter in parameters:
+                if parameter.kind in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD):
+                    continue
+                # the annotation, or the type of the default value
+                param_type = parameter.annotation
+                if param_type is parameter.empty and parameter.default not in (parameter.empty, None):
+                    param_type = type(parameter.default)
+                if param_type in CONVERTERS:
+                    self.converters[parameter.name] = (param_type, CONVERTERS[param_type])
+                usage.append(parameter.name if parameter.default is parameter.empty
+                             else f"[{parameter.name}={parameter.default}]")
+            self.usage = ' '.join(usage)
+            if self.parameters is not None:
+                self.positional_converters = tuple(self.converters[name][1] if name in self.converters else None
+                                                   for name in self.parameters)
+
+    def bind(self, args, kwargs):
+        """
+        Check the arguments from a message against the signature and convert them to the declared types
+        :return: args, kwargs to call func with (after the bot)
+        :raise RuntimeError: the arguments don't fit - with the usage of the command
+        """
+        if self.signature is None:
+            return args, kwargs
+        if self.parameters is None:
+            try:
+                bound = self.signature.bind(None, *args, **kwargs)
+            except TypeError as e:
+                raise RuntimeError(f"{e}. Usage: {self.usage}") from None
+            for name, value in bound.arguments.items():
+                bound.arguments[name] = self._convert(name, value)
+            return bound.args[1:], bound.kwargs
+
+        parameters = self.parameters
+        if not kwargs and len(self.required) <= len(args) <= len(parameters):
+            # positional arguments only - the usual message. Required parameters come first, counting is enough
+            try:
+                return list(map(_convert_positional, self.positional_converters, args)), {}
+            except ValueError:
+                pass  # reported with the name of the argument below
+        if len(args) > len(parameters):
+            raise RuntimeError(f"Too many arguments. Usage: {self.usage}")
+        arguments = dict(zip(parameters, args))
+        for name, value in kwargs.items():
+            if name not in parameters:
+                raise RuntimeError(f"Unexpected argument {name}. Usage: {self.usage}")
+            if name in arguments:
+                raise RuntimeError(f"Multiple values for {name}. Usage: {self.usage}")
+            arguments[name] = value
+        for name in self.required:
+            if name not in arguments:
+                raise RuntimeError(f"Missing {name}. Usage: {self.usage}")
+        for name, value in arguments.items():
+            arguments[name] = self._convert(name, value)
+        return (), arguments
+
+    def _convert(self, name, value):
+        converter = self.converters.get(name)
+        if converter is None or value.__class__ is not str:
+            return value
+        param_type, convert = converter
+        try:
+            return convert(value)
+        except ValueError:
+            raise RuntimeError(f"Invalid {name}: {value!r} is not {param_type.__name__}. "
+                               f"Usage: {self.usage}") from None
 
 
 class CommandRegistry:
     """
     Register a map from command shortcut to function name
+    One Command per function, all its shortcuts point to it. The lists, indexes and help text derived
+    from the commands are built on first use and rebuilt after the commands change
     """
 
     def __init__(self):
-        self.functions = {}
-        self.descriptions = {}
-        self.docstrings = {}
-        self.groups = {}
-        # self._is_markdown_safe = {}
+        self._commands = {}  # shortcut -> Command
+        self.dispatch_table = MappingProxyType(self._commands)  # shortcut -> Command, read only
+        self._by_name = {}  # function name -> Command
+        self._index = None  # _CommandIndex, None - to be rebuilt
 
     # def register(self, shortcuts=None, group=None, is_markdown_safe=False):
     def register(self, shortcuts=None, group=None):
@@ -32,7 +161,7 @@ class CommandRegistry:
             if not shortcuts:
                 shortcuts.append(f"/{name}")
             # self.add_command(name, shortcuts, doc, group or func.__class__, is_markdown_safe=is_markdown_safe)
-            self.add_command(name, shortcuts, doc, group or func.__class__)
+            self.add_command(name, shortcuts, doc, group or func.__class__, func=func)
 
             func.__shortcuts__ = shortcuts
             return func
@@ -40,43 +169,104 @@ class CommandRegistry:
         return wrapper
 
     # def add_command(self, command, shortcuts, docstring, group, is_markdown_safe=False):
-    def add_command(self, command, shortcuts, docstring: str, group):
+    def add_command(self, command, shortcuts, docstring: str, group, func=None):
+        """
+        :param func: the function, to call the command through `dispatch_table`
+        """
         if docstring is not None and docstring.strip():
             desc = docstring.strip().splitlines()[0]
         else:
             desc = "This docstring is missing!! Abuse @petr_lavrov until he writes it!!"
 
+        # registering a function again replaces it, with all its shortcuts
+        previous = self._by_name.get(command)
+        if previous is not None:
+            for shortcut in previous.shortcuts:
+                del self._commands[shortcut]
+        record = Command(command, func, shortcuts, docstring, desc, group)
+        self._by_name[command] = record
         for shortcut in shortcuts:
-            self.functions[shortcut] = command
-            self.descriptions[shortcut] = desc
-            self.docstrings[shortcut] = docstring
-            self.groups[shortcut] = group
-            # self._is_markdown_safe[shortcut] = is_markdown_safe
-
-        # todo: add command as a separate object as well - avoid duplication in help command. Dataclass?
+            self._commands[shortcut] = record
+        self._index = None
 
     def update(self, commands):
-        self.functions.update(commands)
+        """
+        Add shortcuts to registered commands
+        :param commands: shortcut -> function name
+        """
+        for shortcut, name in commands.items():
+            record = self._by_name[name]
+            if shortcut not in record.shortcuts:
+                record.shortcuts += (shortcut,)
+            self._commands[shortcut] = record
+        self._index = None
+
+    def _get_index(self):
+        index = self._index
+        if index is None:
+            # sorted by group, in the order of registration within a group
+            shortcuts = tuple(sorted(self._commands, key=lambda shortcut: str(self._commands[shortcut].group)))
+            commands = list(dict.fromkeys(self._commands[shortcut] for shortcut in shortcuts))
+            groups = {}
+            for record in commands:
+                groups.setdefault(record.group, []).append(record)
+            help_text = "Available commands:\n" + ''.join(
+                f"{', '.join(record.shortcuts)}: {record.description}\n" for record in commands)
+            bot_commands = tuple(BotCommand(shortcut.lstrip('/'),
+                                            self._commands[shortcut].description[:MAX_BOT_COMMAND_DESCRIPTION])
+                                 for shortcut in shortcuts)
+            index = _CommandIndex(shortcuts, {group: tuple(records) for group, records in groups.items()},
+                                  sorted(shortcuts), help_text, bot_commands)
+            self._index = index  # readers get either the old or the new index - no locking needed
+        return index
 
-    @lru_cache(maxsize=1)
     def list_commands(self):
         """
         List all commands
-        :return: List[str]
+        :return: Tuple[str]
+        """
+        return self._get_index().shortcuts
+
+    def list_group(self, group):
+        """ :return: Tuple[Command] of the group """
+        return self._get_index().groups.get(group, ())
+
+    def find_by_prefix(self, prefix):
+        """ :return: List[str] shortcuts starting with the prefix, sorted """
+        sorted_shortcuts = self._get_index().sorted_shortcuts
+        start = bisect.bisect_left(sorted_shortcuts, prefix)
+        end = bisect.bisect_left(sorted_shortcuts, prefix + '\U0010ffff', start)
+        return sorted_shortcuts[start:end]
+
+    def get_help_text(self):
+        """ All commands, a line per command with all its shortcuts """
+        return self._get_index().help_text
+
+    def get_bot_commands(self):
+        """ :return: Tuple[BotCommand] - for set_my_commands """
+        return self._get_index().bot_commands
+
+    def get_command(self, command):
+        """
+        :return: Command
+        :raise RuntimeError: unknown command
         """
-        return sorted(self.functions.keys(), key=self.get_group)
+        try:
+            return self._commands[command]
+        except KeyError:
+            raise RuntimeError(f"Unknown command {command}, see /help") from None
 
     def get_function(self, command):
-        return self.functions[command]
+        return self._commands[command].name
 
     def get_description(self, command):
-        return self.descriptions[command]
+        return self._commands[command].description
 
     def get_docstring(self, command):
-        return self.docstrings[command]
+        return self._commands[command].docstring
 
     def get_group(self, command):
-        return self.groups[command]
+        return self._commands[command].group
 
     # def is_markdown_safe(self, command):
     #     return self._is_markdown_safe[command]
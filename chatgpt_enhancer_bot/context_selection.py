@@ -0,0 +1,49 @@
+"""
+Which past turns go into the prompt as context - /set_context_strategy
+
+recency - the most recent turns of the topic that fit into the history budget (see prompt_transcript.py)
+relevance - the last few turns as is, for follow-ups like "and why?". The rest of the budget goes to the earlier
+    turns scoring best against the new prompt - BM25 of the search index, of the active topic or of all topics.
+    They are packed best first, and the turns sharing only common words with the prompt are left out even if
+    there is room: chatter costs no tokens, and an old turn that matters is found however far back it is
+"""
+from .search_index import tokenize
+from .token_budget import count_turn_tokens
+
+RECENCY = 'recency'
+RELEVANCE = 'relevance'
+CONTEXT_STRATEGIES = (RECENCY, RELEVANCE)
+DEFAULT_CONTEXT_STRATEGY = RECENCY
+RECENT_TURNS = 2  # always included with the relevance strategy
+MAX_RELEVANT_TURNS = 20  # candidates looked up in the search index
+MIN_RELEVANCE = 1.  # BM25 score - a turn matching a rare word of the prompt is above it, common words are not
+RELATIVE_RELEVANCE = 0.3  # of the score of the best turn
+
+
+def make_relevance_query(prompt):
+    """ The words of the prompt as a search query - quotes in a message are not phrases """
+    return ' '.join(dict.fromkeys(tokenize(prompt)))
+
+
+def select_relevant_turns(hits, budget, exclude=()):
+    """
+    :param hits: List[SearchHit] best first
+    :param budget: max tokens of the turns
+    :param exclude: Tuple(topic, prompt, response, timestamp) of the turns that are in the context anyway
+    :return: Tuple(List[SearchHit] in the order they happened, tokens they take)
+    """
+    hits = [hit for hit in hits if hit[:4] not in exclude]
+    if not hits:
+        return [], 0
+    min_score = max(MIN_RELEVANCE, hits[0].score * RELATIVE_RELEVANCE)
+    selected = []
+    used = 0
+    for hit in hits:
+        if hit.score < min_score:
+            break
+        tokens = count_turn_tokens(hit.prompt, hit.response)
+        if used + tokens <= budget:
+            selected.append(hit)
+            used += tokens
+    selected.sort(key=lambda hit: hit.timestamp)
+    return selected, used
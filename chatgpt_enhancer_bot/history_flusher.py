@@ -0,0 +1,95 @@
+"""
+Write-behind persistence for conversation history
+
+Storages put their writes into a queue and return immediately, a background thread collects the writes
+of all users into batches and hands each target its share at once (group commit):
+one journal write per user, one sqlite transaction for everyone.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 0.5  # seconds
+MAX_BATCH = 1000
+
+
+class HistoryFlusher:
+    """
+    Background flusher. A target is any object with `write_batch(items, fsync)` method,
+    items of the same target are passed in the order they were submitted.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, max_batch=MAX_BATCH, fsync=False):
+        """
+        :param flush_interval: max time (seconds) a write waits in the queue
+        :param max_batch: max number of writes in a single group commit
+        :param fsync: fsync files / use full sync for sqlite on each commit
+        """
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.fsync = fsync
+
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='history-flusher', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, target, item):
+        """ Queue a write. Never blocks on disk I/O """
+        if self._closed:
+            raise RuntimeError("History flusher is closed")
+        self._queue.put((target, item))
+
+    def flush(self):
+        """ Block until everything submitted so far is written """
+        done = threading.Event()
+        self._queue.put((None, done))
+        done.wait()
+
+    def close(self):
+        """ Write everything that's queued and stop the background thread """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put((None, None))
+        self._thread.join()
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.max_batch and batch[-1][0] is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        per_target = {}
+        for target, item in batch:
+            per_target.setdefault(target, []).append(item)
+        for target, items in per_target.items():
+            try:
+                target.write_batch(items, fsync=self.fsync)
+            except Exception:
+                logger.exception(f"Failed to write {len(items)} history items to {target}")
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            target, control = batch[-1]
+            if target is None:  # flush or close request
+                batch.pop()
+            self._write(batch)
+            if target is None:
+                if control is None:
+                    return
+                control.set()
@@ -0,0 +1,205 @@
+"""
+Append-only journal for conversation history.
+
+Each change (new message, new topic, rename) is a single JSON line appended to the journal file,
+so recording a turn costs the same no matter how long the history is.
+On load the snapshot (the good old `history_<user>.json`) is read and the journal is replayed on top of it.
+Every `compact_every` records the snapshot is rewritten atomically and the journal is truncated.
+
+What the snapshot holds is up to the owner: `load` works with a plain {topic: messages} snapshot,
+while JsonHistoryStorage keeps only a topic index there (see history_storage.py) and uses `read_snapshot` + `replay`.
+"""
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+COMPACT_EVERY = 1000
+SNAPSHOT_VERSION = 1
+
+OP_MESSAGE = 'message'
+OP_NEW_TOPIC = 'new_topic'
+OP_RENAME = 'rename'
+OP_SUMMARY = 'summary'
+
+
+def get_journal_path(snapshot_path):
+    return os.path.splitext(snapshot_path)[0] + '.journal.jsonl'
+
+
+def apply_record(history, record):
+    """
+    Apply a single journal record to the history dict (in place)
+    :param history: Dict[topic, List[Tuple(prompt, response, timestamp)]]
+    :param record: dict with 'op' key
+    """
+    op = record['op']
+    if op == OP_MESSAGE:
+        history.setdefault(record['topic'], []).append(
+            (record['prompt'], record['response'], record['timestamp']))
+    elif op == OP_NEW_TOPIC:
+        history.setdefault(record['topic'], [])
+    elif op == OP_RENAME:
+        if record['topic'] in history:
+            history[record['new_name']] = history.pop(record['topic'])
+    elif op == OP_SUMMARY:
+        pass  # plain {topic: messages} history has no place for summaries
+    else:
+        raise ValueError(f"Unknown journal operation: {op}")
+
+
+def atomic_write_json(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps(data))  # json.dump encodes in python, dumps in C - several times faster on a big snapshot
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class HistoryJournal:
+    """
+    Snapshot + append-only journal of conversation history changes
+
+    Records carry a sequence number and the snapshot remembers the last one it includes,
+    so a crash between writing the snapshot and truncating the journal doesn't replay anything twice.
+    """
+
+    def __init__(self, snapshot_path, journal_path=None, compact_every=COMPACT_EVERY, fsync=False):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path or get_journal_path(snapshot_path)
+        self.compact_every = compact_every
+        self.fsync = fsync
+
+        self._seq = 0
+        self._records_since_compaction = 0
+        self._lock = threading.Lock()
+        self._file = None
+
+    @property
+    def needs_compaction(self):
+        return self.compact_every is not None and self._records_since_compaction >= self.compact_every
+
+    def read_snapshot(self):
+        """
+        :return: Tuple(topics, version). topics is None if there's no snapshot yet.
+         version 0 - legacy plain {topic: messages} dict, written before the journal existed
+        """
+        if not os.path.exists(self.snapshot_path):
+            return None, SNAPSHOT_VERSION
+        with open(self.snapshot_path) as f:
+            data = json.load(f)
+        if isinstance(data, dict) and set(data.keys()) == {'version', 'seq', 'topics'}:
+            self._seq = data['seq']
+            return data['topics'], data['version']
+        return data, 0
+
+    def load(self, default=None):
+        """
+        Read the snapshot and replay the journal on top of it.
+        :param default: history to start from if there's no snapshot yet
+        :return: Dict[topic, List[Tuple(prompt, response, timestamp)]]
+        """
+        history, _ = self.read_snapshot()
+        if history is None:
+            history = default if default is not None else {}
+        self.replay(lambda record: apply_record(history, record))
+        return history
+
+    def replay(self, callback):
+        """
+        Call `callback(record)` for each journal record not included in the snapshot yet.
+        Must be called after `read_snapshot`.
+        A torn last line (crash mid-write) is dropped and cut off the journal file.
+        """
+        replayed = 0
+        if os.path.exists(self.journal_path):
+            good_offset = 0
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Dropping torn record at the end of {self.journal_path}")
+                        break
+                    good_offset += len(line)
+                    if record['seq'] <= self._seq:
+                        continue  # already included in the snapshot
+                    callback(record)
+                    self._seq = record['seq']
+                    replayed += 1
+            if good_offset < os.path.getsize(self.journal_path):
+                with open(self.journal_path, 'r+b') as f:
+                    f.truncate(good_offset)
+        self._records_since_compaction = replayed
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.journal_path, 'a')
+        return self._file
+
+    def make_record(self, op, **fields):
+        """
+        Create a record with the next sequence number. Records must be written in the order they were made
+        :param op: one of OP_MESSAGE, OP_NEW_TOPIC, OP_RENAME, OP_SUMMARY
+        :param fields: record payload, see `apply_record`
+        """
+        with self._lock:
+            self._seq += 1
+            self._records_since_compaction += 1
+            return dict(op=op, seq=self._seq, **fields)
+
+    def write_batch(self, records, fsync=None):
+        """
+        Append records to the journal with a single write
+        :param fsync: override the fsync setting of the journal
+        """
+        with self._lock:
+            f = self._open()
+            f.write(''.join(json.dumps(record) + '\n' for record in records))
+            f.flush()
+            if self.fsync if fsync is None else fsync:
+                os.fsync(f.fileno())
+
+    def append(self, op, **fields):
+        """ Make a record and write it right away """
+        self.write_batch([self.make_record(op, **fields)])
+
+    def start_compaction(self):
+        """
+        :return: sequence number the snapshot of the current state should be written with
+        """
+        with self._lock:
+            self._records_since_compaction = 0
+            return self._seq
+
+    def finish_compaction(self, topics, seq, version=SNAPSHOT_VERSION):
+        """
+        Rewrite the snapshot and truncate the journal.
+        Records up to `seq` must be written already, records after it must not be written yet
+        :param topics: snapshot payload - must include everything up to `seq`
+        :param seq: result of `start_compaction`
+        :param version: snapshot format version
+        """
+        with self._lock:
+            atomic_write_json(self.snapshot_path, {'version': version, 'seq': seq, 'topics': topics})
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            open(self.journal_path, 'w').close()
+
+    def compact(self, topics, version=SNAPSHOT_VERSION):
+        """
+        Rewrite the snapshot and truncate the journal
+        :param topics: snapshot payload - must include everything journaled so far
+        :param version: snapshot format version
+        """
+        self.finish_compaction(topics, self.start_compaction(), version=version)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
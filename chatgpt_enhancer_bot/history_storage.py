@@ -0,0 +1,529 @@
+"""
+Conversation history storage backends for ChatBot
+
+JsonHistoryStorage - default, per-user topic index + a json file per topic + append-only journal,
+    topics are loaded lazily
+SQLiteHistoryStorage - one database for all users, tables for users, topics and messages
+"""
+import collections
+import copy
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict
+
+from .history_journal import HistoryJournal, OP_MESSAGE, OP_NEW_TOPIC, OP_RENAME, OP_SUMMARY, atomic_write_json
+
+INDEX_SNAPSHOT_VERSION = 2
+MAX_LOADED_TOPICS = 5
+
+# kinds of items JsonHistoryStorage submits to the flusher
+JOURNAL_RECORD = 'record'
+COMPACTION = 'compaction'
+
+
+class HistoryStorage:
+    """
+    Interface of a conversation history backend. One instance per user.
+    Topics are ordered from the oldest to the most recent (renamed topics count as recent)
+    Messages are tuples (prompt, response, timestamp)
+    """
+
+    def list_topics(self, limit=None):
+        """
+        :param limit: return only the `limit` most recent topics. None or 0 - all topics
+        :return: List[str]
+        """
+        raise NotImplementedError
+
+    def has_topic(self, topic):
+        raise NotImplementedError
+
+    def add_topic(self, topic):
+        raise NotImplementedError
+
+    def rename_topic(self, topic, new_name):
+        raise NotImplementedError
+
+    def get_history(self, topic, limit=None):
+        """
+        :param topic: topic name. KeyError if missing
+        :param limit: return only `limit` last messages. None or 0 - all messages
+        :return: List[Tuple(prompt, response, timestamp)]
+        """
+        raise NotImplementedError
+
+    def count_messages(self, topic):
+        raise NotImplementedError
+
+    def get_history_range(self, topic, start, end):
+        """
+        A page of history: messages [start, end) of the topic, oldest first.
+        Backends may read more than the page - see JsonHistoryStorage
+        :return: List[Tuple(prompt, response, timestamp)]
+        """
+        raise NotImplementedError
+
+    def record(self, topic, prompt, response, timestamp):
+        raise NotImplementedError
+
+    def get_summary(self, topic):
+        """
+        :return: Tuple(summary text, number of first messages of the topic it covers). ('', 0) if not summarized yet
+        """
+        raise NotImplementedError
+
+    def set_summary(self, topic, summary, covered):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __contains__(self, topic):
+        return self.has_topic(topic)
+
+
+class JsonHistoryStorage(HistoryStorage):
+    """
+    Only a small topic index is kept in memory, messages of a topic are loaded when first needed
+    and evicted when the topic wasn't used for a while.
+
+    On disk:
+    history_<user>.json - topic index snapshot: name -> message file, message count, last activity
+    history_<user>.topics/<file>.json - messages of a topic as of the last compaction
+    history_<user>.journal.jsonl - everything that happened since the last compaction
+
+    With a flusher, journal writes and compactions happen on the flusher thread.
+    """
+
+    def __init__(self, path, max_loaded_topics=MAX_LOADED_TOPICS, flusher=None, **journal_kwargs):
+        """
+        :param flusher: HistoryFlusher for write-behind persistence. None - write synchronously
+        """
+        self.path = path
+        self.topics_dir = os.path.splitext(path)[0] + '.topics'
+        self.max_loaded_topics = max_loaded_topics
+        self._flusher = flusher
+        self._journal = HistoryJournal(path, **journal_kwargs)
+        self._lock = threading.RLock()
+
+        self._index = {}  # topic -> {'file': str, 'count': int, 'last_activity': str}
+        self._tail = {}  # topic -> messages journaled since the last compaction, not in the topic file yet
+        self._compacting = {}  # file -> messages being written to the topic file by a compaction
+        self._loaded = OrderedDict()  # topic -> all messages, least recently used first
+
+        topics, version = self._journal.read_snapshot()
+        if version == INDEX_SNAPSHOT_VERSION:
+            self._index = topics
+        elif topics is not None:
+            # legacy snapshot with all messages inside - migrate to per-topic files
+            for topic, messages in topics.items():
+                self._new_topic(topic)
+                for message in messages:
+                    self._append(topic, tuple(message))
+        self._journal.replay(self._apply)
+        if topics is not None and version != INDEX_SNAPSHOT_VERSION:
+            self.compact()
+
+    # ------------------------------
+    # in-memory state changes, shared by the api methods and the journal replay
+
+    def _apply(self, record):
+        op = record['op']
+        if op == OP_MESSAGE:
+            self._append(record['topic'], (record['prompt'], record['response'], record['timestamp']))
+        elif op == OP_NEW_TOPIC:
+            self._new_topic(record['topic'])
+        elif op == OP_RENAME:
+            self._rename(record['topic'], record['new_name'])
+        elif op == OP_SUMMARY:
+            self._set_summary(record['topic'], record['summary'], record['covered'])
+        else:
+            raise ValueError(f"Unknown journal operation: {op}")
+
+    def _new_topic(self, topic):
+        self._index[topic] = {'file': uuid.uuid4().hex, 'count': 0, 'last_activity': None}
+        self._tail[topic] = []
+
+    def _rename(self, topic, new_name):
+        self._index[new_name] = self._index.pop(topic)
+        if topic in self._tail:
+            self._tail[new_name] = self._tail.pop(topic)
+        if topic in self._loaded:
+            self._loaded[new_name] = self._loaded.pop(topic)
+
+    def _set_summary(self, topic, summary, covered):
+        self._index[topic]['summary'] = summary
+        self._index[topic]['summary_covered'] = covered
+
+    def _append(self, topic, message):
+        entry = self._index[topic]
+        entry['count'] += 1
+        entry['last_activity'] = message[2]
+        self._tail.setdefault(topic, []).append(message)
+        if topic in self._loaded:
+            self._loaded[topic].append(message)
+
+    def _log(self, op, **fields):
+        record = self._journal.make_record(op, **fields)
+        if self._flusher is not None:
+            self._flusher.submit(self, (JOURNAL_RECORD, record))
+        else:
+            self._journal.write_batch([record])
+
+    # ------------------------------
+    # lazy loading
+
+    def _topic_file(self, file):
+        return os.path.join(self.topics_dir, file + '.json')
+
+    def _read_topic_file(self, file):
+        path = self._topic_file(file)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return [tuple(m) for m in json.load(f)]
+
+    def _load_topic(self, topic):
+        """ :return: all messages of the topic, loading them from disk if necessary """
+        if topic in self._loaded:
+            self._loaded.move_to_end(topic)
+            return self._loaded[topic]
+        if topic not in self._index:
+            raise KeyError(topic)
+        entry = self._index[topic]
+        compacting = self._compacting.get(entry['file'], [])
+        tail = self._tail.get(topic, [])
+        # a crash during a compaction can leave journaled messages in the topic file - they're replayed into the tail
+        stored = entry['count'] - len(compacting) - len(tail)
+        messages = self._read_topic_file(entry['file'])[:stored] + compacting + tail
+        self._loaded[topic] = messages
+        self._evict()
+        return messages
+
+    def _evict(self):
+        # loaded messages are always recoverable from the topic file + tail, so it's safe to just drop them
+        while len(self._loaded) > self.max_loaded_topics:
+            self._loaded.popitem(last=False)
+
+    # ------------------------------
+    # HistoryStorage api
+
+    def list_topics(self, limit=None):
+        with self._lock:
+            return list(self._index.keys())[-limit:] if limit else list(self._index.keys())
+
+    def has_topic(self, topic):
+        return topic in self._index
+
+    def get_topic_info(self, topic):
+        """ :return: dict with message 'count' and 'last_activity' timestamp - without loading the messages """
+        entry = self._index[topic]
+        return {'count': entry['count'], 'last_activity': entry['last_activity']}
+
+    def add_topic(self, topic):
+        with self._lock:
+            self._new_topic(topic)
+            self._log(OP_NEW_TOPIC, topic=topic)
+
+    def rename_topic(self, topic, new_name):
+        with self._lock:
+            self._rename(topic, new_name)
+            self._log(OP_RENAME, topic=topic, new_name=new_name)
+
+    def get_summary(self, topic):
+        entry = self._index[topic]
+        return entry.get('summary', ''), entry.get('summary_covered', 0)
+
+    def set_summary(self, topic, summary, covered):
+        with self._lock:
+            self._set_summary(topic, summary, covered)
+            self._log(OP_SUMMARY, topic=topic, summary=summary, covered=covered)
+
+    def get_history(self, topic, limit=None):
+        with self._lock:
+            tail = self._tail.get(topic, [])
+            if limit and topic not in self._loaded and limit <= len(tail):
+                return tail[-limit:]  # recent messages are still in memory, no need to touch the disk
+            history = self._load_topic(topic)
+            return history[-limit:] if limit else history[:]
+
+    def count_messages(self, topic):
+        with self._lock:
+            return self._index[topic]['count']
+
+    def get_history_range(self, topic, start, end):
+        """
+        Not real paging: a topic file is a single json list, so a page before the journal tail loads the whole topic
+        (kept in the LRU of loaded topics for the next pages). SQLiteHistoryStorage reads only the page
+        """
+        with self._lock:
+            tail = self._tail.get(topic, [])
+            first_in_tail = self._index[topic]['count'] - len(tail)
+            if topic not in self._loaded and start >= first_in_tail:
+                return tail[start - first_in_tail:end - first_in_tail]
+            return self._load_topic(topic)[start:end]
+
+    def record(self, topic, prompt, response, timestamp):
+        with self._lock:
+            if topic not in self._index:
+                raise KeyError(topic)
+            self._append(topic, (prompt, response, timestamp))
+            self._log(OP_MESSAGE, topic=topic, prompt=prompt, response=response, timestamp=timestamp)
+            if self._journal.needs_compaction:
+                self.compact()
+
+    def compact(self):
+        """ Write new messages to topic files, rewrite the topic index and truncate the journal """
+        with self._lock:
+            job = {
+                'seq': self._journal.start_compaction(),
+                'index': copy.deepcopy(self._index),
+                'tails': {self._index[topic]['file']: tail for topic, tail in self._tail.items()},
+                # messages the topic file has before the tail - it may have more, written before a crash
+                'stored': {self._index[topic]['file']: self._index[topic]['count'] - len(tail)
+                           for topic, tail in self._tail.items()},
+            }
+            for file, tail in job['tails'].items():
+                self._compacting.setdefault(file, []).extend(tail)
+            self._tail = {}
+            if self._flusher is not None:
+                self._flusher.submit(self, (COMPACTION, job))
+                return
+        self._run_compaction(job)
+
+    def _run_compaction(self, job):
+        """
+        The topic files are rewritten before the snapshot, so after a crash in between the old snapshot
+        covers fewer messages than the files have. The messages it doesn't cover are cut off when a file is read
+        """
+        os.makedirs(self.topics_dir, exist_ok=True)
+        for file, tail in job['tails'].items():
+            messages = self._read_topic_file(file)[:job['stored'][file]] + tail
+            atomic_write_json(self._topic_file(file) + '.new', messages)
+            with self._lock:
+                os.replace(self._topic_file(file) + '.new', self._topic_file(file))
+                del self._compacting[file][:len(tail)]
+                if not self._compacting[file]:
+                    del self._compacting[file]
+        self._journal.finish_compaction(job['index'], job['seq'], version=INDEX_SNAPSHOT_VERSION)
+
+    def write_batch(self, items, fsync=False):
+        """ Flusher callback: write journal records in one go, run compactions in between """
+        records = []
+        for kind, item in items:
+            if kind == JOURNAL_RECORD:
+                records.append(item)
+            else:
+                if records:
+                    self._journal.write_batch(records, fsync=fsync)
+                    records = []
+                self._run_compaction(item)
+        if records:
+            self._journal.write_batch(records, fsync=fsync)
+
+    def flush(self):
+        """ Wait until all changes are on disk """
+        if self._flusher is not None:
+            self._flusher.flush()
+
+    def close(self):
+        self.flush()
+        self._journal.close()
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS topics (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    summary TEXT NOT NULL DEFAULT '',
+    summary_covered INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (user_id, name)
+);
+CREATE INDEX IF NOT EXISTS topics_user_position ON topics (user_id, position);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    topic_id INTEGER NOT NULL REFERENCES topics(id),
+    prompt TEXT NOT NULL,
+    response TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_user_topic_timestamp ON messages (user_id, topic_id, timestamp);
+"""
+
+
+INSERT_MESSAGE = 'INSERT INTO messages (user_id, topic_id, prompt, response, timestamp) VALUES (?, ?, ?, ?, ?)'
+
+
+class SQLiteDatabase:
+    """ A connection shared by all users' storages. sqlite3 connections aren't thread-safe - hence the lock """
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SQLITE_SCHEMA)
+        self._migrate()
+        self._fsync = False
+        self.pending = {}  # topic_id -> messages submitted to the flusher, but not committed yet
+
+    def _migrate(self):
+        """ Add columns introduced after the database was created """
+        columns = {row[1] for row in self.connection.execute('PRAGMA table_info(topics)')}
+        with self.connection:
+            if 'summary' not in columns:
+                self.connection.execute("ALTER TABLE topics ADD COLUMN summary TEXT NOT NULL DEFAULT ''")
+            if 'summary_covered' not in columns:
+                self.connection.execute("ALTER TABLE topics ADD COLUMN summary_covered INTEGER NOT NULL DEFAULT 0")
+
+    @classmethod
+    def get(cls, path):
+        with cls._instances_lock:
+            if path not in cls._instances:
+                cls._instances[path] = cls(path)
+            return cls._instances[path]
+
+    def execute(self, query, params=()):
+        with self.lock, self.connection:
+            return self.connection.execute(query, params).fetchall()
+
+    def write_batch(self, messages, fsync=False):
+        """
+        Insert messages of all users in a single transaction. Also a flusher callback
+        :param messages: List[Tuple(user_id, topic_id, prompt, response, timestamp)]
+        """
+        with self.lock:
+            if fsync != self._fsync:
+                self.connection.execute(f"PRAGMA synchronous={'FULL' if fsync else 'NORMAL'}")
+                self._fsync = fsync
+            with self.connection:
+                self.connection.executemany(INSERT_MESSAGE, messages)
+            for topic_id, count in collections.Counter(m[1] for m in messages).items():
+                if topic_id in self.pending:
+                    del self.pending[topic_id][:count]
+                    if not self.pending[topic_id]:
+                        del self.pending[topic_id]
+
+
+class SQLiteHistoryStorage(HistoryStorage):
+    """
+    History of a single user in a database shared with other users. Every operation is an indexed query
+    With a flusher, new messages are inserted in the background (topic changes are rare and stay synchronous)
+    """
+
+    def __init__(self, path, user, flusher=None):
+        """
+        :param flusher: HistoryFlusher for write-behind persistence. None - write synchronously
+        """
+        self.db = SQLiteDatabase.get(path)
+        self.user = user
+        self._flusher = flusher
+        self._topic_ids = {}
+        with self.db.lock:
+            self.db.execute('INSERT OR IGNORE INTO users (name) VALUES (?)', (user,))
+            (self.user_id,), = self.db.execute('SELECT id FROM users WHERE name = ?', (user,))
+
+    def _get_topic_id(self, topic):
+        if topic not in self._topic_ids:
+            rows = self.db.execute('SELECT id FROM topics WHERE user_id = ? AND name = ?', (self.user_id, topic))
+            if not rows:
+                raise KeyError(topic)
+            self._topic_ids[topic] = rows[0][0]
+        return self._topic_ids[topic]
+
+    def _next_position(self):
+        (position,), = self.db.execute('SELECT COALESCE(MAX(position), 0) + 1 FROM topics WHERE user_id = ?',
+                                       (self.user_id,))
+        return position
+
+    def list_topics(self, limit=None):
+        query = 'SELECT name FROM topics WHERE user_id = ? ORDER BY position DESC'
+        params = (self.user_id,)
+        if limit:
+            query += ' LIMIT ?'
+            params += (limit,)
+        return [name for name, in reversed(self.db.execute(query, params))]
+
+    def has_topic(self, topic):
+        return bool(self.db.execute('SELECT 1 FROM topics WHERE user_id = ? AND name = ?', (self.user_id, topic)))
+
+    def add_topic(self, topic):
+        with self.db.lock:
+            self.db.execute('INSERT INTO topics (user_id, name, position) VALUES (?, ?, ?)',
+                            (self.user_id, topic, self._next_position()))
+
+    def rename_topic(self, topic, new_name):
+        with self.db.lock:
+            topic_id = self._get_topic_id(topic)
+            self.db.execute('UPDATE topics SET name = ?, position = ? WHERE id = ?',
+                            (new_name, self._next_position(), topic_id))
+            self._topic_ids[new_name] = self._topic_ids.pop(topic)
+
+    def get_history(self, topic, limit=None):
+        query = 'SELECT prompt, response, timestamp FROM messages WHERE user_id = ? AND topic_id = ? ' \
+                'ORDER BY timestamp DESC, id DESC'
+        with self.db.lock:
+            topic_id = self._get_topic_id(topic)
+            params = (self.user_id, topic_id)
+            if limit:
+                query += ' LIMIT ?'
+                params += (limit,)
+            rows = self.db.execute(query, params)
+            pending = list(self.db.pending.get(topic_id, []))
+        history = [tuple(row) for row in reversed(rows)] + pending
+        return history[-limit:] if limit else history
+
+    def count_messages(self, topic):
+        with self.db.lock:
+            topic_id = self._get_topic_id(topic)
+            (count,), = self.db.execute('SELECT COUNT(*) FROM messages WHERE user_id = ? AND topic_id = ?',
+                                        (self.user_id, topic_id))
+            return count + len(self.db.pending.get(topic_id, []))
+
+    def get_history_range(self, topic, start, end):
+        with self.db.lock:
+            topic_id = self._get_topic_id(topic)
+            pending = list(self.db.pending.get(topic_id, []))  # the newest messages, not written yet
+            (stored,), = self.db.execute('SELECT COUNT(*) FROM messages WHERE user_id = ? AND topic_id = ?',
+                                         (self.user_id, topic_id))
+            rows = []
+            if start < min(end, stored):
+                rows = self.db.execute('SELECT prompt, response, timestamp FROM messages '
+                                       'WHERE user_id = ? AND topic_id = ? ORDER BY timestamp, id LIMIT ? OFFSET ?',
+                                       (self.user_id, topic_id, min(end, stored) - start, start))
+        return [tuple(row) for row in rows] + pending[max(0, start - stored):max(0, end - stored)]
+
+    def record(self, topic, prompt, response, timestamp):
+        message = (self.user_id, self._get_topic_id(topic), prompt, response, timestamp)
+        if self._flusher is None:
+            self.db.write_batch([message])
+            return
+        with self.db.lock:
+            self.db.pending.setdefault(message[1], []).append((prompt, response, timestamp))
+        self._flusher.submit(self.db, message)
+
+    def get_summary(self, topic):
+        (summary, covered), = self.db.execute('SELECT summary, summary_covered FROM topics WHERE id = ?',
+                                              (self._get_topic_id(topic),))
+        return summary, covered
+
+    def set_summary(self, topic, summary, covered):
+        self.db.execute('UPDATE topics SET summary = ?, summary_covered = ? WHERE id = ?',
+                        (summary, covered, self._get_topic_id(topic)))
+
+    def close(self):
+        if self._flusher is not None:
+            self._flusher.flush()
@@ -0,0 +1,89 @@
+"""
+Shared HTTP transport: one pool of keep-alive connections for the OpenAI calls of all users
+
+openai (0.x) sends requests with `requests`, and by default every thread gets its own session -
+so with many users the TLS handshakes keep repeating. `PooledSession` is installed as openai.requestssession:
+connections are reused across threads and bots, the pool size is bounded, and timeouts are set per phase.
+Telegram calls go through python-telegram-bot's own urllib3 pool - it gets the same pool size and timeouts,
+see `get_telegram_request_kwargs`.
+HTTP/2 is not available here: neither requests nor the telegram urllib3 pool support it.
+"""
+import socket
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+POOL_SIZE = 32  # connections per host
+CONNECT_TIMEOUT = 5.  # seconds
+READ_TIMEOUT = 120.  # seconds - completions of long answers are slow
+# detect dead idle connections instead of failing the next request on them
+KEEP_ALIVE_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+
+class PooledSession(requests.Session):
+    def __init__(self, pool_size=POOL_SIZE, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        """
+        :param pool_size: max connections kept open per host
+        :param connect_timeout: seconds to establish a connection (TCP + TLS)
+        :param read_timeout: seconds to wait for the response data
+        """
+        super().__init__()
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        adapter.init_poolmanager(4, pool_size, socket_options=KEEP_ALIVE_SOCKET_OPTIONS)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self._adapter = adapter
+
+    def request(self, method, url, timeout=None, **kwargs):
+        # openai passes a single overall timeout - replace it with the per phase one
+        if not isinstance(timeout, tuple):
+            timeout = self.timeout
+        return super().request(method, url, timeout=timeout, **kwargs)
+
+    def stats(self):
+        """ Pool utilisation: connections opened vs requests sent, and connections idle in the pools """
+        pools = self._adapter.poolmanager.pools
+        opened = requests_sent = idle = 0
+        for key in pools.keys():
+            pool = pools[key]
+            opened += pool.num_connections
+            requests_sent += pool.num_requests
+            idle += pool.pool.qsize() - sum(conn is None for conn in list(pool.pool.queue))
+        return {
+            'http_requests': requests_sent,
+            'http_connections_opened': opened,
+            'http_connection_reuse': 1 - opened / requests_sent if requests_sent else 0.,
+            'http_idle_connections': idle,
+            'http_pool_size': self.pool_size,
+        }
+
+    def close(self):
+        # openai closes the session of a thread every few minutes to recycle connections - don't drop the shared pool
+        pass
+
+    def shutdown(self):
+        super().close()
+
+
+_openai_session = None
+
+
+def install_openai_transport(session):
+    """ Make the openai package send all requests through the session """
+    global _openai_session
+    import openai
+    openai.requestssession = session
+    _openai_session = session
+
+
+def get_transport_stats():
+    """ Stats of the session installed for openai, empty if there's none """
+    return _openai_session.stats() if _openai_session is not None else {}
+
+
+def get_telegram_request_kwargs(pool_size=POOL_SIZE, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+    """ `request_kwargs` for telegram.ext.Updater - the same pool size and timeouts """
+    return {'con_pool_size': pool_size, 'connect_timeout': connect_timeout, 'read_timeout': read_timeout}
@@ -4,18 +4,37 @@
 
 
 """a simple bot that just forwards queries to openai and sends the response"""
+import asyncio
 import logging
 import os
+import threading
 import time
 import traceback
 from typing import Dict
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
+from telegram.error import RetryAfter
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler
 from telegram.utils.helpers import escape_markdown
 
+from .async_runtime import AsyncRuntime, MAX_CONCURRENT_CHATS
+from .history_flusher import HistoryFlusher, FLUSH_INTERVAL
+from .history_storage import JsonHistoryStorage, SQLiteHistoryStorage
+from .http_transport import PooledSession, install_openai_transport, get_telegram_request_kwargs, POOL_SIZE, \
+    CONNECT_TIMEOUT, READ_TIMEOUT
+from .command_registry import Command
+from .context_selection import DEFAULT_CONTEXT_STRATEGY
 from .openai_chatbot import ChatBot, telegram_commands_registry
-from .utils import get_secrets, generate_funny_reason, generate_funny_consolation, split_to_code_blocks, parse_query
+from .rate_limiter import OpenAIScheduler, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE
+from .resilience import ResilientCaller, MAX_RETRIES
+from .semantic_cache import SemanticCache
+from .search_index import SearchIndex
+from .send_queue import SendQueue
+from .response_cache import ResponseCache
+from .webhook_server import WebhookServer, generate_secret_token, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, \
+    MAX_QUEUED_UPDATES
+from .utils import get_secrets, generate_funny_reason, generate_funny_consolation, parse_query, CodeBlockSplitter, \
+    MenuResponse, format_message, split_block, escape_code
 
 secrets = get_secrets()
 
@@ -30,60 +49,204 @@ TOUCH_FILE_PATH = os.path.expanduser('~/heartbeat/chatgpt_enhancer_last_alive')
 os.makedirs(os.path.dirname(TOUCH_FILE_PATH), exist_ok=True)
 
 bot_registry = {}  # type: Dict[str, ChatBot]
+bot_registry_lock = threading.Lock()
 
 default_model = "text-ada:001"
 
 history_dir = os.path.join(os.path.dirname(__file__), 'history')
 os.makedirs(history_dir, exist_ok=True)
 
+# 'json' - a file per user, 'sqlite' - one database for all users
+history_backend = 'json'
+SQLITE_HISTORY_PATH = os.path.join(history_dir, 'history.sqlite3')
+history_flusher = None  # type: HistoryFlusher  # write-behind for history, started in main()
+response_cache = ResponseCache(os.path.join(history_dir, 'response_cache.sqlite3'))
+openai_scheduler = OpenAIScheduler()  # rate limits of the api key, shared by all users
+resilient_caller = ResilientCaller()  # retries and circuit breakers, shared by all users
+semantic_cache = None  # type: SemanticCache  # answers to near-duplicate prompts, enabled in main()
+default_context_strategy = DEFAULT_CONTEXT_STRATEGY  # of new users, they change it with /set_context_strategy
+
+runtime = None  # type: AsyncRuntime  # event loop for the handlers, started in main()
+send_queue = None  # type: SendQueue  # all messages to users go through it, started in main()
+# commands of these groups go to OpenAI - they wait for a free chat slot. The rest are answered right away
+REMOTE_COMMAND_GROUPS = ('custom', 'models')
+# chat responses are shown while being generated - a message is edited as the text arrives
+streaming = True
+STREAM_EDIT_INTERVAL = 1.  # seconds between edits of a message - telegram limits the edits per chat
+
+
+def make_history_storage(user):
+    if history_backend == 'sqlite':
+        return SQLiteHistoryStorage(SQLITE_HISTORY_PATH, user=user, flusher=history_flusher)
+    history_path = os.path.join(history_dir, f'history_{user}.json')
+    return JsonHistoryStorage(history_path, flusher=history_flusher)
+
+
+def make_search_index(user, history_storage):
+    """ Loaded on first use - by the user's own request, not under bot_registry_lock """
+    return SearchIndex(history_storage, os.path.join(history_dir, f'search_{user}.json'), flusher=history_flusher)
+
 
 def get_bot(user) -> ChatBot:
-    if user not in bot_registry.keys():
-        history_path = os.path.join(history_dir, f'history_{user}.json')
-        new_bot = ChatBot(conversations_history_path=history_path, model=default_model, user=user)
-        bot_registry[user] = new_bot
-    return bot_registry[user]
+    with bot_registry_lock:
+        if user not in bot_registry.keys():
+            history_storage = make_history_storage(user)
+            new_bot = ChatBot(model=default_model, user=user, history_storage=history_storage,
+                              response_cache=response_cache, scheduler=openai_scheduler,
+                              resilient_caller=resilient_caller, semantic_cache=semantic_cache,
+                              search_index=make_search_index(user, history_storage),
+                              context_strategy=default_context_strategy)
+            bot_registry[user] = new_bot
+        return bot_registry[user]
+
+
+def schedule(handler):
+    """
+    Make a dispatcher callback out of a coroutine handler.
+    The callback only schedules the handler on the event loop, so dispatcher threads are never blocked
+    """
+
+    def callback(update: Update, context: CallbackContext) -> None:
+        runtime.submit(run_handler(handler, update, context))
+
+    return callback
+
+
+async def run_handler(handler, update: Update, context: CallbackContext):
+    try:
+        await handler(update, context)
+    except Exception as e:
+        await runtime.run_blocking(context.dispatcher.dispatch_error, update, e)
 
 
-def send_message_with_markdown(message_to_reply_to, message, enable_markdown=False, escape_markdown_flag=False):
+def send_message_with_markdown(message_to_reply_to, message, enable_markdown=False, escape_markdown_flag=False,
+                               plain_text=None):
+    """ :param plain_text: the text before escaping - sent if the markdown can't be parsed """
     if enable_markdown:
+        if plain_text is None:
+            plain_text = message
         if escape_markdown_flag:
             message = escape_markdown(message, version=2)
         try:
             return message_to_reply_to.reply_markdown_v2(message)
+        except RetryAfter:
+            raise  # the send queue retries it
         except:  # can't parse entities
-            error_message = "Unable to parse markdown in this response. Here's the raw text:\n\n" + message
+            error_message = "Unable to parse markdown in this response. Here's the raw text:\n\n" + plain_text
             return message_to_reply_to.reply_text(error_message)
     else:
         return message_to_reply_to.reply_text(message)
 
 
+def edit_message_with_markdown(message, text, plain_text=None):
+    """ :param plain_text: the text before escaping - shown if the markdown can't be parsed """
+    try:
+        return message.edit_text(text, parse_mode=ParseMode.MARKDOWN_V2)
+    except RetryAfter:
+        raise  # the send queue retries it
+    except:  # can't parse entities
+        return message.edit_text(plain_text if plain_text is not None else text)
+
+
 def send_message_to_user(message_to_reply_to, message):
-    # just always send as plain text for now
-    # step 1: tell the bot to always use ``` for the code
-    # step 2: parse the code blocks in text
-    blocks = split_to_code_blocks(message)
-    sent_messages = []
-    for block in blocks:
-        if block['is_code_block']:
-            text = f"```{block['text']}```"
-        else:
-            text = block['text']
-        msg = send_message_with_markdown(message_to_reply_to, text, enable_markdown=block['is_code_block'])
-        sent_messages.append(msg)
+    """
+    Queue the response for sending. Code blocks are sent as markdown, adjacent blocks are merged into
+    as few messages as fit, blocks too long for a message are split at line boundaries
+    :return: List[Future] of the sent messages
+    """
+    chat_id = message_to_reply_to.chat_id
+    return [send_queue.submit(chat_id, send_message_with_markdown, message_to_reply_to, formatted.text,
+                              enable_markdown=formatted.is_markdown, plain_text=formatted.plain_text)
+            for formatted in format_message(message)]
+
 
-    if len(sent_messages) == 1:
-        # todo: add support for multiple messages everywhere where this is used
-        return sent_messages[0]
-    return sent_messages
+async def send(chat_id, func, *args, **kwargs):
+    """ Send through the queue and wait until it's sent """
+    return await asyncio.wrap_future(send_queue.submit(chat_id, func, *args, **kwargs))
 
 
-def chat_handler(update: Update, context: CallbackContext) -> None:
+async def reply_to_user(message_to_reply_to, message):
+    """ Same as `send_message_to_user`, but waits until it's sent. :return: list of sent messages """
+    return [await asyncio.wrap_future(future) for future in send_message_to_user(message_to_reply_to, message)]
+
+
+def stream_message_to_user(message_to_reply_to, chunks, edit_interval=STREAM_EDIT_INTERVAL):
+    """
+    Send a response that is still being generated: a message per block (as in send_message_to_user),
+    the message of the block in progress is edited at most every `edit_interval` seconds as the text arrives.
+    A code block is shown as plain text until its closing fence arrives, then formatted.
+    A block that outgrows a message continues in the next one - the parts are the same as `split_block` gives
+    for the complete block, so a part that is full is final
+    :param chunks: iterable of str, closed when done or when sending fails
+    """
+    start = time.monotonic()
+    chat_id = message_to_reply_to.chat_id
+    splitter = CodeBlockSplitter()
+    message = None  # message of the block in progress
+    shown_text = None
+    last_update = 0.
+    parts_shown = 0  # full parts of the block in progress, already sent as final messages
+
+    def send_and_wait(func, *args, **kwargs):
+        return send_queue.submit(chat_id, func, *args, **kwargs).result()
+
+    def show(block, finished):
+        nonlocal message, shown_text, last_update
+        text = f"```{block['text']}```" if block['is_code_block'] else block['text']
+        markdown_text = f"```{escape_code(block['text'])}```" if block['is_code_block'] else text
+        if message is None:
+            if finished:
+                send_and_wait(send_message_with_markdown, message_to_reply_to, markdown_text,
+                              enable_markdown=block['is_code_block'], plain_text=text)
+            else:
+                message = send_and_wait(message_to_reply_to.reply_text, text)
+            if last_update == 0.:
+                logger.info(f"First token shown after {time.monotonic() - start:.2f}s")
+        elif finished and block['is_code_block']:
+            send_and_wait(edit_message_with_markdown, message, markdown_text, plain_text=text)
+        elif text != shown_text:
+            send_and_wait(message.edit_text, text)
+        shown_text = text
+        last_update = time.monotonic()
+        if finished:
+            message, shown_text = None, None
+
+    def show_parts(block, finished):
+        nonlocal parts_shown
+        parts = split_block(block)
+        for part in parts[parts_shown:-1]:
+            show(part, finished=True)
+        parts_shown = 0 if finished else len(parts) - 1
+        if parts:
+            show(parts[-1], finished)
+
+    try:
+        for chunk in chunks:
+            for block in splitter.feed(chunk):
+                show_parts(block, finished=True)
+            block = splitter.get_current_block()
+            if block is not None and time.monotonic() - last_update >= edit_interval:
+                show_parts(block, finished=False)
+        for block in splitter.close():
+            show_parts(block, finished=True)
+    finally:
+        # a failed send must not leave the stream suspended - ChatBot.chat_stream holds the user's turn until
+        # it's closed, and the traceback kept by the error handler would keep it alive
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+async def chat_handler(update: Update, context: CallbackContext) -> None:
     user = update.effective_user.username
-    bot = get_bot(user)
-    reply = bot.chat(prompt=update.message.text)
+    bot = await runtime.run_blocking(get_bot, user)
+    if streaming:
+        # the stream is consumed in a worker thread - holds a chat slot until the response is complete
+        await runtime.run_chat(stream_message_to_user, update.message, bot.chat_stream(update.message.text),
+                               user_turn=bot.user_turn())
+        return
+    reply = await runtime.run_chat(bot.chat, prompt=update.message.text, user_turn=bot.user_turn())
     # send_message_to_user(update.message, reply, enable_markdown=bot.markdown_enabled, escape_markdown_flag=False)
-    send_message_to_user(update.message, reply)
+    await reply_to_user(update.message, reply)
 
 
 def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
@@ -95,40 +258,63 @@ def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
     return menu
 
 
-def send_menu(update, context, menu: dict, message, n_cols=2):
+def make_menu_markup(menu: dict, n_cols=2):
     button_list = [InlineKeyboardButton(k, callback_data=v) for k, v in menu.items()]
-    reply_markup = InlineKeyboardMarkup(build_menu(button_list, n_cols=n_cols))
-    update.message.reply_text(message, reply_markup=reply_markup)
+    return InlineKeyboardMarkup(build_menu(button_list, n_cols=n_cols))
 
 
-def topics_menu_handler(update: Update, context: CallbackContext) -> None:
-    user = update.effective_user.username
-    bot = get_bot(user)
-    send_menu(update, context, bot.get_topics_menu(), "Choose a topic to switch to:")
+def send_menu(update, context, menu: dict, message, n_cols=2):
+    """ :return: Future of the sent message """
+    reply_markup = make_menu_markup(menu, n_cols=n_cols)
+    return send_queue.submit(update.effective_chat.id, update.effective_message.reply_text, message,
+                             reply_markup=reply_markup)
+
+
+async def respond(update: Update, context: CallbackContext, command, result, from_button=False):
+    """
+    Send the result of a command. A MenuResponse is sent with its buttons -
+    when it comes from a button of a menu, that menu message is updated instead (e.g. the pages of /history)
+    """
+    if isinstance(result, MenuResponse):
+        if from_button:
+            await send(update.effective_chat.id, update.callback_query.edit_message_text, result.text,
+                       reply_markup=make_menu_markup(result.menu))
+        else:
+            await asyncio.wrap_future(send_menu(update, context, result.menu, result.text))
+        return
+    if not result:
+        result = f"Command {command} finished successfully"
+    response_messages = await reply_to_user(update.effective_message, result)
+    if result.startswith("Active topic"):
+        await send(update.effective_chat.id, response_messages[0].pin)
+
 
+async def run_command(bot, method, is_remote, *args, **kwargs):
+    if is_remote:
+        return await runtime.run_chat(method, bot, *args, user_turn=bot.user_turn(), **kwargs)
+    return await runtime.run_blocking(method, bot, *args, **kwargs)
 
-def button_callback(update, context):
+
+async def button_callback(update, context):
     prompt = update.callback_query.data
     user = update.effective_user.username
-    bot = get_bot(user)
+    bot = await runtime.run_blocking(get_bot, user)
+    await runtime.run_blocking(update.callback_query.answer)  # stop the loading animation of the button
 
+    name = None
     if prompt.startswith('/'):
-        command, qargs, qkwargs = parse_query(prompt)
-        method_name = bot.command_registry.get_function(command)
-        method = getattr(bot, method_name)
-        result = method(*qargs, **qkwargs)
-        if not result:
-            result = f"Command {command} finished successfully"
+        name, qargs, qkwargs = parse_query(prompt)
+        command = bot.command_registry.get_command(name)
+        args, kwargs = command.bind(qargs, qkwargs)
+        result = await run_command(bot, command.func, command.group in REMOTE_COMMAND_GROUPS, *args, **kwargs)
     else:
-        result = bot.chat(prompt)
+        result = await runtime.run_chat(bot.chat, prompt, user_turn=bot.user_turn())
 
     # markdown_safe =
     # escape_markdown_flag = not markdown_safe
     # response_message = send_message_to_user(update.effective_message, result, enable_markdown=bot.markdown_enabled,
     #                                         escape_markdown_flag=escape_markdown_flag)
-    response_message = send_message_to_user(update.effective_message, result)
-    if result.startswith("Active topic"):
-        response_message.pin()
+    await respond(update, context, name, result, from_button=True)
 
 
 # Enable logging
@@ -146,22 +332,13 @@ def error_handler(update: Update, context: CallbackContext):
         prompt = update.message.text
     elif update.callback_query:
         prompt = update.callback_query.data
-    bot.save_error(timestamp=timestamp, error=context.error, traceback=traceback.format_exc(),
-                   message_text=prompt)
+    # errors of the scheduled handlers are reported from another thread - format_exc() wouldn't see them
+    error_traceback = ''.join(traceback.format_exception(context.error))
+    bot.save_error(timestamp=timestamp, error=context.error, traceback=error_traceback, message_text=prompt)
     # todo: make save_error also save error to file somewhere
-    logger.warning(traceback.format_exc())
-
-    # # step 1.5: todo, retry after 1 second
-    # time.sleep(1)
-    # prompt = update.message.text
-    # try:
-    #     # todo: retrying the 'new_chat' command is stupid
-    #     # do I need to process the commands differently? I have a special parser inside chat() method.. should be ok
-    #     chat(prompt, user)
-    # except Exception as e:
-    #     bot = get_bot(user)
-    #     bot.save_traceback(traceback.format_exc())
-    #     update.message.reply_text(f"Nah, it's hopeless.. {generate_funny_consolation().lower()}")
+    logger.warning(error_traceback)
+
+    # step 1.5: transient OpenAI errors are retried before they get here - see ResilientCaller
 
     # step 2: Send a funny reason to the user, (but also an error message)
     # Give user the info? Naah, let's rather joke around
@@ -175,7 +352,7 @@ If the error persists, you can also try /new_chat command to start a new convers
 """
     # if bot.markdown_enabled:
     #     error_message += "\n Or /disable_markdown to disable markdown in this chat"
-    update.message.reply_text(error_message)
+    send_queue.submit(update.effective_chat.id, update.effective_message.reply_text, error_message)
 
 
 ANNOUNCEMENT_TEMPLATE = """
@@ -202,90 +379,157 @@ def announce_command(update: Update, context: CallbackContext):
         update.message.reply_text("Haaa, you sneaky! You can't do that!")
 
 
-def make_command_handler(method_name):
-    def command_handler(update: Update, context: CallbackContext) -> None:
+def make_command_handler(command: Command):
+    """
+    :param command: Command of the ChatBot method to call. Commands of REMOTE_COMMAND_GROUPS go to OpenAI -
+        they wait for a free chat slot
+    """
+    is_remote = command.group in REMOTE_COMMAND_GROUPS
+
+    async def command_handler(update: Update, context: CallbackContext) -> None:
         user = update.effective_user.username
-        bot = get_bot(user)
-        method = bot.__getattribute__(method_name)
+        bot = await runtime.run_blocking(get_bot, user)
 
         prompt = update.message.text
-        command, qargs, qkwargs = parse_query(prompt)
-        # todo: if necessary args are missing, ask for them or at least handle the exception gracefully
-        result = method(*qargs, **qkwargs)  # todo: parse kwargs from the command
-        if not result:
-            result = f"Command {command} finished successfully"
+        name, qargs, qkwargs = parse_query(prompt)
+        # todo: if necessary args are missing, ask for them
+        args, kwargs = command.bind(qargs, qkwargs)
+        result = await run_command(bot, command.func, is_remote, *args, **kwargs)
         # escape_markdown_flag = not bot.command_registry.is_markdown_safe(command)
         # response_message = send_message_to_user(update.effective_message, result, enable_markdown=bot.markdown_enabled,
         #                                         escape_markdown_flag=escape_markdown_flag)
-        response_message = send_message_to_user(update.effective_message, result)
-        if result.startswith("Active topic"):
-            response_message.pin()
+        await respond(update, context, name, result)
 
     return command_handler
 
 
-def main(expensive: bool) -> None:
+def main(expensive: bool, history_backend: str = 'json', history_flush_interval: float = FLUSH_INTERVAL,
+         history_fsync: bool = False, max_concurrent_chats: int = MAX_CONCURRENT_CHATS,
+         requests_per_minute: int = REQUESTS_PER_MINUTE, tokens_per_minute: int = TOKENS_PER_MINUTE,
+         streaming: bool = True, max_retries: int = MAX_RETRIES, hedge_requests: bool = False,
+         http_pool_size: int = POOL_SIZE, http_connect_timeout: float = CONNECT_TIMEOUT,
+         http_read_timeout: float = READ_TIMEOUT, semantic_cache_threshold: float = None, mode: str = 'polling',
+         webhook_url: str = None, webhook_host: str = WEBHOOK_HOST, webhook_port: int = WEBHOOK_PORT,
+         webhook_secret: str = None, webhook_max_queued: int = MAX_QUEUED_UPDATES,
+         context_strategy: str = DEFAULT_CONTEXT_STRATEGY) -> None:
     """
     Start the bot
     :param expensive: Use 'text-davinci-003' model instead of 'text-ada:001'
+    :param history_backend: 'json' - a history file per user, 'sqlite' - one database for all users
+    :param history_flush_interval: max seconds history changes wait before being written to disk
+    :param history_fsync: fsync history on every write batch
+    :param max_concurrent_chats: max conversations waiting on OpenAI at the same time
+    :param requests_per_minute: OpenAI requests per minute limit of the api key
+    :param tokens_per_minute: OpenAI tokens per minute limit of the api key
+    :param streaming: show chat responses while they are generated, editing the message as the text arrives
+    :param max_retries: retries of transient OpenAI errors
+    :param hedge_requests: send a duplicate of an unusually slow OpenAI request, use the first answer
+    :param http_pool_size: keep-alive connections kept open per host, for OpenAI and Telegram
+    :param http_connect_timeout: seconds to establish a connection
+    :param http_read_timeout: seconds to wait for response data
+    :param semantic_cache_threshold: answer prompts at least that similar to an earlier one (in the same context)
+        from cache. None - only exact matches are cached
+    :param mode: 'polling' - ask telegram for updates, 'webhook' - receive them on a local HTTP server
+    :param webhook_url: public https url that reaches the webhook server - registered with telegram on start.
+        None - don't register, e.g. when the webhook is set up once for several workers behind a load balancer
+    :param webhook_host: interface for the webhook server
+    :param webhook_port: port for the webhook server
+    :param webhook_secret: token telegram sends with every update, updates without it are refused.
+        By default - secrets.txt 'telegram_webhook_secret', or a random one (then webhook_url is required)
+    :param webhook_max_queued: updates waiting to be handled, above that telegram is asked to deliver them later
+    :param context_strategy: past messages sent for context, until a user sets their own - 'recency' or 'relevance'
     :return:
     """
     # Create the Updater and pass it your bot's token.
     token = secrets["telegram_api_token"]
-    updater = Updater(token)
+    # one pool of keep-alive connections for the OpenAI calls of all users
+    http_session = PooledSession(pool_size=http_pool_size, connect_timeout=http_connect_timeout,
+                                 read_timeout=http_read_timeout)
+    install_openai_transport(http_session)
+    updater = Updater(token, request_kwargs=get_telegram_request_kwargs(http_pool_size, http_connect_timeout,
+                                                                        http_read_timeout))
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
 
     globals()['default_model'] = "text-davinci-003" if expensive else "text-ada:001"
+    globals()['history_backend'] = history_backend
+    globals()['history_flusher'] = HistoryFlusher(flush_interval=history_flush_interval, fsync=history_fsync)
+    globals()['runtime'] = AsyncRuntime(max_concurrent_chats=max_concurrent_chats)
+    globals()['send_queue'] = SendQueue()
+    globals()['streaming'] = streaming
+    globals()['default_context_strategy'] = context_strategy
+    globals()['resilient_caller'] = ResilientCaller(max_retries=max_retries, hedge=hedge_requests)
+    if semantic_cache_threshold is not None:
+        globals()['semantic_cache'] = SemanticCache(threshold=semantic_cache_threshold)
+    globals()['openai_scheduler'] = OpenAIScheduler(requests_per_minute=requests_per_minute,
+                                                    tokens_per_minute=tokens_per_minute)
     # on non command i.e message - echo the message on Telegram
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, chat_handler))
-
-    for command in telegram_commands_registry.list_commands():
-        match command:
-            case "/get_topics_menu":
-                command_handler = topics_menu_handler
-            case other:
-                function_name = telegram_commands_registry.get_function(command)
-                command_handler = make_command_handler(function_name)
-        dispatcher.add_handler(CommandHandler(command.lstrip('/'), command_handler))
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, schedule(chat_handler)))
+
+    for shortcut, command in telegram_commands_registry.dispatch_table.items():
+        # commands with a menu (e.g. /topics_menu) return a MenuResponse - see respond()
+        dispatcher.add_handler(CommandHandler(shortcut.lstrip('/'), schedule(make_command_handler(command))))
     dispatcher.add_handler(CommandHandler("/announce", announce_command))
 
     # Add the callback handler to the dispatcher
-    dispatcher.add_handler(CallbackQueryHandler(button_callback))
+    dispatcher.add_handler(CallbackQueryHandler(schedule(button_callback)))
 
     # Update commands list
-    commands = [BotCommand(command, telegram_commands_registry.get_description(command)) for command in
-                telegram_commands_registry.list_commands()]
-    dispatcher.bot.set_my_commands(commands)
+    dispatcher.bot.set_my_commands(telegram_commands_registry.get_bot_commands())
 
     # Add the error handler to the dispatcher
     dispatcher.add_error_handler(error_handler)
 
     # Start the Bot
-    updater.start_polling()
+    webhook = None
+    if mode == 'webhook':
+        if webhook_secret is None:
+            webhook_secret = secrets.get('telegram_webhook_secret')
+        if webhook_secret is None:
+            if webhook_url is None:
+                raise ValueError("Webhook without a url needs a secret shared with the registered webhook")
+            webhook_secret = generate_secret_token()
+        webhook = WebhookServer(lambda data: dispatcher.process_update(Update.de_json(data, dispatcher.bot)),
+                                host=webhook_host, port=webhook_port, path=WEBHOOK_PATH,
+                                secret_token=webhook_secret, max_queued=webhook_max_queued)
+        webhook.start()
+        if webhook_url is not None:
+            dispatcher.bot.set_webhook(webhook_url, secret_token=webhook_secret)
+        host, port = webhook.address
+        logger.info(f"Receiving updates on http://{host}:{port}{WEBHOOK_PATH}")
+    else:
+        updater.start_polling()
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     count = 0
-    while True:
-        time.sleep(1)
-
-        # heartbeat
-        count += 1
-        if count % 60 == 0:
-            # touch the touch file
-            with open(TOUCH_FILE_PATH, 'w'):
-                pass
+    try:
+        while True:
+            time.sleep(1)
+
+            # heartbeat
+            count += 1
+            if count % 60 == 0:
+                # touch the touch file
+                with open(TOUCH_FILE_PATH, 'w'):
+                    pass
+                if send_queue.get_depth():
+                    logger.info(f"Telegram send queue: {send_queue.stats()}")
+                if webhook is not None:
+                    logger.info(f"Webhook: {webhook.stats()}")
+    finally:
+        if webhook is not None:
+            webhook.stop()  # handle the updates already received
+        updater.stop()
+        runtime.stop()  # let the handlers in progress finish
+        send_queue.close()  # send the queued messages
+        history_flusher.close()  # drain all pending history writes
+        http_session.shutdown()
 
 
 if __name__ == '__main__':
-    import argparse
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--expensive", action="store_true",
-                        help="use expensive calculation - 'text-davinci-003' model instead of 'text-ada:001' ")
-    args = parser.parse_args()
+    from .cli import make_argument_parser, get_main_kwargs
 
-    main(expensive=args.expensive)
+    main(**get_main_kwargs(make_argument_parser().parse_args()))
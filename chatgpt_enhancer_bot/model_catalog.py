@@ -0,0 +1,84 @@
+"""
+Catalog of the available OpenAI models, shared by all users
+
+Seeded from the bundled resources/models_list.txt, so it's usable right away without a network call.
+Once the data is older than the TTL, the next lookup starts a refresh in a background thread
+and keeps answering from the current data meanwhile.
+"""
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MODELS_LIST_PATH = os.path.join(os.path.dirname(__file__), 'resources/models_list.txt')
+CATALOG_TTL = 3600  # seconds
+REFRESH_RETRY_INTERVAL = 60  # seconds to wait after a failed refresh
+
+
+class ModelCatalog:
+    def __init__(self, list_models, ttl=CATALOG_TTL, seed_path=MODELS_LIST_PATH):
+        """
+        :param list_models: callable returning the models, objects with an `id` - e.g. Model.list().data
+        :param ttl: seconds before the data is refreshed
+        :param seed_path: model ids to start with, one per line. None - start empty
+        """
+        self._list_models = list_models
+        self.ttl = ttl
+        models = {}
+        if seed_path is not None and os.path.exists(seed_path):
+            with open(seed_path) as f:
+                models = {line.strip(): None for line in f if line.strip()}  # no model info until refreshed
+        self._set_models(models)
+        self._expires = 0.  # seeded data is refreshed on first use
+        self._refresh_lock = threading.Lock()
+        self._refresh_thread = None
+
+    def _set_models(self, models):
+        # readers get either the old or the new dict - no locking needed
+        self._models = models
+        self._ids = sorted(models)
+
+    def refresh(self):
+        """ Fetch the models now. On failure keep the current data and retry after REFRESH_RETRY_INTERVAL """
+        try:
+            self._set_models({model.id: model for model in self._list_models()})
+            self._expires = time.monotonic() + self.ttl
+        except Exception as e:
+            logger.warning(f"Failed to refresh the model catalog: {e!r}")
+            self._expires = time.monotonic() + REFRESH_RETRY_INTERVAL
+
+    def _refresh_if_stale(self):
+        if time.monotonic() < self._expires:
+            return
+        with self._refresh_lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(target=self.refresh, name='model-catalog-refresh', daemon=True)
+            self._refresh_thread.start()
+
+    def wait_for_refresh(self, timeout=None):
+        thread = self._refresh_thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def __contains__(self, model_id):
+        self._refresh_if_stale()
+        return model_id in self._models
+
+    def get_ids(self):
+        """ :return: sorted list of model ids """
+        self._refresh_if_stale()
+        return self._ids
+
+    def get(self, model_id):
+        """
+        Model info. A seeded model has no info yet - then the lookup waits for the refresh of stale data.
+        Fresh data is the answer: an unknown model is not looked up again until the TTL expires
+        :raise KeyError: unknown model
+        """
+        self._refresh_if_stale()
+        if self._models.get(model_id) is None:
+            self.wait_for_refresh()  # started by _refresh_if_stale, if any
+        return self._models[model_id]
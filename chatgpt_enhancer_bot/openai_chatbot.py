@@ -1,22 +1,36 @@
 # idea: the "openai" part of the bot. API. A functionality
 import datetime
-import json
+import functools
 import logging
-import os.path
 import pprint
-from functools import cached_property
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from random_word import RandomWords
 from telegram.utils.helpers import escape_markdown
 
-from chatgpt_enhancer_bot.utils import try_guess_topic_name
+from chatgpt_enhancer_bot.utils import MenuResponse, MAX_MESSAGE_LENGTH
 from openai_wrapper import get_openai_wrapper, DEFAULT_QUERY_CONFIG
 from .command_registry import CommandRegistry
+from .context_selection import CONTEXT_STRATEGIES, DEFAULT_CONTEXT_STRATEGY, MAX_RELEVANT_TURNS, RECENT_TURNS, \
+    RELEVANCE, make_relevance_query, select_relevant_turns
+from .history_storage import JsonHistoryStorage
+from .http_transport import get_transport_stats
+from .model_catalog import ModelCatalog
+from .prompt_transcript import TopicTranscript
+from .rate_limiter import OpenAIScheduler
+from .resilience import ResilientCaller
+from .response_cache import ResponseCache, make_cache_key, is_deterministic, get_config_value, CACHED_CONFIG_FIELDS
+from .search_index import SearchIndex, make_snippet, MAX_RESULTS
+from .singleflight import SingleFlight
+from .token_budget import TokenPrefixSums, count_tokens, TURN_OVERHEAD_TOKENS
+from .topic_index import TopicIndex
+from .topic_summarizer import TopicSummarizer, SUMMARIZE_EVERY, SUMMARY_HEADER
 
 openai_wrapper = get_openai_wrapper()
 
 CONVERSATIONS_HISTORY_PATH = 'conversations_history.json'
-HISTORY_WORD_LIMIT = 1000
+HISTORY_WORD_LIMIT = 1000  # in tokens, despite the name
 
 HUMAN_TOKEN = '[H]'
 BOT_TOKEN = '[B]'
@@ -39,7 +53,44 @@ Error: *{error}*
 
 RW = RandomWords()
 
+# memory-only cache shared by bots that weren't given a persistent one
+DEFAULT_RESPONSE_CACHE = ResponseCache()
+# rate limits are per api key - so shared by everyone in the process
+DEFAULT_OPENAI_SCHEDULER = OpenAIScheduler()
+# available models - one catalog for all bots, refreshed in the background
+MODEL_CATALOG = ModelCatalog(lambda: openai_wrapper.api.Model.list().data)
+# retries and circuit breakers - per model, shared by all bots
+DEFAULT_RESILIENT_CALLER = ResilientCaller()
+# identical cacheable requests in flight at the same time (e.g. a double tap) go upstream once
+IN_FLIGHT_REQUESTS = SingleFlight()
+TOPIC_REQUEST_TEMPLATE = "What is the topic of this question?:\"{}\""
+TOPIC_NAMING_TIMEOUT = 10  # seconds - after that the question keeps a generated topic name
+# topic naming runs alongside the answer of /question
+TOPIC_NAMING_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='topic-naming')
+# query config fields passed to a streamed completion - the ones that shape the completion, same as chat() sends
+STREAM_QUERY_FIELDS = CACHED_CONFIG_FIELDS + ('user',)
+# command kwargs come as strings. stop and logit_bias are passed as is
+QUERY_FIELD_TYPES = {'model': str, 'temperature': float, 'max_tokens': int, 'top_p': float, 'n': int,
+                     'presence_penalty': float, 'frequency_penalty': float, 'best_of': int, 'suffix': str, 'user': str}
+
+
+def serialized(method):
+    """ Run the method in the user's turn queue - see OpenAIScheduler.user_turn """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._scheduler.user_turn(self._user):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def render_turn(prompt, response):
+    return f"{HUMAN_TOKEN}: {prompt}\n{BOT_TOKEN}: {response}\n"
+
+
 MAX_HISTORY_WORD_LIMIT = 4096
+HISTORY_PAGE_SIZE = 10  # messages per page of /history
 
 # Enable logging
 logging.basicConfig(
@@ -56,10 +107,25 @@ class ChatBot:  # todo: rename to OpenAIChatbot
 
     def __init__(self, model=None, history_word_limit=HISTORY_WORD_LIMIT,  # history_path=HISTORY_PATH,
                  conversations_history_path=CONVERSATIONS_HISTORY_PATH, query_config=DEFAULT_QUERY_CONFIG, user=None,
-                 **kwargs):
+                 history_storage=None, summarize_every=SUMMARIZE_EVERY, response_cache=None, scheduler=None,
+                 resilient_caller=None, semantic_cache=None, search_index=None,
+                 context_strategy=DEFAULT_CONTEXT_STRATEGY, context_all_topics=False, **kwargs):
+        """
+        :param conversations_history_path: path for the default json history storage
+        :param history_storage: HistoryStorage instance to use instead of json files, e.g. SQLiteHistoryStorage
+        :param summarize_every: summarize older turns of a topic every that many turns. None - never summarize
+        :param response_cache: ResponseCache, usually shared by all users. By default - memory only
+        :param scheduler: OpenAIScheduler - rate limits and per-user turn queue. By default - shared by all bots
+        :param resilient_caller: ResilientCaller - retries, circuit breakers and hedging. By default - shared by all bots
+        :param semantic_cache: SemanticCache - answers near-duplicate prompts from cache. By default - disabled
+        :param search_index: SearchIndex over history_storage for /search. By default - in memory, built on first use
+        :param context_strategy: which past turns are sent as context - 'recency' or 'relevance', see context_selection
+        :param context_all_topics: the relevance strategy also picks turns of the other topics
+        """
         # set up query config
         self._query_config = query_config
         self._query_config.update(**kwargs)
+        self._user = user
         if user is not None:
             self._query_config.user = user
         if model is not None:
@@ -68,13 +134,30 @@ class ChatBot:  # todo: rename to OpenAIChatbot
         self.topic_count = 0
         self._session_name = RW.get_random_word()  # random-word
         self._history_word_limit = history_word_limit
+        self._context_strategy = context_strategy
+        self._context_all_topics = context_all_topics
 
         self._active_topic = self.DEFAULT_TOPIC_NAME
         # todo: remember last active topic for each user!
-        self._conversations_history_path = conversations_history_path
-        self._conversations_history = self._load_conversations_history()  # attempt to make 'new chat' a thing
+        self._transcripts = {}  # topic -> TopicTranscript, built on first use
+        self._topic_refs = {}  # short id -> topic, for the buttons - callback data is limited to 64 bytes
+        if history_storage is None:
+            history_storage = JsonHistoryStorage(conversations_history_path)
+        self._history = history_storage
+        if not self._history.list_topics():
+            self._history.add_topic(self.DEFAULT_TOPIC_NAME)
+        self._topic_index = TopicIndex(self._history.list_topics())  # for fuzzy /switch_topic
+        self._search_index = search_index if search_index is not None else SearchIndex(self._history)
+        self._summarizer = None
+        if summarize_every:
+            self._summarizer = TopicSummarizer(self._history, self._summarize, render_turn,
+                                               summarize_every=summarize_every)
         # self._start_new_topic()
         self._traceback = []
+        self._response_cache = response_cache if response_cache is not None else DEFAULT_RESPONSE_CACHE
+        self._scheduler = scheduler if scheduler is not None else DEFAULT_OPENAI_SCHEDULER
+        self._resilient_caller = resilient_caller if resilient_caller is not None else DEFAULT_RESILIENT_CALLER
+        self._semantic_cache = semantic_cache
 
         # self.markdown_enabled = True
 
@@ -101,7 +184,6 @@ class ChatBot:  # todo: rename to OpenAIChatbot
     @telegram_commands_registry.register(group='configs')
     def set_temperature(self, temperature: float):
         """ Set temperature for the model """
-        temperature = float(temperature)
         if not 0 <= temperature <= 1:
             raise ValueError("Temperature must be in [0, 1]")
         self._query_config.temperature = temperature
@@ -116,6 +198,11 @@ class ChatBot:  # todo: rename to OpenAIChatbot
         "code-cushman-001": 2048
     }
 
+    def get_model_token_limit(self):
+        """ Max tokens the active model accepts - prompt and response combined """
+        model = self.active_model
+        return self.model_token_limit.get(model, 4000 if 'davinci' in model else 2048)
+
     @telegram_commands_registry.register(['/set_max_tokens', '/set_response_length'], group='configs')
     def set_max_tokens(self, max_tokens: int):
         """
@@ -124,10 +211,8 @@ class ChatBot:  # todo: rename to OpenAIChatbot
         :param max_tokens:
         :return:
         """
-        max_tokens = int(max_tokens)
-        model = self.active_model
         # todo: change the limits when model is changed
-        model_token_limit = self.model_token_limit.get(model, 4000 if 'davinci' in model else 2048)
+        model_token_limit = self.get_model_token_limit()
         if max_tokens > model_token_limit - self._history_word_limit:
             raise ValueError(
                 f"Max tokens combined with history word limit ({self._history_word_limit}) should not exceed {model_token_limit}")
@@ -136,12 +221,31 @@ class ChatBot:  # todo: rename to OpenAIChatbot
 
     @telegram_commands_registry.register(['/set_history_depth', '/set_history_word_limit'], group='configs')
     def set_history_word_limit(self, limit: int):
-        """Set history word limit - how many words to include for chatbot for context"""
+        """Set history word limit - how many tokens of history to include for chatbot for context"""
         if limit > MAX_HISTORY_WORD_LIMIT - self._query_config.max_tokens:
             raise ValueError(f"Limit must be less than {MAX_HISTORY_WORD_LIMIT}")
         self._history_word_limit = limit
         return f"History word limit set to {limit}"
 
+    @telegram_commands_registry.register('/set_context_strategy', group='configs')
+    def set_context_strategy(self, strategy: str, all_topics: bool = False):
+        """
+        Set which past messages are sent for context: recency - the latest, relevance - related to the new message
+        :param strategy: recency or relevance
+        :param all_topics: relevance - look for related messages in all topics, not only the active one
+        """
+        if strategy not in CONTEXT_STRATEGIES:
+            raise ValueError(f"Strategy must be one of {', '.join(CONTEXT_STRATEGIES)}")
+        self._context_strategy = strategy
+        self._context_all_topics = all_topics
+        if strategy == RELEVANCE and all_topics:
+            return f"Context strategy set to {strategy}, from all topics"
+        return f"Context strategy set to {strategy}"
+
+    def user_turn(self):
+        """ Turn of the user, for a handler on the event loop - see OpenAIScheduler.user_turn_async """
+        return self._scheduler.user_turn_async(self._user)
+
     @property
     def command_registry(self):
         return telegram_commands_registry
@@ -166,18 +270,9 @@ class ChatBot:  # todo: rename to OpenAIChatbot
         :return:
         """
         # todo: pass max topics number, adapt rows number. Get most recent topics
-        return {f"*{topic}*" if topic == self._active_topic else topic: f"/switch_topic {topic}" for topic in
-                self.list_topics()}
-
-    def _load_conversations_history(self):
-        if os.path.exists(self._conversations_history_path):
-            return json.load(open(self._conversations_history_path))
-        else:
-            return {self.DEFAULT_TOPIC_NAME: []}
-
-    def _save_conversations_history(self):
-        json.dump(self._conversations_history, open(self._conversations_history_path, 'w'), indent=' ')
-        # todo: Implement saving to database
+        return MenuResponse("Choose a topic to switch to:",
+                            {f"*{topic}*" if topic == self._active_topic else topic:
+                                 self._get_switch_topic_command(topic) for topic in self.list_topics()})
 
     def get_history(self, topic=None, limit=10):
         """
@@ -190,39 +285,121 @@ class ChatBot:  # todo: rename to OpenAIChatbot
             limit = int(limit)
         if topic is None:
             topic = self._active_topic
-        return self._conversations_history[topic][-limit:]
+        return self._history.get_history(topic, limit)
 
     @telegram_commands_registry.register('/history', group='topics')
-    def get_history_command(self, topic=None, limit=10):
+    def get_history_command(self, topic: str = None, limit: int = HISTORY_PAGE_SIZE):
+        """
+        Get conversation history for a particular topic - the latest page, with buttons for the older ones
+        :param topic: by default - current
+        :param limit: messages per page
+        :return: MenuResponse
+        """
+        if topic is None:
+            topic = self._active_topic
+        elif topic not in self._history:
+            raise RuntimeError(f"Topic {topic} not found")
+        return self._get_history_page(topic, self._history.count_messages(topic), limit)
+
+    @telegram_commands_registry.register('/history_page', group='topics')
+    def get_history_page_command(self, cursor):
+        """
+        Get a page of conversation history - used by the buttons of /history
+        :param cursor: "{topic id}:{end}:{limit}" - the page ends before message number `end`
+        :return: MenuResponse
+        """
+        ref, end, limit = cursor.split(':')
+        topic = self._topic_refs.get(ref)
+        if topic is None or topic not in self._history:
+            raise RuntimeError("This history page is outdated, use /history again")
+        return self._get_history_page(topic, int(end), int(limit))
+
+    def _get_topic_ref(self, topic):
+        for ref, name in self._topic_refs.items():
+            if name == topic:
+                return ref
+        ref = str(len(self._topic_refs))
+        self._topic_refs[ref] = topic
+        return ref
+
+    def _get_switch_topic_command(self, topic):
+        """ Callback data of a button switching to the topic - a name may not fit into 64 bytes """
+        return f"/switch_topic ref={self._get_topic_ref(topic)}"
+
+    def _get_history_page(self, topic, end, limit):
+        total = self._history.count_messages(topic)
+        end = max(0, min(end, total))
+        start = max(0, end - limit)
+        if end == 0:
+            return MenuResponse(f"No messages in {topic} yet", {})
+        entries = [f"{timestamp}\n[Human]: {prompt}\n[Bot]: {response}"
+                   for prompt, response, timestamp in self._history.get_history_range(topic, start, end)]
+        # a page is one message - the oldest messages that don't fit are left for the previous page
+        max_length = MAX_MESSAGE_LENGTH - 100  # header
+        while len(entries) > 1 and len('\n'.join(entries)) > max_length:
+            entries.pop(0)
+            start += 1
+        text = '\n'.join(entries)
+        if len(text) > max_length:
+            text = text[:max_length - 1] + '…'
+        ref = self._get_topic_ref(topic)
+        menu = {}
+        if start > 0:
+            menu['⬅ Older'] = f"/history_page {ref}:{start}:{limit}"
+        if end < total:
+            menu['Newer ➡'] = f"/history_page {ref}:{min(total, end + limit)}:{limit}"
+        return MenuResponse(f"{topic}, messages {start + 1}-{end} of {total}\n{text}", menu)
+
+    @telegram_commands_registry.register('/search', group='topics')
+    def search_command(self, query, topic: str = None, limit: int = MAX_RESULTS):
+        """
+        Search the conversation history of all topics. "Quoted phrases" must match exactly, topic=... to search one
+        :param query: words and "quoted phrases"
+        :param topic: search only this topic
+        :param limit: max results
+        :return:
         """
-        Get conversation history for a particular topic. Use limit=5 if getting 'message too long' error
-        Or ping @petr_lavrov to add pagination or buffer
-        :param topic:
-        :param limit: messages to include
+        if topic is not None and topic not in self._history:
+            raise RuntimeError(f"Topic {topic} not found")
+        hits = self._search_index.search(query, topic=topic, limit=limit)
+        if not hits:
+            return f"Nothing found for {query}"
+        return '\n\n'.join(f"{hit.topic} ({hit.timestamp})\n"
+                            f"[Human]: {make_snippet(hit.prompt, query)}\n[Bot]: {make_snippet(hit.response, query)}"
+                            for hit in hits)
+
+    @telegram_commands_registry.register('/summary', group='topics')
+    def get_summary_command(self, topic=None):
+        """
+        Get summary of the earlier conversation in a topic - it's sent to the bot instead of the old messages
+        :param topic: by default - current
         :return:
         """
-        if limit is not None:
-            limit = int(limit)
-        history = self.get_history(topic, limit)
-        # todo: figure out telegram message lenght limit - split into multiple messages
-        return '\n'.join(
-            f"{timestamp}\n"
-            f"[Human]: {prompt}\n[Bot]: {response}"
-            for prompt, response, timestamp in history)
+        if topic is None:
+            topic = self._active_topic
+        summary, covered = self._history.get_summary(topic)
+        if not summary:
+            return f"Topic {topic} is not summarized yet"
+        return f"Summary of the first {covered} messages of {topic}:\n{summary}"
 
-    # def get_summary(self):
-    # todo: get summary of the conversation from ChatGPT until this point..
+    def _summarize(self, request):
+        return self._query_openai('query_cheap', request)
 
-    def _record_history(self, prompt, response_text, topic=None):  # todo: save to proper database
+    def _record_history(self, prompt, response_text, topic=None):
         if topic is None:
             topic = self._active_topic
 
-        timestamp = datetime.datetime.now()
-        self._conversations_history[topic].append((prompt, response_text, timestamp.isoformat()))
-        self._save_conversations_history()
+        timestamp = datetime.datetime.now().isoformat()
+        self._history.record(topic, prompt, response_text, timestamp)
+        self._search_index.add(topic, self._history.count_messages(topic) - 1, prompt, response_text)
+        if topic in self._transcripts:
+            self._transcripts[topic].append(prompt, response_text)
+            if self._summarizer is not None:
+                self._summarizer.maybe_schedule(topic, len(self._transcripts[topic]))
 
     # @telegram_commands_registry.register(['/new_topic', '/nt'], group='topics', is_markdown_safe=True)
     @telegram_commands_registry.register(['/new_topic', '/nt'], group='topics')
+    @serialized
     def add_new_topic(self, name=None):
         """
         Start a new conversation thread with clean context. Saves up the token quota.
@@ -231,11 +408,12 @@ class ChatBot:  # todo: rename to OpenAIChatbot
         """
         if name is None:
             name = self._generate_new_topic_name()
-        if name in self._conversations_history:
+        if name in self._history:
             # todo: process properly? Switch instead?
             raise RuntimeError("Topic already exists")
+        self._history.add_topic(name)
+        self._topic_index.add(name)
         self._active_topic = name
-        self._conversations_history[self._active_topic] = []
         self.topic_count += 1
         # todo: name a topic accordingly, after a few messages
         # return f"Active topic: *{escape_markdown(self._active_topic, 2)}*"
@@ -256,7 +434,7 @@ class ChatBot:  # todo: rename to OpenAIChatbot
         """
         if limit is not None:
             limit = int(limit)
-        return list(self._conversations_history.keys())[-limit:]
+        return self._history.list_topics(limit)
 
     @telegram_commands_registry.register(['/topics', '/t'], group='topics')
     def list_topics_command(self, limit=10):
@@ -267,29 +445,40 @@ class ChatBot:  # todo: rename to OpenAIChatbot
 
     # @telegram_commands_registry.register(['/switch_topic', '/st'], group='topics', is_markdown_safe=True)
     @telegram_commands_registry.register(['/switch_topic', '/st'], group='topics')
-    def switch_topic(self, name=None, index=None):
+    @serialized
+    def switch_topic(self, name: str = None, index: int = None, ref: str = None):
         """
         Switch ChatGPT context to another thread of discussion. Provide name or index of the chat to switch
         :param name:
         :param index:
+        :param ref: short id of the topic - used by the buttons of the topic menus
         :return:
         """
+        if ref is not None:
+            name = self._topic_refs.get(ref)
+            if name is None or name not in self._history:
+                raise RuntimeError("This menu is outdated, use /topics_menu again")
         if name is not None:
-            if name in self._conversations_history:  # todo: fuzzy matching, especially using our random words
+            if name in self._history:
                 self._active_topic = name
                 # return f"Active topic: *{escape_markdown(name, 2)}*"  # todo - log instead? And then send logs to user
                 return f"Active topic: {name}"  # todo - log instead? And then send logs to user
-            guess = try_guess_topic_name(name, self._conversations_history.keys())
-            if guess is not None:
+            matches = self._topic_index.search(name)
+            substring_matches = [topic for topic, score in matches if score > 0.9]
+            if len(substring_matches) == 1:
+                guess = substring_matches[0]
                 self._active_topic = guess
                 # return f"Active topic: *{escape_markdown(guess, 2)}*"
-                return f"Active topic:{guess}"
+                return f"Active topic: {guess}"
             try:
                 index = int(name)
-            except:
+            except ValueError:
+                if matches:
+                    return MenuResponse(f"No topic {name}. Did you mean:",
+                                        {topic: self._get_switch_topic_command(topic) for topic, score in matches})
                 raise RuntimeError(f"Missing topic with name {escape_markdown(name, 2)}")
         if index is not None:
-            name = list(self._conversations_history.keys())[-index]
+            name = self._history.list_topics()[-index]
             self._active_topic = name
             # return f"Active topic: *{escape_markdown(name, 2)}*"  # todo - log instead? And then send logs to user
             return f"Active topic: {name}"  # todo - log instead? And then send logs to user
@@ -297,6 +486,7 @@ class ChatBot:  # todo: rename to OpenAIChatbot
 
     # @telegram_commands_registry.register(group='topics', is_markdown_safe=True)
     @telegram_commands_registry.register(group='topics')
+    @serialized
     def rename_topic(self, new_name, topic=None):
         """
         Rename conversation thread for more convenience and future reference
@@ -306,19 +496,25 @@ class ChatBot:  # todo: rename to OpenAIChatbot
         :return:
         """
         # check if new name is already taken
-        if new_name in self._conversations_history:
+        if new_name in self._history:
             # raise RuntimeError(f"Name {escape_markdown(new_name, 2)} already taken")
             raise RuntimeError(f"Name {new_name} already taken")
         if topic is None:
             topic = self._active_topic
             self._active_topic = new_name
-        elif topic not in self._conversations_history:
+        elif topic not in self._history:
             # raise RuntimeError(f"Topic {escape_markdown(topic, 2)} not found")
             raise RuntimeError(f"Topic {topic} not found")
 
         # update conversation history
-        self._conversations_history[new_name] = self._conversations_history[topic]
-        del self._conversations_history[topic]
+        self._history.rename_topic(topic, new_name)
+        self._topic_index.rename(topic, new_name)
+        self._search_index.rename_topic(topic, new_name)
+        if topic in self._transcripts:
+            self._transcripts[new_name] = self._transcripts.pop(topic)
+        for ref, name in self._topic_refs.items():
+            if name == topic:
+                self._topic_refs[ref] = new_name
 
         if new_name == self._active_topic:
             # return f"Active topic: *{escape_markdown(new_name, 2)}*"
@@ -329,12 +525,22 @@ class ChatBot:  # todo: rename to OpenAIChatbot
 
     @staticmethod
     def calculate_history_depth(history, word_limit):
-        num_items = 0
-        num_words = 0
-        while num_words <= word_limit and num_items < len(history):
-            num_words += len(history[-(num_items + 1)][0]) + len(history[-(num_items + 1)][1])
-            num_items += 1
-        return num_items
+        """ How many most recent turns of the history fit into `word_limit` tokens """
+        return TokenPrefixSums(history).depth_for_budget(word_limit)
+
+    def _get_transcript(self, topic=None):
+        if topic is None:
+            topic = self._active_topic
+        if topic not in self._transcripts:
+            self._transcripts[topic] = TopicTranscript(render_turn, self.get_history(topic, limit=0))
+        return self._transcripts[topic]
+
+    def _get_history_budget(self, prompt):
+        """ Tokens left for history: within the history limit and within the model context together with the
+        intro, the new prompt and the response """
+        model_budget = self.get_model_token_limit() - self._query_config.max_tokens - count_tokens(
+            CHATBOT_INTRO_MESSAGE) - count_tokens(prompt) - TURN_OVERHEAD_TOKENS
+        return max(0, min(self._history_word_limit, model_budget))
 
     @telegram_commands_registry.register('/start', group='basic')
     def start(self):
@@ -350,24 +556,17 @@ class ChatBot:  # todo: rename to OpenAIChatbot
         *CONGRATULATIONS* You used /help help!!
         """
         if command is None:
-            help_message = "Available commands:\n"
-            for command in self.command_registry.list_commands():
-                # todo: add command groups
-                help_message += f'{command}: {self.command_registry.get_description(command)}\n'
-            return help_message
+            # todo: add command groups
+            return self.command_registry.get_help_text()
         else:
             return self.command_registry.get_docstring(command)
 
-    @cached_property
-    def models_data(self):
-        return {m.id: m for m in openai_wrapper.api.Model.list().data}
-
     def get_models_ids(self):
         """
         Get available openai models ids
         :return: List[str]
         """
-        return sorted(self.models_data.keys())
+        return MODEL_CATALOG.get_ids()
 
     @telegram_commands_registry.register('/list_models', group='models')
     def get_models_ids_command(self):
@@ -392,7 +591,7 @@ class ChatBot:  # todo: rename to OpenAIChatbot
         :param model_id: str
         :return: dict
         """
-        return self.models_data[model_id]
+        return MODEL_CATALOG.get(model_id)
 
     @telegram_commands_registry.register('/get_model_info', group='models')
     def get_model_info_command(self, model_id):
@@ -417,7 +616,7 @@ class ChatBot:  # todo: rename to OpenAIChatbot
         """
         # check model is valid
         # todo: if model is missing - show user a menu with available models..
-        if model not in self.models_data:
+        if model not in MODEL_CATALOG:
             raise RuntimeError(f"Model {model} is not in the list, use /list_models to see available models")
         self._query_config.model = model
         return f"Active model: {model}"
@@ -431,14 +630,12 @@ class ChatBot:  # todo: rename to OpenAIChatbot
         return self._traceback[-limit:]
 
     @telegram_commands_registry.register(['/error', '/describe_error'], group='dev')
-    def describe_errors(self, limit=1):
+    def describe_errors(self, limit: int = 1):
         """
         Get last errors
         :param limit: int, number of errors to return
         :return: str
         """
-        if limit is not None:
-            limit = int(limit)
         errors = self.get_errors(limit)
         res = []
         for timestamp, error, traceback, message_text in errors:
@@ -450,6 +647,135 @@ class ChatBot:  # todo: rename to OpenAIChatbot
             ))
         return '\n'.join(res)
 
+    @telegram_commands_registry.register('/cache_stats', group='dev')
+    def get_cache_stats(self):
+        """
+        Response cache hit/miss counters, near-duplicate prompt hits and identical requests coalesced while in flight
+        :return: str
+        """
+        stats = dict(self._response_cache.stats(), **IN_FLIGHT_REQUESTS.stats())
+        if self._semantic_cache is not None:
+            stats.update(self._semantic_cache.stats())
+        return '\n'.join(f"{k}: {v:.2f}" if isinstance(v, float) else f"{k}: {v}" for k, v in stats.items())
+
+    @telegram_commands_registry.register('/openai_stats', group='dev')
+    def get_openai_stats(self):
+        """
+        OpenAI stats: waits for rate limits and for earlier messages of the same user, retries, errors, latency
+        and connection reuse
+        :return: str
+        """
+        stats = dict(self._scheduler.stats(), my_queue_depth=self._scheduler.get_user_queue_depth(self._user),
+                     **self._resilient_caller.stats(), **get_transport_stats())
+        return '\n'.join(f"{k}: {v:.2f}" if isinstance(v, float) else f"{k}: {v}" for k, v in stats.items())
+
+    def _wait_for_rate_limits(self, prompt, kwargs):
+        max_tokens = get_config_value(self._query_config, 'max_tokens', kwargs) or 0
+        self._scheduler.acquire(count_tokens(prompt) + int(max_tokens))
+
+    def _send_to_openai(self, endpoint, prompt, **kwargs):
+        """ Send the request, retrying transient errors - see ResilientCaller """
+        model = get_config_value(self._query_config, 'model', kwargs)
+        return self._resilient_caller.call(model, self._send_once, endpoint, prompt, **kwargs)
+
+    def _send_once(self, endpoint, prompt, **kwargs):
+        """ Wait for the rate limits and send the request """
+        self._wait_for_rate_limits(prompt, kwargs)
+        return getattr(openai_wrapper, endpoint)(prompt, config=self._query_config, **kwargs)
+
+    def _stream_openai(self, prompt, **kwargs):
+        """
+        Same as `_query_openai('query', prompt)`, but yields the completion in chunks as the model generates it.
+        A cached response comes as a single chunk, a finished stream is cached as usual
+        :return: generator of str
+        """
+        cache = is_deterministic(self._query_config, kwargs)
+        key = make_cache_key('query', prompt, self._query_config, kwargs)
+        if cache:
+            response = self._response_cache.get(key)
+            if response is not None:
+                yield response
+                return
+
+        params = {field: get_config_value(self._query_config, field, kwargs) for field in STREAM_QUERY_FIELDS}
+        params = {k: QUERY_FIELD_TYPES[k](v) if k in QUERY_FIELD_TYPES else v for k, v in params.items()
+                  if v is not None}
+        params.update((k, v) for k, v in kwargs.items() if k not in params)
+        chunks = []
+        # only opening the stream is retried - a stream that broke halfway can't be replayed to the user
+        stream = self._resilient_caller.call(params.get('model'), self._open_stream, prompt, params, hedge=False)
+        for event in stream:
+            choice = event['choices'][0]
+            if choice.get('index', 0):
+                continue  # n > 1 - the other completions are not shown
+            text = choice['text']
+            if text:
+                chunks.append(text)
+                yield text
+        if cache:
+            self._response_cache.set(key, ''.join(chunks))
+
+    def _query_similar(self, endpoint, prompt, context, full_prompt, **kwargs):
+        """
+        Same as `_query_openai`, but first look for a response to a near-duplicate prompt - see SemanticCache
+        :param prompt: the user's prompt - compared for similarity
+        :param context: everything that goes before the prompt - near-duplicates only match in the same context
+        :param full_prompt: what is sent to openai
+        """
+        if self._semantic_cache is None:
+            return self._query_openai(endpoint, full_prompt, **kwargs)
+        context_key = make_cache_key(endpoint, context, self._query_config, kwargs)
+        response = self._semantic_cache.get(prompt, context_key)
+        if response is None:
+            response = self._query_openai(endpoint, full_prompt, **kwargs)
+            self._semantic_cache.set(prompt, response, context_key)
+        return response
+
+    def _stream_similar(self, prompt, context, full_prompt, **kwargs):
+        """ Streaming version of `_query_similar` """
+        if self._semantic_cache is None:
+            yield from self._stream_openai(full_prompt, **kwargs)
+            return
+        context_key = make_cache_key('query', context, self._query_config, kwargs)
+        response = self._semantic_cache.get(prompt, context_key)
+        if response is not None:
+            yield response
+            return
+        chunks = []
+        for text in self._stream_openai(full_prompt, **kwargs):
+            chunks.append(text)
+            yield text
+        self._semantic_cache.set(prompt, ''.join(chunks), context_key)
+
+    def _open_stream(self, prompt, params):
+        self._wait_for_rate_limits(prompt, params)
+        return openai_wrapper.api.Completion.create(prompt=prompt, stream=True, **params)
+
+    def _query_openai(self, endpoint, prompt, cache=None, **kwargs):
+        """
+        Send a request to openai. All requests go through here
+        :param endpoint: openai_wrapper method - 'query', 'query_cheap' or 'edit'
+        :param cache: use the response cache, and share the call with identical requests in flight.
+            By default - only for deterministic settings (temperature 0)
+        :param kwargs: additional parameters for the openai_wrapper method
+        :return: str
+        """
+        if cache is None:
+            cache = is_deterministic(self._query_config, kwargs)
+        if not cache:
+            return self._send_to_openai(endpoint, prompt, **kwargs)
+
+        key = make_cache_key(endpoint, prompt, self._query_config, kwargs)
+        response = self._response_cache.get(key)
+        if response is None:
+            response = IN_FLIGHT_REQUESTS.do(key, self._send_and_cache, key, endpoint, prompt, **kwargs)
+        return response
+
+    def _send_and_cache(self, key, endpoint, prompt, **kwargs):
+        response = self._send_to_openai(endpoint, prompt, **kwargs)
+        self._response_cache.set(key, response)
+        return response
+
     # custom commands
 
     @telegram_commands_registry.register(['/raw_query', '/query'], group='custom')
@@ -461,7 +787,7 @@ class ChatBot:  # todo: rename to OpenAIChatbot
         Description https://beta.openai.com/docs/api-reference/completions/create
         :return:
         """
-        return openai_wrapper.query(prompt, config=self._query_config, **kwargs)
+        return self._query_similar('query', prompt, '', prompt, **kwargs)
 
     @telegram_commands_registry.register(group='custom')
     def cheap(self, prompt, **kwargs):
@@ -472,7 +798,7 @@ class ChatBot:  # todo: rename to OpenAIChatbot
         Description https://beta.openai.com/docs/api-reference/completions/create
         :return:
         """
-        return openai_wrapper.query_cheap(prompt, config=self._query_config, **kwargs)
+        return self._query_openai('query_cheap', prompt, **kwargs)
 
     @telegram_commands_registry.register(group='custom')
     def edit(self, prompt, instruction=None, **kwargs):
@@ -487,7 +813,7 @@ class ChatBot:  # todo: rename to OpenAIChatbot
                 instruction, prompt = prompt.split('\n', 1)
             else:
                 instruction, prompt = prompt, ""
-        return openai_wrapper.edit(prompt, instruction=instruction, config=self._query_config, **kwargs)
+        return self._query_openai('edit', prompt, instruction=instruction, **kwargs)
 
     # def get_code(self, prompt, model='', **kwargs):
     #     """
@@ -504,20 +830,33 @@ class ChatBot:  # todo: rename to OpenAIChatbot
 
     # ask
     @telegram_commands_registry.register(group='custom')
+    @serialized
     def question(self, prompt, **kwargs):
-        # determine topic
-        TOPIC_REQUEST_TEMPLATE = "What is the topic of this question?:\"{}\""
-        topic = openai_wrapper.query_cheap(TOPIC_REQUEST_TEMPLATE.format(prompt))
-        # todo: edit most recent topic message
-
-        # create new topic
-        res = self.add_new_topic(topic)
-
+        """
+        Ask a question in a new topic, named after the question.
+        The name is requested at the same time as the answer - the answer goes to a provisional topic, renamed after
+        :param prompt: the question
+        """
+        deadline = time.monotonic() + TOPIC_NAMING_TIMEOUT
+        naming = TOPIC_NAMING_EXECUTOR.submit(self._query_openai, 'query_cheap', TOPIC_REQUEST_TEMPLATE.format(prompt),
+                                              cache=True)
+        self.add_new_topic(self._generate_new_topic_name())
         answer = self.chat(prompt, **kwargs)
+
+        # todo: edit most recent topic message
+        try:
+            topic = naming.result(timeout=max(0., deadline - time.monotonic())).strip()
+            if not topic:
+                raise ValueError("Empty topic name")
+            res = self.rename_topic(topic)
+        except Exception as e:  # slow or failed naming, or the name is taken - keep the provisional name
+            logger.warning(f"Keeping topic name {self._active_topic}, naming failed: {e!r}")
+            res = f"Active topic: {self._active_topic}"
         return res + '\n' + answer  # todo: return topic and answer separately
 
     # @telegram_commands_registry.register(group='custom', is_markdown_safe=True)
     @telegram_commands_registry.register(group='custom')
+    @serialized
     def chat(self, prompt, **kwargs):
         """
         https://beta.openai.com/docs/api-reference/completions/create
@@ -526,6 +865,75 @@ class ChatBot:  # todo: rename to OpenAIChatbot
         :param kwargs:
         :return:
         """
+        context, augmented_prompt = self._make_chat_prompt(prompt)
+        response_text = self._query_similar('query', prompt, context, augmented_prompt, **kwargs)
+        response_text = self._clean_response(response_text)
+
+        # Update the conversation history
+        self._record_history(prompt, response_text)
+
+        # Return the response to the user
+        return response_text
+
+    def chat_stream(self, prompt, **kwargs):
+        """
+        Same as `chat`, but yields the response in chunks as the model generates it.
+        The response is recorded to history once the stream ends
+        :return: generator of str
+        """
+        with self._scheduler.user_turn(self._user):
+            context, augmented_prompt = self._make_chat_prompt(prompt)
+            raw_chunks = []
+            head = ''  # start of the response, held until we know if it's the bot token
+            started = False
+            for text in self._stream_similar(prompt, context, augmented_prompt, **kwargs):
+                raw_chunks.append(text)
+                if head is not None:
+                    head = (head + text).lstrip()
+                    if len(head) <= len(BOT_TOKEN) and BOT_TOKEN.startswith(head):
+                        continue
+                    text, head = self._strip_bot_token(head), None  # the rest of the text is kept as is
+                if not started:
+                    text = text.lstrip()
+                if text:
+                    started = True
+                    yield text
+            if head and self._clean_response(head):
+                yield self._clean_response(head)
+
+            self._record_history(prompt, self._clean_response(''.join(raw_chunks)))
+
+    @staticmethod
+    def _strip_bot_token(response_text):
+        response_text = response_text.lstrip()
+        if response_text.startswith(BOT_TOKEN):
+            response_text = response_text[len(BOT_TOKEN) + 1:].lstrip()  # "[B]: answer"
+        return response_text
+
+    @classmethod
+    def _clean_response(cls, response_text):
+        return cls._strip_bot_token(response_text).rstrip()
+
+    def _get_relevant_context(self, prompt, budget, recent_depth):
+        """
+        Earlier turns related to the prompt, rendered
+        :param recent_depth: the most recent turns of the active topic, in the context anyway
+        """
+        if budget <= 0:
+            return ""
+        recent = {(self._active_topic, *turn[:3]) for turn in self.get_history(limit=recent_depth)} \
+            if recent_depth else set()
+        hits = self._search_index.search(make_relevance_query(prompt),
+                                         topic=None if self._context_all_topics else self._active_topic,
+                                         limit=MAX_RELEVANT_TURNS + recent_depth)
+        selected, _ = select_relevant_turns(hits, budget, exclude=recent)
+        return ''.join(render_turn(hit.prompt, hit.response) for hit in selected)
+
+    def _make_chat_prompt(self, prompt):
+        """
+        Prompt with the intro, summary and history of the active topic
+        :return: Tuple(context - everything before the prompt, full prompt)
+        """
         # todo: Commands. Extract this into a separate method
         if prompt.startswith('/'):
             raise NotImplementedError("There was an update to command handling, this part of code is not updated yet")
@@ -540,36 +948,32 @@ class ChatBot:  # todo: rename to OpenAIChatbot
             #     return f"Unknown Command! {prompt}"
 
         # intro message for model
-        augmented_prompt = CHATBOT_INTRO_MESSAGE
         # if self.markdown_enabled:
-        #     augmented_prompt = "USE MARKDOWN FOR ALL COMPLETIONS. \n" + augmented_prompt
-
-        # history - for context
-        full_history = self.get_history(limit=0)
-        history_depth = self.calculate_history_depth(full_history, word_limit=self._history_word_limit)
-        history = full_history[-history_depth:]
-        for i in range(len(history)):
-            past_prompt, past_response, timestamp = history[i]
-            # if self._query_config['history_include_timestamp']:
-            # augmented_prompt += f"{timestamp}\n"
-            augmented_prompt += f"{HUMAN_TOKEN}: {past_prompt}\n{BOT_TOKEN}: {past_response}\n"
+        #     intro = "USE MARKDOWN FOR ALL COMPLETIONS. \n" + CHATBOT_INTRO_MESSAGE
+
+        # summary of the older turns - instead of the turns themselves
+        summary, covered = self._history.get_summary(self._active_topic)
+        summary_text = f"{SUMMARY_HEADER}{summary}\n" if summary else ""
+
+        # history - for context. Rendered turns are cached, only new ones are rendered
+        # todo: if self._query_config['history_include_timestamp']: include timestamps
+        transcript = self._get_transcript()
+        budget = self._get_history_budget(prompt) - count_tokens(summary_text)
+        max_depth = len(transcript) - covered
+        if self._context_strategy == RELEVANCE:
+            # the last turns, then the earlier ones related to the prompt in the rest of the budget
+            max_depth = min(max_depth, RECENT_TURNS)
+        history_text, depth = transcript.render(budget, load_history=lambda limit: self.get_history(limit=limit),
+                                                max_depth=max_depth)
+        if self._context_strategy == RELEVANCE:
+            budget -= transcript.token_counts.tokens_in_last(depth)
+            history_text = self._get_relevant_context(prompt, budget, depth) + history_text
 
         # include the latest prompt
-        augmented_prompt += f"{HUMAN_TOKEN}: {prompt}\n"
+        context = ''.join((CHATBOT_INTRO_MESSAGE, summary_text, history_text))
+        augmented_prompt = f"{context}{HUMAN_TOKEN}: {prompt}\n"
         logger.debug(augmented_prompt)  # print(augmented_prompt)
-
-        response_text = openai_wrapper.query(augmented_prompt, self._query_config, **kwargs)  # todo: pass hash of user
-
-        # Extract the response from the API response
-        response_text = response_text.strip()
-        if response_text.startswith(BOT_TOKEN):
-            response_text = response_text[len(BOT_TOKEN) + 1:]
-
-        # Update the conversation history
-        self._record_history(prompt, response_text)
-
-        # Return the response to the user
-        return response_text
+        return context, augmented_prompt
 
 
 def main(expensive: bool = False):
@@ -0,0 +1,49 @@
+"""
+Per-topic cache of the rendered chat transcript
+
+Each turn is rendered into its [H]/[B] segment once, when it's recorded.
+The cache only holds the segments of the most recent turns that fit into the prompt budget (plus a little slack),
+older ones are dropped as the window slides and re-rendered only if the window grows back.
+"""
+import collections
+import itertools
+
+from .token_budget import TokenPrefixSums
+
+TRANSCRIPT_SLACK = 4  # extra segments to keep beyond the current window
+
+
+class TopicTranscript:
+    def __init__(self, render_turn, history=()):
+        """
+        :param render_turn: function (prompt, response) -> str
+        :param history: full topic history, List[Tuple(prompt, response, timestamp)] - to count tokens
+        """
+        self.render_turn = render_turn
+        self.token_counts = TokenPrefixSums(history)
+        self.segments = collections.deque()  # rendered segments of the most recent turns
+
+    def append(self, prompt, response):
+        self.token_counts.append(prompt, response)
+        self.segments.append(self.render_turn(prompt, response))
+
+    def __len__(self):
+        return len(self.token_counts)
+
+    def render(self, budget, load_history, max_depth=None):
+        """
+        :param budget: max tokens for the transcript
+        :param load_history: function (limit) -> last `limit` turns of the topic. Only called if the window grew
+        :param max_depth: max turns to include, e.g. to leave out turns covered by a summary
+        :return: Tuple(transcript text of the most recent turns that fit into the budget, number of turns included)
+        """
+        depth = self.token_counts.depth_for_budget(budget)
+        if max_depth is not None:
+            depth = max(0, min(depth, max_depth))
+        missing = depth - len(self.segments)
+        if missing > 0:
+            older = load_history(depth)[:missing]
+            self.segments.extendleft(self.render_turn(prompt, response) for prompt, response, *_ in reversed(older))
+        while len(self.segments) > depth + TRANSCRIPT_SLACK:
+            self.segments.popleft()
+        return ''.join(itertools.islice(self.segments, len(self.segments) - depth, None)), depth
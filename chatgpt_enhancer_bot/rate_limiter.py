@@ -0,0 +1,213 @@
+"""
+Scheduling of outbound OpenAI traffic
+
+Token buckets for requests per minute and tokens per minute are shared by all users, so bursts wait
+instead of tripping OpenAI rate limits. Requests of each user go through a per-user FIFO queue,
+so two quick messages are answered (and recorded to history) in the order they were sent.
+"""
+import asyncio
+import contextvars
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+
+REQUESTS_PER_MINUTE = 60
+TOKENS_PER_MINUTE = 150000
+
+# user queues whose turn the current context holds. A context, not a thread: pooled threads run turns of
+# different handlers one after another, see AsyncRuntime.run_blocking
+_held_turns = contextvars.ContextVar('held_turns', default=frozenset())
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute, capacity=None, now=None):
+        """
+        :param rate_per_minute: refill rate
+        :param capacity: max burst, by default - a minute worth of refill
+        :param now: time of creation, by default - time.monotonic()
+        """
+        self.rate = rate_per_minute / 60.
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = now if now is not None else time.monotonic()
+
+    def reserve(self, amount, now):
+        """
+        Take `amount` from the bucket, going into debt if there's not enough.
+        Reservations are served in order - a later one waits for the debt of the earlier ones too
+        :return: seconds to wait until the reservation is covered
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return max(0., -self.tokens / self.rate)
+
+
+class _UserQueue:
+    """ FIFO lock - a ticket per turn. Turns wait in a thread, or on the event loop without taking a thread """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.next_ticket = 0
+        self.serving = 0
+        self.depth = 0  # waiting + in progress
+        self._async_waiters = {}  # ticket -> (loop, future) of a turn waiting on an event loop
+        self._abandoned = set()  # tickets of the turns cancelled while waiting - skipped
+
+    def take_ticket(self):
+        with self.condition:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            self.depth += 1
+            return ticket
+
+    def wait(self, ticket):
+        with self.condition:
+            while self.serving != ticket:
+                self.condition.wait()
+
+    async def wait_async(self, ticket):
+        loop = asyncio.get_running_loop()
+        with self.condition:
+            if self.serving == ticket:
+                return
+            future = loop.create_future()
+            self._async_waiters[ticket] = (loop, future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.condition:
+                self._async_waiters.pop(ticket, None)
+                granted = self.serving == ticket
+                if not granted:
+                    self._abandoned.add(ticket)
+            if granted:
+                self.exit()
+            raise
+
+    def exit(self):
+        """ End the turn being served """
+        with self.condition:
+            self.serving += 1
+            self.depth -= 1
+            while self.serving in self._abandoned:
+                self._abandoned.discard(self.serving)
+                self.serving += 1
+                self.depth -= 1
+            self.condition.notify_all()
+            waiter = self._async_waiters.pop(self.serving, None)
+        if waiter is not None:
+            loop, future = waiter
+            loop.call_soon_threadsafe(_set_result, future)
+
+
+def _set_result(future):
+    if not future.done():  # cancelled meanwhile
+        future.set_result(None)
+
+
+class OpenAIScheduler:
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE,
+                 clock=time.monotonic, sleep=time.sleep):
+        """
+        :param clock: seconds, monotonic - e.g. a fake one in tests, with `sleep` to go with it
+        """
+        self._clock = clock
+        self._sleep = sleep
+        self._requests = TokenBucket(requests_per_minute, now=clock())
+        self._tokens = TokenBucket(tokens_per_minute, now=clock())
+        self._lock = threading.Lock()
+        self._user_queues = {}
+        self._user_queues_lock = threading.Lock()
+
+        self.num_requests = 0
+        self.rate_limit_wait_total = 0.
+        self.rate_limit_wait_max = 0.
+        self.num_turns = 0
+        self.user_queue_wait_total = 0.
+        self.user_queue_wait_max = 0.
+
+    def acquire(self, estimated_tokens):
+        """
+        Block until a request of `estimated_tokens` (prompt + max_tokens) fits into the rate limits
+        :return: seconds waited
+        """
+        with self._lock:
+            now = self._clock()
+            wait = max(self._requests.reserve(1, now), self._tokens.reserve(estimated_tokens, now))
+            self.num_requests += 1
+            self.rate_limit_wait_total += wait
+            self.rate_limit_wait_max = max(self.rate_limit_wait_max, wait)
+        if wait:
+            self._sleep(wait)
+        return wait
+
+    def _get_user_queue(self, user):
+        with self._user_queues_lock:
+            return self._user_queues.setdefault(user, _UserQueue())
+
+    def _record_turn_wait(self, start):
+        wait = self._clock() - start
+        with self._lock:
+            self.num_turns += 1
+            self.user_queue_wait_total += wait
+            self.user_queue_wait_max = max(self.user_queue_wait_max, wait)
+
+    @contextmanager
+    def _hold(self, queue):
+        """ The turn is granted - nested turns of the same context (e.g. chat -> add_new_topic) don't wait """
+        token = _held_turns.set(_held_turns.get() | {queue})
+        try:
+            yield
+        finally:
+            try:
+                _held_turns.reset(token)
+            except ValueError:
+                pass  # a stream closed from another context - the context that held the turn is gone
+            queue.exit()
+
+    @contextmanager
+    def user_turn(self, user):
+        """ Serialize turns of a user - the block runs after all the earlier turns of the user finished """
+        queue = self._get_user_queue(user)
+        if queue in _held_turns.get():
+            yield
+            return
+        start = self._clock()
+        queue.wait(queue.take_ticket())
+        self._record_turn_wait(start)
+        with self._hold(queue):
+            yield
+
+    @asynccontextmanager
+    async def user_turn_async(self, user):
+        """
+        Same as `user_turn`, waiting on the event loop - e.g. before taking a chat slot (AsyncRuntime.run_chat).
+        Blocking calls the block awaits in AsyncRuntime.run_blocking are in the turn already
+        """
+        queue = self._get_user_queue(user)
+        if queue in _held_turns.get():
+            yield
+            return
+        start = self._clock()
+        await queue.wait_async(queue.take_ticket())
+        self._record_turn_wait(start)
+        with self._hold(queue):
+            yield
+
+    def get_user_queue_depth(self, user):
+        queue = self._user_queues.get(user)
+        return queue.depth if queue is not None else 0
+
+    def stats(self):
+        depths = [queue.depth for queue in self._user_queues.values()]
+        return {
+            'requests': self.num_requests,
+            'rate_limit_wait_avg': self.rate_limit_wait_total / self.num_requests if self.num_requests else 0.,
+            'rate_limit_wait_max': self.rate_limit_wait_max,
+            'user_turns': self.num_turns,
+            'user_queue_wait_avg': self.user_queue_wait_total / self.num_turns if self.num_turns else 0.,
+            'user_queue_wait_max': self.user_queue_wait_max,
+            'user_queue_depth_total': sum(depths),
+            'user_queue_depth_max': max(depths, default=0),
+        }
@@ -0,0 +1,212 @@
+"""
+Retries, circuit breaking and hedged requests for OpenAI calls
+
+Transient errors (rate limits, timeouts, 5xx) are retried with jittered exponential backoff, respecting Retry-After.
+A model that keeps failing gets its circuit opened for a while - requests fail fast instead of piling up.
+With hedging enabled, a request slower than the usual (a latency percentile of the model) gets a duplicate,
+and whichever answer arrives first is used.
+"""
+import logging
+import random
+import threading
+import time
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+MAX_RETRIES = 3
+BACKOFF_BASE = 1.  # seconds
+BACKOFF_CAP = 30.  # seconds
+FAILURE_THRESHOLD = 5  # consecutive transient failures that open the circuit
+RESET_TIMEOUT = 30.  # seconds the circuit stays open before a trial request
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20  # no hedging until the model has that many latencies recorded
+LATENCY_WINDOW = 200
+
+# openai error classes worth retrying - matched by name, so the openai package is not needed here
+TRANSIENT_ERRORS = {'RateLimitError', 'APIConnectionError', 'Timeout', 'APITimeoutError', 'ServiceUnavailableError',
+                    'APIError', 'TryAgain', 'ConnectionError', 'TimeoutError'}
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+def is_transient(error):
+    return any(cls.__name__ in TRANSIENT_ERRORS for cls in type(error).__mro__)
+
+
+def get_retry_after(error, cap=BACKOFF_CAP):
+    """
+    Retry-After header of the error response, in seconds. None if there's none
+    :param cap: max seconds - a worker thread sleeps that long, whatever the server asks for
+    """
+    headers = getattr(error, 'headers', None) or {}
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    try:
+        return min(max(0., float(value)), cap) if value is not None else None
+    except ValueError:
+        return None
+
+
+def get_backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """ Exponential backoff with full jitter - retries of many users don't come back all at once """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def check(self):
+        """ Raise CircuitOpenError if the circuit is open. After reset_timeout, a single trial request goes through """
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"Too many failures, not sending requests for {self.reset_timeout:.0f}s")
+            self.opened_at = time.monotonic()  # half-open: let this one through, the rest wait for its result
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    def __init__(self, window=LATENCY_WINDOW):
+        self._latencies = deque(maxlen=window)
+
+    def add(self, latency):
+        self._latencies.append(latency)
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def __iter__(self):
+        return iter(self._latencies)
+
+    def percentile(self, p):
+        """ :return: None if there are no samples """
+        if not self._latencies:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+
+class ResilientCaller:
+    def __init__(self, max_retries=MAX_RETRIES, hedge=False, hedge_percentile=HEDGE_PERCENTILE,
+                 failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT, sleep=time.sleep):
+        """
+        :param max_retries: retries of a transient error, 0 - no retries
+        :param hedge: send a duplicate of a request slower than `hedge_percentile` of the model latencies
+        """
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self._sleep = sleep
+        self._breakers = defaultdict(lambda: CircuitBreaker(failure_threshold, reset_timeout))
+        self._latencies = defaultdict(LatencyTracker)
+        self._executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='openai-hedge') if hedge else None
+        self._lock = threading.Lock()
+
+        self.num_calls = 0
+        self.num_retries = 0
+        self.num_errors = 0
+        self.num_hedges = 0
+        self.num_hedge_wins = 0
+
+    def call(self, model, func, *args, hedge=None, **kwargs):
+        """
+        Call func(*args, **kwargs) with retries of transient errors
+        :param model: circuit breakers and latencies are per model
+        :param hedge: override the hedging setting - e.g. a stream can't be hedged
+        """
+        breaker = self._breakers[model]
+        hedge = self.hedge if hedge is None else hedge
+        with self._lock:
+            self.num_calls += 1
+        for attempt in range(self.max_retries + 1):
+            breaker.check()
+            start = time.monotonic()
+            try:
+                if hedge and self._executor is not None:
+                    result = self._call_hedged(model, func, args, kwargs)
+                else:
+                    result = func(*args, **kwargs)
+            except Exception as e:
+                if not is_transient(e):
+                    with self._lock:
+                        self.num_errors += 1
+                    raise
+                breaker.record_failure()
+                if attempt == self.max_retries:
+                    with self._lock:
+                        self.num_errors += 1
+                    raise
+                retry_after = get_retry_after(e)
+                delay = retry_after if retry_after is not None else get_backoff_delay(attempt)
+                logger.warning(f"{model}: {e!r}, retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                with self._lock:
+                    self.num_retries += 1
+                self._sleep(delay)
+            else:
+                breaker.record_success()
+                self._latencies[model].add(time.monotonic() - start)
+                return result
+
+    def _call_hedged(self, model, func, args, kwargs):
+        latencies = self._latencies[model]
+        threshold = latencies.percentile(self.hedge_percentile) if len(latencies) >= HEDGE_MIN_SAMPLES else None
+        first = self._executor.submit(func, *args, **kwargs)
+        if threshold is None:
+            return first.result()
+        done, _ = wait([first], timeout=threshold)
+        if done:
+            return first.result()
+
+        with self._lock:
+            self.num_hedges += 1
+        second = self._executor.submit(func, *args, **kwargs)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        with self._lock:
+                            self.num_hedge_wins += 1
+                    return future.result()
+        return first.result()  # both failed - raise the error of the original request
+
+    def stats(self):
+        latencies = LatencyTracker(window=None)
+        for tracker in self._latencies.values():
+            for latency in tracker:
+                latencies.add(latency)
+        p50, p99 = latencies.percentile(0.5), latencies.percentile(0.99)
+        return {
+            'calls': self.num_calls,
+            'retries': self.num_retries,
+            'error_rate': self.num_errors / self.num_calls if self.num_calls else 0.,
+            'latency_p50': p50 or 0.,
+            'latency_p99': p99 or 0.,
+            'hedged_requests': self.num_hedges,
+            'hedge_wins': self.num_hedge_wins,
+            'open_circuits': ', '.join(model for model, breaker in self._breakers.items() if breaker.is_open),
+        }
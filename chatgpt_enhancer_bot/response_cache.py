@@ -0,0 +1,160 @@
+"""
+Cache of OpenAI responses: in-memory LRU in front of an on-disk sqlite store
+
+Keyed on endpoint, normalized prompt and the query config fields that affect the completion.
+By default only deterministic queries (temperature 0) are cached - see `is_deterministic`.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+CACHED_CONFIG_FIELDS = ('model', 'temperature', 'max_tokens', 'top_p', 'n', 'stop', 'presence_penalty',
+                        'frequency_penalty', 'best_of', 'suffix', 'logit_bias')
+DEFAULT_TTL = 7 * 24 * 3600  # seconds
+MEMORY_CACHE_SIZE = 1000
+DISK_CACHE_MAX_ENTRIES = 100000
+EVICTION_CHECK_EVERY = 100  # inserts
+
+
+def normalize_prompt(prompt):
+    """ Strip whitespace around the prompt and at line ends - it doesn't change the meaning """
+    return '\n'.join(line.rstrip() for line in prompt.strip().splitlines())
+
+
+def get_config_value(config, field, kwargs):
+    if field in kwargs:
+        return kwargs[field]
+    return getattr(config, field, None)
+
+
+def is_deterministic(config, kwargs):
+    """ Same prompt gets the same completion - safe to cache """
+    temperature = get_config_value(config, 'temperature', kwargs)
+    try:
+        return temperature is not None and float(temperature) == 0
+    except ValueError:
+        return False
+
+
+def make_cache_key(endpoint, prompt, config, kwargs):
+    """
+    :param endpoint: openai_wrapper method name - 'query', 'query_cheap', 'edit'
+    :param config: query config
+    :param kwargs: extra query parameters, override config fields
+    :return: str
+    """
+    fields = {field: get_config_value(config, field, kwargs) for field in CACHED_CONFIG_FIELDS}
+    extra = {k: v for k, v in kwargs.items() if k not in fields}
+    payload = json.dumps([endpoint, normalize_prompt(prompt), fields, extra], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path=None, ttl=DEFAULT_TTL, memory_size=MEMORY_CACHE_SIZE,
+                 max_entries=DISK_CACHE_MAX_ENTRIES):
+        """
+        :param path: sqlite file for the on-disk store. None - memory only
+        :param ttl: seconds a response stays valid
+        :param memory_size: max entries in the in-memory LRU
+        :param max_entries: max entries on disk, least recently used are evicted
+        """
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()  # key -> (created, value)
+        self._lock = threading.Lock()
+        self._inserts = 0
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            with self._db:
+                self._db.execute('CREATE TABLE IF NOT EXISTS responses '
+                                 '(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, '
+                                 'accessed REAL NOT NULL)')
+                self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+
+    def _remember(self, key, created, value):
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _get(self, key, now):
+        if key in self._memory:
+            created, value = self._memory[key]
+            if now - created <= self.ttl:
+                self._memory.move_to_end(key)
+                return value
+            del self._memory[key]
+        if self._db is None:
+            return None
+        rows = self._db.execute('SELECT value, created FROM responses WHERE key = ?', (key,)).fetchall()
+        if not rows:
+            return None
+        value, created = rows[0]
+        with self._db:
+            if now - created > self.ttl:
+                self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                return None
+            self._db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        self._remember(key, created, value)
+        return value
+
+    def get(self, key):
+        """ :return: cached response or None """
+        with self._lock:
+            value = self._get(key, time.time())
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+            if self._db is None:
+                return
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO responses (key, value, created, accessed) '
+                                 'VALUES (?, ?, ?, ?)', (key, value, now, now))
+            self._inserts += 1
+            if self._inserts % EVICTION_CHECK_EVERY == 0:
+                self._evict(now)
+
+    def _evict(self, now):
+        with self._db:
+            self._db.execute('DELETE FROM responses WHERE created < ?', (now - self.ttl,))
+            self._db.execute('DELETE FROM responses WHERE key IN '
+                             '(SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                             (self.max_entries,))
+
+    def __len__(self):
+        if self._db is None:
+            return len(self._memory)
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.,
+            'memory_entries': len(self._memory),
+            'entries': len(self),
+        }
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                with self._db:
+                    self._db.execute('DELETE FROM responses')
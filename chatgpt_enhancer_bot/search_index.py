@@ -0,0 +1,466 @@
+"""
+Full-text search over the conversation history of a user, across topics - for /search
+
+An inverted index: term -> {message: term frequency} over the prompts and responses, ranked with BM25.
+Words are matched in any order, "quoted phrases" must appear as is - they are checked on the best
+candidates only, so a phrase costs about the same as its words. The messages of rare terms are all scored.
+A common term (in thousands of messages) is read through its impact list - its messages ordered by its
+BM25 weight in them - and reading stops once the weights left can't beat the results found, so a query
+of common words scores hundreds of messages rather than most of the history. The top results are exact.
+
+The index has no text: a message is its topic and position, the text of the results is read from the history.
+Messages are added as they are recorded. The index is persisted as a snapshot of the postings + journal
+(the format of history_journal.py) next to the history, written through the history flusher. It's loaded on
+first use and catches up with the history then - a new index is built from it.
+"""
+import heapq
+import itertools
+import math
+import re
+import threading
+from collections import Counter, defaultdict, namedtuple
+
+from .history_journal import HistoryJournal, OP_MESSAGE, OP_RENAME, COMPACT_EVERY
+from .history_storage import JOURNAL_RECORD, COMPACTION
+
+K1 = 1.2
+B = 0.75
+MAX_RESULTS = 5
+SNIPPET_LENGTH = 300  # characters of a prompt or a response shown in the results
+IMPACT_LIST_MIN_DOCS = 2000  # terms in more messages are read through an impact list
+IMPACT_LIST_STEP = 256  # messages of an impact list read between checks of the threshold
+IMPACT_LIST_REBUILD_GROWTH = 1.1  # rebuilt once there are this many times more messages
+MAX_FILTERED_DOCS = 10000  # a topic or a word of a phrase in fewer messages - they are all checked
+INDEX_SNAPSHOT_VERSION = 2  # postings without the text. Version 1 had the text of the messages
+# the snapshot is rewritten once the journal has this share of the messages - a big index is rewritten less often
+JOURNAL_GROWTH = 0.1
+_TOKEN_RE = re.compile(r'\w+')
+_QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+
+SearchHit = namedtuple('SearchHit', ['topic', 'prompt', 'response', 'timestamp', 'score'])
+# messages of a term by its weight in them, best first. bounds - the weight every IMPACT_LIST_STEP messages
+_ImpactList = namedtuple('_ImpactList', ['doc_ids', 'bounds', 'num_docs', 'avg_length'])
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(text.lower())
+
+
+def parse_search_query(query):
+    """
+    :return: Tuple(terms, phrases) - all the words, and the "quoted phrases" as lists of words
+    """
+    terms = []
+    phrases = []
+    for phrase, word in _QUERY_RE.findall(query):
+        tokens = tokenize(phrase or word)
+        if phrase and len(tokens) > 1:
+            phrases.append(tokens)
+        terms.extend(tokens)
+    return terms, phrases
+
+
+def make_snippet(text, query, length=SNIPPET_LENGTH):
+    """ Part of the text around the first word of the query it contains """
+    if len(text) <= length:
+        return text
+    terms, _ = parse_search_query(query)
+    lowered = text.lower()
+    positions = [match.start() for match in (re.search(rf'\b{re.escape(term)}\b', lowered) for term in terms)
+                 if match is not None]
+    start = max(0, min(positions, default=0) - length // 4)
+    end = min(len(text), start + length)
+    return ('…' if start else '') + text[start:end] + ('…' if end < len(text) else '')
+
+
+def compile_phrase(phrase):
+    """
+    A regex finding the words of the phrase in lowercased text - one after another, as tokenize splits them.
+    Without a word boundary at the start: re looks for the literal first word quickly, see contains_phrase
+    """
+    return re.compile(r'\W+'.join(map(re.escape, phrase)) + r'(?!\w)')
+
+
+def contains_phrase(pattern, text):
+    """ :param pattern: from compile_phrase """
+    match = pattern.search(text)
+    while match is not None:
+        start = match.start()
+        if not start or not _TOKEN_RE.match(text, start - 1):
+            return True
+        match = pattern.search(text, start + 1)  # the end of a longer word - a match may overlap it
+    return False
+
+
+def count_terms(prompt, response):
+    """ :return: Tuple(term -> frequency in the message, number of words) """
+    tokens = tokenize(prompt) + tokenize(response)
+    return Counter(tokens), len(tokens)
+
+
+def encode_posting(posting, num_docs):
+    """
+    :param posting: {doc id: term frequency}, in the order of doc ids
+    :param num_docs: only the doc ids before it
+    :return: Tuple(doc ids as deltas from the previous one, [doc id, frequency, ...] of the frequencies above 1)
+    """
+    deltas = []
+    frequencies = []
+    previous = 0
+    for doc_id, tf in posting.items():
+        if doc_id >= num_docs:
+            break
+        deltas.append(doc_id - previous)
+        previous = doc_id
+        if tf > 1:
+            frequencies += (doc_id, tf)
+    return deltas, frequencies
+
+
+def decode_posting(deltas, frequencies):
+    posting = dict.fromkeys(itertools.accumulate(deltas), 1)
+    posting.update(zip(frequencies[::2], frequencies[1::2]))
+    return posting
+
+
+class SearchIndex:
+    """
+    The index holds references to the messages - topic and position - and reads the text from the history storage
+    for the results and the phrase checks. It's loaded on the first search, the messages the history has and
+    the index doesn't (all of them if it's new) are indexed then - until that, recording a message costs nothing
+    """
+
+    def __init__(self, history, path=None, flusher=None, fsync=False):
+        """
+        :param history: HistoryStorage of the user - the messages to index and their text
+        :param path: snapshot file, the journal is next to it. None - keep in memory only
+        :param flusher: HistoryFlusher for the journal writes and compactions. None - write synchronously
+        """
+        self._history = history
+        self._postings = defaultdict(dict)  # term -> {doc id: term frequency}
+        self._docs = []  # doc id -> (topic id, index of the message in the topic)
+        self._doc_lengths = []
+        self._total_length = 0
+        self._topics = []  # topic id -> name
+        self._topic_ids = {}
+        self._topic_docs = defaultdict(set)  # topic id -> doc ids
+        self._topic_sizes = defaultdict(int)  # topic id -> index of the next message of the topic to be indexed
+        self._impact_lists = {}  # term -> _ImpactList, of the common terms that were searched for
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._pending_renames = []  # (topic, new name) renamed before the load, the journal may not have them yet
+        self._flusher = flusher
+        self._journal = None
+        if path is not None:
+            self._journal = HistoryJournal(path, fsync=fsync)
+
+    def _load(self):
+        self._loaded = True
+        if self._journal is not None:
+            snapshot, version = self._journal.read_snapshot()
+            if snapshot is not None and version == INDEX_SNAPSHOT_VERSION:
+                self._load_snapshot(snapshot)
+            # an older snapshot with the text of the messages is dropped - the messages are indexed again below
+            self._journal.replay(self._apply)
+        for topic, new_name in self._pending_renames:
+            self._rename(topic, new_name)  # no-op if the journal had it
+        self._pending_renames = []
+        added = self._catch_up()
+        if self._journal is not None:
+            self._set_compaction_interval()
+            if added or self._journal.needs_compaction:
+                self._compact()
+
+    def _load_snapshot(self, snapshot):
+        self._topics = snapshot['topics']
+        self._topic_ids = {topic: topic_id for topic_id, topic in enumerate(self._topics)}
+        self._docs = list(zip(snapshot['doc_topics'], snapshot['doc_indexes']))
+        self._doc_lengths = snapshot['doc_lengths']
+        self._total_length = sum(self._doc_lengths)
+        for doc_id, (topic_id, index) in enumerate(self._docs):
+            self._topic_docs[topic_id].add(doc_id)
+            self._topic_sizes[topic_id] = max(self._topic_sizes[topic_id], index + 1)
+        self._postings.update((term, decode_posting(*encoded)) for term, encoded in snapshot['postings'].items())
+
+    def _catch_up(self):
+        """
+        Index the messages of the history the index doesn't have
+        :return: number of messages indexed
+        """
+        added = 0
+        for topic in self._history.list_topics():
+            topic_id = self._get_topic_id(topic)
+            start = self._topic_sizes[topic_id]
+            end = self._history.count_messages(topic)
+            if start >= end:
+                continue
+            for index, (prompt, response, _) in enumerate(self._history.get_history_range(topic, start, end), start):
+                self._add(topic_id, index, *count_terms(prompt, response))
+            added += end - start
+        return added
+
+    def _apply(self, record):
+        if record['op'] == OP_MESSAGE:
+            if 'terms' in record:  # older records with the text are indexed again from the history
+                self._add(self._get_topic_id(record['topic']), record['index'], record['terms'],
+                          sum(record['terms'].values()))
+        elif record['op'] == OP_RENAME:
+            self._rename(record['topic'], record['new_name'])
+
+    def _log(self, op, **fields):
+        record = self._journal.make_record(op, **fields)
+        if self._flusher is not None:
+            self._flusher.submit(self, (JOURNAL_RECORD, record))
+        else:
+            self._journal.write_batch([record])
+
+    def _set_compaction_interval(self):
+        self._journal.compact_every = max(COMPACT_EVERY, int(len(self._docs) * JOURNAL_GROWTH))
+
+    def _compact(self):
+        self._set_compaction_interval()
+        job = (self._journal.start_compaction(), len(self._docs), list(self._topics))
+        if self._flusher is not None:
+            self._flusher.submit(self, (COMPACTION, job))
+        else:
+            self._run_compaction(job)
+
+    def _run_compaction(self, job):
+        """
+        Write the snapshot of the first `num_docs` messages. Messages are added meanwhile - and are in the journal,
+        a posting is read under the lock, one at a time
+        """
+        seq, num_docs, topics = job
+        with self._lock:
+            terms = list(self._postings)
+            docs = self._docs[:num_docs]
+            doc_lengths = self._doc_lengths[:num_docs]
+        postings = {}
+        for term in terms:
+            with self._lock:
+                encoded = encode_posting(self._postings[term], num_docs)
+            if encoded[0]:
+                postings[term] = encoded
+        snapshot = {'topics': topics, 'doc_topics': [topic_id for topic_id, _ in docs],
+                    'doc_indexes': [index for _, index in docs], 'doc_lengths': doc_lengths, 'postings': postings}
+        self._journal.finish_compaction(snapshot, seq, version=INDEX_SNAPSHOT_VERSION)
+
+    def write_batch(self, items, fsync=False):
+        """ Flusher callback: write journal records in one go, run compactions in between """
+        records = []
+        for kind, item in items:
+            if kind == JOURNAL_RECORD:
+                records.append(item)
+            else:
+                if records:
+                    self._journal.write_batch(records, fsync=fsync)
+                    records = []
+                self._run_compaction(item)
+        if records:
+            self._journal.write_batch(records, fsync=fsync)
+
+    def _get_topic_id(self, topic):
+        topic_id = self._topic_ids.get(topic)
+        if topic_id is None:
+            topic_id = self._topic_ids[topic] = len(self._topics)
+            self._topics.append(topic)
+        return topic_id
+
+    def _add(self, topic_id, index, counts, length):
+        """ :return: False if the message is indexed already """
+        if index < self._topic_sizes[topic_id]:
+            return False
+        self._topic_sizes[topic_id] = index + 1
+        doc_id = len(self._docs)
+        self._docs.append((topic_id, index))
+        self._topic_docs[topic_id].add(doc_id)
+        for term, count in counts.items():
+            self._postings[term][doc_id] = count
+        self._doc_lengths.append(length)
+        self._total_length += length
+        return True
+
+    def _rename(self, topic, new_name):
+        topic_id = self._topic_ids.pop(topic, None)
+        if topic_id is not None:
+            self._topics[topic_id] = new_name
+            self._topic_ids[new_name] = topic_id
+
+    def _get_message(self, doc_id):
+        """ :return: Tuple(prompt, response, timestamp) from the history, None if it's not there """
+        topic_id, index = self._docs[doc_id]
+        try:
+            messages = self._history.get_history_range(self._topics[topic_id], index, index + 1)
+        except KeyError:
+            return None
+        return messages[0] if messages else None
+
+    def __len__(self):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            return len(self._docs)
+
+    def add(self, topic, index, prompt, response):
+        """
+        Index a recorded message. Before the load it's skipped - the load indexes it from the history
+        :param index: of the message in the topic
+        """
+        if not self._loaded:
+            return
+        counts, length = count_terms(prompt, response)
+        with self._lock:
+            if not self._add(self._get_topic_id(topic), index, counts, length) or self._journal is None:
+                return
+            self._log(OP_MESSAGE, topic=topic, index=index, terms=counts)
+            if self._journal.needs_compaction:
+                self._compact()
+
+    def rename_topic(self, topic, new_name):
+        with self._lock:
+            if self._loaded:
+                self._rename(topic, new_name)
+            else:
+                self._pending_renames.append((topic, new_name))
+            if self._journal is not None:
+                self._log(OP_RENAME, topic=topic, new_name=new_name)
+
+    def search(self, query, topic=None, limit=MAX_RESULTS):
+        """
+        :param query: words and "quoted phrases"
+        :param topic: search only this topic
+        :return: List[SearchHit] best first
+        """
+        terms, phrases = parse_search_query(query)
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if not terms or not self._docs:
+                return []
+            if any(term not in self._postings for phrase in phrases for term in phrase):
+                return []
+            restrict = [self._postings[term] for phrase in phrases for term in phrase]
+            if topic is not None:
+                if topic not in self._topic_ids:
+                    return []
+                restrict.append(self._topic_docs[self._topic_ids[topic]])
+            terms = [term for term in set(terms) if term in self._postings]
+            if not terms:
+                return []
+            best = self._search(terms, [compile_phrase(phrase) for phrase in phrases], sorted(restrict, key=len),
+                                limit)
+            hits = []
+            for score, doc_id, message in best:
+                if message is None:
+                    message = self._get_message(doc_id)
+                if message is not None:
+                    hits.append(SearchHit(self._topics[self._docs[doc_id][0]], *message, score))
+            return hits
+
+    def flush(self):
+        """ Wait until the journal writes and compactions are on disk """
+        if self._flusher is not None:
+            self._flusher.flush()
+
+    def close(self):
+        self.flush()
+        if self._journal is not None:
+            self._journal.close()
+
+    def _get_impact_list(self, term, avg_length):
+        impact_list = self._impact_lists.get(term)
+        if impact_list is None or len(self._docs) > impact_list.num_docs * IMPACT_LIST_REBUILD_GROWTH:
+            posting = self._postings[term]
+            doc_lengths = self._doc_lengths
+            weights = {doc_id: tf / (tf + K1 * (1 - B + B * doc_lengths[doc_id] / avg_length))
+                       for doc_id, tf in posting.items()}
+            doc_ids = sorted(weights, key=weights.__getitem__, reverse=True)
+            bounds = [weights[doc_ids[i]] for i in range(0, len(doc_ids), IMPACT_LIST_STEP)]
+            impact_list = self._impact_lists[term] = _ImpactList(doc_ids, bounds, len(self._docs), avg_length)
+        return impact_list
+
+    def _search(self, terms, phrases, restrict, limit):
+        """
+        :param phrases: compiled with compile_phrase
+        :param restrict: sets of doc ids each result must be in, smallest first
+        :return: List[Tuple[score, doc id, Tuple(prompt, response, timestamp) if it was read for a phrase]] best first
+        """
+        num_docs = len(self._docs)
+        avg_length = self._total_length / num_docs or 1.
+        doc_lengths = self._doc_lengths
+        weighted = []  # (term, posting, idf * (K1 + 1))
+        for term in terms:
+            posting = self._postings[term]
+            idf = math.log(1 + (num_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            weighted.append((term, posting, idf * (K1 + 1)))
+
+        def score(doc_id):
+            norm = K1 * (1 - B + B * doc_lengths[doc_id] / avg_length)
+            total = 0.
+            for _, posting, factor in weighted:
+                tf = posting.get(doc_id)
+                if tf:
+                    total += factor * tf / (tf + norm)
+            return total
+
+        best = []  # min-heap of (score, doc id, message)
+
+        def consider(doc_id):
+            if not all(doc_id in docs for docs in restrict):
+                return
+            doc_score = score(doc_id)
+            if not doc_score or (len(best) == limit and doc_score <= best[0][0]):
+                return
+            message = None
+            if phrases:
+                # checked last, on the messages that would make it to the top only
+                message = self._get_message(doc_id)
+                if message is None:
+                    return
+                texts = (message[0].lower(), message[1].lower())
+                if not all(any(contains_phrase(phrase, text) for text in texts) for phrase in phrases):
+                    return
+            if len(best) < limit:
+                heapq.heappush(best, (doc_score, doc_id, message))
+            else:
+                heapq.heapreplace(best, (doc_score, doc_id, message))
+
+        if restrict and len(restrict[0]) <= MAX_FILTERED_DOCS:
+            # few messages to choose from (a rare word of a phrase, a small topic) - score them all
+            for doc_id in restrict[0]:
+                consider(doc_id)
+            return sorted(best, reverse=True)
+
+        # messages of the rare terms are all scored. The common terms are read by weight, best first, until
+        # no message not seen yet can beat the ones found: the sum of the weights reached is below them
+        seen = set()
+        impact_lists = []
+        for term, posting, factor in weighted:
+            if len(posting) <= IMPACT_LIST_MIN_DOCS:
+                docs = posting
+            else:
+                impact_list = self._get_impact_list(term, avg_length)
+                impact_lists.append((factor, impact_list))
+                # messages added after the list was built are not in it
+                docs = itertools.takewhile(impact_list.num_docs.__le__, reversed(posting))
+            for doc_id in docs:
+                if doc_id not in seen:
+                    seen.add(doc_id)
+                    consider(doc_id)
+        if not impact_lists:
+            return sorted(best, reverse=True)
+
+        # the weights are of the average length the lists were built with - a longer one now only raises them
+        slack = max(1., max(avg_length / impact_list.avg_length for _, impact_list in impact_lists))
+        step = 0
+        while True:
+            for _, impact_list in impact_lists:
+                for doc_id in impact_list.doc_ids[step * IMPACT_LIST_STEP:(step + 1) * IMPACT_LIST_STEP]:
+                    if doc_id not in seen:
+                        seen.add(doc_id)
+                        consider(doc_id)
+            step += 1
+            threshold = slack * sum(factor * impact_list.bounds[step] for factor, impact_list in impact_lists
+                                    if step < len(impact_list.bounds))
+            if not threshold or (len(best) == limit and best[0][0] >= threshold):
+                return sorted(best, reverse=True)
@@ -0,0 +1,160 @@
+"""
+Cache of responses for near-duplicate prompts: "what is X" / "what's X?"
+
+Prompts are normalized and fingerprinted with MinHash of character trigrams, indexed with LSH bands,
+so a lookup only compares against a few candidates. A cached response is served when the Jaccard similarity
+of the trigrams is above the threshold and the context (history, query config) is the same.
+Runs fully offline. NumPy is used for the fingerprints when installed, pure python otherwise.
+"""
+import random
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+
+try:
+    import numpy as np
+except ImportError:  # optional
+    np = None
+
+SIMILARITY_THRESHOLD = 0.8
+NUM_BANDS = 16
+ROWS_PER_BAND = 4
+SHINGLE_SIZE = 3
+MAX_ENTRIES = 10000
+DEFAULT_TTL = 24 * 3600  # seconds
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+CONTRACTIONS = {"what's": "what is", "who's": "who is", "where's": "where is", "how's": "how is",
+                "it's": "it is", "that's": "that is", "there's": "there is", "can't": "cannot",
+                "won't": "will not", "don't": "do not", "doesn't": "does not", "isn't": "is not",
+                "i'm": "i am", "you're": "you are", "let's": "let us"}
+_CONTRACTION_RE = re.compile(r"\b(" + "|".join(re.escape(c) for c in CONTRACTIONS) + r")\b")
+
+
+def normalize_prompt(prompt):
+    """ Lowercase, expand contractions, drop punctuation and extra whitespace """
+    text = prompt.lower().replace("’", "'")
+    text = _CONTRACTION_RE.sub(lambda m: CONTRACTIONS[m.group(1)], text)
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def get_shingles(text, size=SHINGLE_SIZE):
+    text = f" {text} "
+    return frozenset(text[i:i + size] for i in range(max(1, len(text) - size + 1)))
+
+
+def jaccard(a, b):
+    if not a and not b:
+        return 1.
+    return len(a & b) / len(a | b)
+
+
+class MinHasher:
+    def __init__(self, num_perm=NUM_BANDS * ROWS_PER_BAND, seed=1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.a = [rng.randrange(1, _PRIME) for _ in range(num_perm)]
+        self.b = [rng.randrange(0, _PRIME) for _ in range(num_perm)]
+        if np is not None:
+            # 32 bit hashes and coefficients, so that a * h + b fits into uint64
+            self._a = np.array([a & _MAX_HASH for a in self.a], dtype=np.uint64)
+            self._b = np.array([b & _MAX_HASH for b in self.b], dtype=np.uint64)
+
+    def signature(self, shingles):
+        hashes = [zlib.crc32(s.encode()) for s in shingles]
+        if np is not None:
+            h = np.array(hashes, dtype=np.uint64)[:, None]
+            return tuple(((h * self._a + self._b) % np.uint64(_MAX_HASH)).min(axis=0).tolist())
+        return tuple(min(((a & _MAX_HASH) * h + (b & _MAX_HASH)) % _MAX_HASH for h in hashes)
+                     for a, b in zip(self.a, self.b))
+
+
+class SemanticCache:
+    def __init__(self, threshold=SIMILARITY_THRESHOLD, max_entries=MAX_ENTRIES, ttl=DEFAULT_TTL,
+                 num_bands=NUM_BANDS, rows_per_band=ROWS_PER_BAND):
+        """
+        :param threshold: min Jaccard similarity of the prompt trigrams to serve a cached response
+        :param max_entries: least recently used entries are evicted above that
+        :param ttl: seconds a response stays valid
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.num_bands = num_bands
+        self.rows_per_band = rows_per_band
+        self._hasher = MinHasher(num_bands * rows_per_band)
+        self._entries = OrderedDict()  # entry id -> (context, bands, shingles, response, created)
+        self._buckets = defaultdict(set)  # (context, band number, band) -> entry ids
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get_bands(self, shingles):
+        signature = self._hasher.signature(shingles)
+        rows = self.rows_per_band
+        return [(i, signature[i * rows:(i + 1) * rows]) for i in range(self.num_bands)]
+
+    def get(self, prompt, context=''):
+        """
+        :param context: key of everything else that affects the response - only entries with the same context match
+        :return: cached response of the most similar prompt, None if there's none similar enough
+        """
+        shingles = get_shingles(normalize_prompt(prompt))
+        bands = self._get_bands(shingles)
+        now = time.time()
+        with self._lock:
+            candidates = set()
+            for band in bands:
+                candidates |= self._buckets.get((context, *band), set())
+            best, best_similarity = None, self.threshold
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                if now - entry[4] > self.ttl:
+                    self._remove(entry_id)
+                    continue
+                similarity = jaccard(shingles, entry[2])
+                if similarity >= best_similarity:
+                    best, best_similarity = entry_id, similarity
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best)
+            return self._entries[best][3]
+
+    def set(self, prompt, response, context=''):
+        shingles = get_shingles(normalize_prompt(prompt))
+        bands = self._get_bands(shingles)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (context, bands, shingles, response, time.time())
+            for band in bands:
+                self._buckets[(context, *band)].add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, entry_id):
+        context, bands, _, _, _ = self._entries.pop(entry_id)
+        for band in bands:
+            bucket = self._buckets[(context, *band)]
+            bucket.discard(entry_id)
+            if not bucket:
+                del self._buckets[(context, *band)]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'semantic_hits': self.hits,
+            'semantic_misses': self.misses,
+            'semantic_hit_rate': self.hits / lookups if lookups else 0.,
+            'semantic_entries': len(self._entries),
+        }
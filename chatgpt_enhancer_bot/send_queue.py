@@ -0,0 +1,146 @@
+"""
+Outbound queue for telegram sends, paced against the flood limits
+
+Telegram allows about 30 messages per second overall and about one per second in a chat, bursts above that
+get 429 (RetryAfter). Sends are queued per chat and dispatched in order: each chat waits for its own interval
+and for the global one, a RetryAfter puts the send back at the head of its chat's queue for the time Telegram asks.
+Senders get a Future of the send result instead of blocking.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_MESSAGES_PER_SECOND = 30
+CHAT_MESSAGES_PER_SECOND = 1
+SEND_WORKERS = 8
+MAX_SEND_ATTEMPTS = 5
+
+
+class _ChatQueue:
+    def __init__(self):
+        self.sends = deque()  # (func, args, kwargs, future, attempt)
+        self.next_time = 0.
+        self.busy = False  # a send of the chat is in progress - the next one waits, to keep the order
+
+
+class SendQueue:
+    def __init__(self, global_rate=GLOBAL_MESSAGES_PER_SECOND, chat_rate=CHAT_MESSAGES_PER_SECOND,
+                 workers=SEND_WORKERS):
+        """
+        :param global_rate: max sends per second, all chats together
+        :param chat_rate: max sends per second to one chat
+        :param workers: sends in progress at the same time (to different chats)
+        """
+        self.global_interval = 1. / global_rate
+        self.chat_interval = 1. / chat_rate
+        self._chats = {}  # chat id -> _ChatQueue, chats with sends queued, in progress or sent within the interval
+        self._global_next_time = 0.
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='telegram-send')
+        self._closed = False
+        self.num_sent = 0
+        self.num_retry_after = 0
+        self.max_depth = 0
+        self._thread = threading.Thread(target=self._dispatch, name='telegram-send-queue', daemon=True)
+        self._thread.start()
+
+    def submit(self, chat_id, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs) - a telegram call sending to the chat
+        :return: concurrent.futures.Future of the call result
+        """
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Send queue is closed")
+            chat = self._chats.setdefault(chat_id, _ChatQueue())
+            chat.sends.append((func, args, kwargs, future, 1))
+            self.max_depth = max(self.max_depth, self._get_depth())
+            self._condition.notify_all()
+        return future
+
+    def _dispatch(self):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                for chat_id in [chat_id for chat_id, chat in self._chats.items()
+                                if not chat.sends and not chat.busy and chat.next_time <= now]:
+                    del self._chats[chat_id]  # idle long enough - a new send can go right away
+                ready = [(chat.next_time, chat_id) for chat_id, chat in self._chats.items()
+                         if chat.sends and not chat.busy]
+                if not ready:
+                    if self._closed and not self._get_depth():
+                        return
+                    self._condition.wait(self.chat_interval if self._chats else None)
+                    continue
+                next_time, chat_id = min(ready)
+                wait = max(next_time, self._global_next_time) - time.monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)  # a new send or a finished one may change the choice
+                    continue
+                chat = self._chats[chat_id]
+                item = chat.sends.popleft()
+                chat.busy = True
+                now = time.monotonic()
+                chat.next_time = now + self.chat_interval
+                self._global_next_time = now + self.global_interval
+                self._executor.submit(self._send, chat_id, chat, item)
+
+    def _send(self, chat_id, chat, item):
+        func, args, kwargs, future, attempt = item
+        try:
+            result = func(*args, **kwargs)
+        except RetryAfter as e:
+            with self._condition:
+                self.num_retry_after += 1
+                if attempt < MAX_SEND_ATTEMPTS:
+                    logger.warning(f"Flood limit in chat {chat_id}, retry in {e.retry_after}s")
+                    chat.sends.appendleft((func, args, kwargs, future, attempt + 1))
+                    chat.next_time = time.monotonic() + e.retry_after
+                else:
+                    future.set_exception(e)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            with self._condition:
+                if future.done():
+                    self.num_sent += 1
+                chat.busy = False
+                self._condition.notify_all()
+
+    def _get_depth(self):
+        return sum(len(chat.sends) + chat.busy for chat in self._chats.values())
+
+    def get_depth(self, chat_id=None):
+        """ Sends queued or in progress - for the chat, or for all chats """
+        with self._condition:
+            if chat_id is None:
+                return self._get_depth()
+            chat = self._chats.get(chat_id)
+            return len(chat.sends) + chat.busy if chat is not None else 0
+
+    def stats(self):
+        with self._condition:
+            return {
+                'queued_sends': self._get_depth(),
+                'queued_chats': sum(bool(chat.sends or chat.busy) for chat in self._chats.values()),
+                'max_queued_sends': self.max_depth,
+                'sent': self.num_sent,
+                'retry_after': self.num_retry_after,
+            }
+
+    def close(self):
+        """ Send everything queued and stop """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
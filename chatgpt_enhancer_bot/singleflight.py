@@ -0,0 +1,65 @@
+"""
+Single-flight coalescing of identical in-flight requests
+
+When the same request (same cache key) is already on its way to OpenAI, later callers don't send
+their own copy - they wait for the first one and get its result, or its error.
+"""
+import threading
+from concurrent.futures import Future, CancelledError
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> Future of the call in flight
+        self.num_calls = 0
+        self.num_shared = 0
+
+    def do(self, key, func, *args, timeout=None, **kwargs):
+        """
+        Call func(*args, **kwargs), unless a call with the same key is in flight already - then wait for its result.
+        If the first call was interrupted (not failed), the waiters don't get its exception - one of them makes a new call
+        :param timeout: max seconds to wait for a call of another thread. TimeoutError doesn't affect the call itself
+        :return: result of the call
+        """
+        while True:
+            with self._lock:
+                future = self._calls.get(key)
+                leader = future is None
+                if leader:
+                    future = self._calls[key] = Future()
+                    self.num_calls += 1
+                else:
+                    self.num_shared += 1
+            if leader:
+                return self._call(key, future, func, args, kwargs)
+            try:
+                return future.result(timeout=timeout)
+            except CancelledError:
+                continue
+
+    def _call(self, key, future, func, args, kwargs):
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        except BaseException:
+            future.cancel()  # e.g. KeyboardInterrupt - not an answer to the request, let the waiters retry
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def in_flight(self):
+        return len(self._calls)
+
+    def stats(self):
+        return {
+            'upstream_calls': self.num_calls,
+            'coalesced_calls': self.num_shared,
+            'in_flight': self.in_flight(),
+        }
@@ -0,0 +1,86 @@
+"""
+Token counting and per-topic token budget accounting
+
+Tokens are counted with tiktoken when it's installed, otherwise approximated locally with a GPT-2 style
+pre-tokenizer. Either way, counts are cached per message text.
+"""
+import bisect
+import re
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+TOKEN_COUNT_CACHE_SIZE = 10000
+TURN_OVERHEAD_TOKENS = 8  # "[H]: ", "\n[B]: ", "\n" around each turn in the prompt
+TIKTOKEN_ENCODING = 'p50k_base'  # text-davinci-003 and friends
+
+# same split as GPT-2 byte-level BPE does before merging
+PRE_TOKEN_PATTERN = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_]+| ?\d+| ?[^\s\w]+|\s+(?!\S)|\s+""")
+CHARS_PER_TOKEN = 6  # long words are split into several tokens
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(TIKTOKEN_ENCODING)
+    except Exception:  # no network to download the encoding
+        return None
+
+
+@lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+def count_tokens(text):
+    """
+    Count tokens in text, as the model would see it
+    :param text: str
+    :return: int
+    """
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return sum(1 + (len(piece) - 1) // CHARS_PER_TOKEN for piece in PRE_TOKEN_PATTERN.findall(text))
+
+
+def count_turn_tokens(prompt, response):
+    return count_tokens(prompt) + count_tokens(response) + TURN_OVERHEAD_TOKENS
+
+
+class TokenPrefixSums:
+    """
+    Running token totals of a topic history: prefix[i] - tokens in the first i turns
+    Recording a turn is O(1), finding how many recent turns fit into a budget is O(log n)
+    """
+
+    def __init__(self, history=()):
+        """
+        :param history: List[Tuple(prompt, response, timestamp)]
+        """
+        self.prefix = [0]
+        for prompt, response, *_ in history:
+            self.append(prompt, response)
+
+    def append(self, prompt, response):
+        self.prefix.append(self.prefix[-1] + count_turn_tokens(prompt, response))
+
+    def __len__(self):
+        return len(self.prefix) - 1
+
+    @property
+    def total(self):
+        return self.prefix[-1]
+
+    def depth_for_budget(self, budget):
+        """
+        :param budget: max tokens
+        :return: number of the most recent turns that fit into the budget together
+        """
+        first = bisect.bisect_left(self.prefix, self.total - budget)
+        return len(self) - first
+
+    def tokens_in_last(self, depth):
+        """ :return: tokens in the `depth` most recent turns """
+        return self.total - self.prefix[len(self) - depth]
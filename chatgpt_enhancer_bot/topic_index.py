@@ -0,0 +1,114 @@
+"""
+Fuzzy lookup of topic names, for /switch_topic with a partial or misspelled name
+
+Lowercased names are indexed by character trigrams, so a lookup only scores the topics sharing a trigram
+with the query - not every topic of the user. Candidates are ranked by: exact match, then substring,
+then the best of trigram similarity and edit distance to the name or one of its words
+(names like '2023Jan05-banana-3' - "banan" finds the topic).
+"""
+import heapq
+import re
+from collections import Counter, defaultdict
+
+TRIGRAM_SIZE = 3
+MIN_SCORE = 0.4  # weaker matches are not suggested
+MAX_SUGGESTIONS = 5
+MAX_CANDIDATES = 100  # scored per lookup - the ones sharing the most trigrams with the query
+_WORD_SEPARATORS_RE = re.compile(r'[\s\-_.,:/]+')
+
+
+def get_trigrams(text):
+    text = f" {text} "
+    return {text[i:i + TRIGRAM_SIZE] for i in range(len(text) - TRIGRAM_SIZE + 1)}
+
+
+def edit_distance(a, b, max_distance):
+    """ Levenshtein distance, or max_distance + 1 if it's more than that """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return min(previous[-1], max_distance + 1)
+
+
+class TopicIndex:
+    def __init__(self, topics=()):
+        self._topics = defaultdict(set)  # lowercased name -> names
+        self._postings = defaultdict(set)  # trigram -> lowercased names
+        for topic in topics:
+            self.add(topic)
+
+    def add(self, topic):
+        key = topic.lower()
+        if not self._topics[key]:
+            for trigram in get_trigrams(key):
+                self._postings[trigram].add(key)
+        self._topics[key].add(topic)
+
+    def remove(self, topic):
+        key = topic.lower()
+        names = self._topics.get(key)
+        if not names:
+            return
+        names.discard(topic)
+        if names:
+            return
+        del self._topics[key]
+        for trigram in get_trigrams(key):
+            postings = self._postings[trigram]
+            postings.discard(key)
+            if not postings:
+                del self._postings[trigram]
+
+    def rename(self, topic, new_name):
+        self.remove(topic)
+        self.add(new_name)
+
+    def __len__(self):
+        return sum(len(names) for names in self._topics.values())
+
+    def _get_candidates(self, query, trigrams):
+        if len(query) < TRIGRAM_SIZE:
+            # too short to share a trigram with a typo - substrings only
+            return [(key, 0) for key in self._topics if query in key]
+        counts = Counter()
+        for trigram in trigrams:
+            counts.update(self._postings.get(trigram, ()))
+        return counts.most_common(MAX_CANDIDATES)
+
+    def search(self, query, limit=MAX_SUGGESTIONS):
+        """
+        :return: List[Tuple[topic, score]] best first. Score 1 - exact match, above 0.9 - a substring
+        """
+        query = query.strip()
+        key = query.lower()
+        if not key:
+            return []
+        trigrams = get_trigrams(key)
+        max_distance = max(1, len(key) // 3)
+        # an edit changes at most TRIGRAM_SIZE trigrams - candidates sharing fewer can't be close
+        min_shared = len(trigrams) - TRIGRAM_SIZE * max_distance
+        scored = []
+        for candidate, shared in self._get_candidates(key, trigrams):
+            if candidate == key:
+                score = 1.
+            elif key in candidate:
+                score = 0.9 + 0.09 * len(key) / len(candidate)
+            elif shared < min_shared:
+                continue
+            else:
+                similarity = shared / (len(trigrams) + len(get_trigrams(candidate)) - shared)
+                words = [word for word in _WORD_SEPARATORS_RE.split(candidate) if word] + [candidate]
+                distance = min(edit_distance(key, word, max_distance) for word in words)
+                score = max(similarity, 1 - distance / (len(key) + 1) if distance <= max_distance else 0.)
+                score = min(score, 0.89)  # below substring matches
+            if score >= MIN_SCORE:
+                scored.extend((topic, score) for topic in self._topics[candidate])
+        # the same spelling as the query first among the equal scores
+        return heapq.nsmallest(limit, scored, key=lambda item: (-item[1], item[0] != query, item[0]))
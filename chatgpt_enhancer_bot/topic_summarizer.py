@@ -0,0 +1,112 @@
+"""
+Rolling summarization of long topics, off the request path
+
+Once enough turns piled up beyond the last summary, a background job folds them into the topic summary.
+chat() then sends the summary instead of the turns it covers, plus the most recent turns verbatim.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .token_budget import count_turn_tokens
+
+logger = logging.getLogger(__name__)
+
+SUMMARIZE_EVERY = 10  # turns
+KEEP_RECENT_TURNS = 4  # most recent turns are never summarized - they are sent as is
+SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+# turns folded into the summary by one request - a long topic is summarized chunk by chunk
+SUMMARY_CHUNK_TOKENS = 2500
+# after a failed refresh, retry once that many more turns were recorded or that much time passed
+RETRY_AFTER_TURNS = 10
+RETRY_AFTER_SECONDS = 600
+
+SUMMARY_REQUEST_TEMPLATE = """Summarize the conversation into a few short bullet points.
+Keep facts, names, numbers, decisions and open questions. Skip greetings and chatter.
+{previous_summary}
+Conversation:
+{transcript}
+Bullet points:
+"""
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='topic-summarizer')
+
+
+class TopicSummarizer:
+    """ Schedules summary refreshes of a user's topics and stores the results in the history storage """
+
+    def __init__(self, storage, summarize, render_turn, summarize_every=SUMMARIZE_EVERY,
+                 keep_recent_turns=KEEP_RECENT_TURNS, chunk_tokens=SUMMARY_CHUNK_TOKENS, executor=_executor,
+                 clock=time.monotonic):
+        """
+        :param storage: HistoryStorage of the user
+        :param summarize: function (request) -> summary text, e.g. a cheap completion
+        :param render_turn: function (prompt, response) -> str
+        :param summarize_every: refresh the summary once that many turns are not covered by it
+        :param keep_recent_turns: that many recent turns are left out of the summary
+        :param chunk_tokens: token budget of the turns sent in one summary request
+        """
+        self.storage = storage
+        self.summarize = summarize
+        self.render_turn = render_turn
+        self.summarize_every = summarize_every
+        self.keep_recent_turns = keep_recent_turns
+        self.chunk_tokens = chunk_tokens
+        self.executor = executor
+        self._clock = clock
+        self._in_progress = set()
+        self._retry_after = {}  # topic -> (num_turns, clock time) - the refresh failed, retry after either of them
+        self._lock = threading.Lock()
+
+    def maybe_schedule(self, topic, num_turns):
+        """
+        Start a background refresh of the topic summary if it's due
+        :param num_turns: total turns in the topic
+        :return: Future or None
+        """
+        _, covered = self.storage.get_summary(topic)
+        new_covered = num_turns - self.keep_recent_turns
+        if new_covered - covered < self.summarize_every:
+            return None
+        with self._lock:
+            if topic in self._in_progress:
+                return None
+            retry_after = self._retry_after.get(topic)
+            if retry_after is not None and num_turns < retry_after[0] and self._clock() < retry_after[1]:
+                return None
+            self._in_progress.add(topic)
+        return self.executor.submit(self._refresh, topic, num_turns, new_covered)
+
+    def _refresh(self, topic, num_turns, new_covered):
+        """ Fold the turns up to new_covered into the summary, a chunk of at most chunk_tokens per request """
+        try:
+            summary, covered = self.storage.get_summary(topic)
+            turns = self.storage.get_history_range(topic, covered, new_covered)
+            start = 0
+            while start < len(turns):
+                end = start + 1  # a turn over the budget goes alone
+                tokens = count_turn_tokens(*turns[start][:2])
+                while end < len(turns):
+                    tokens += count_turn_tokens(*turns[end][:2])
+                    if tokens > self.chunk_tokens:
+                        break
+                    end += 1
+                previous_summary = f"Previous summary:\n{summary}\n" if summary else ""
+                request = SUMMARY_REQUEST_TEMPLATE.format(
+                    previous_summary=previous_summary,
+                    transcript=''.join(self.render_turn(prompt, response) for prompt, response, *_ in turns[start:end]))
+                summary = self.summarize(request).strip()
+                self.storage.set_summary(topic, summary, covered + end)
+                start = end
+            with self._lock:
+                self._retry_after.pop(topic, None)
+        except KeyError:
+            logger.info(f"Topic {topic} was renamed while being summarized, will retry later")
+        except Exception:
+            logger.exception(f"Failed to summarize topic {topic}")
+            with self._lock:
+                self._retry_after[topic] = (num_turns + RETRY_AFTER_TURNS, self._clock() + RETRY_AFTER_SECONDS)
+        finally:
+            with self._lock:
+                self._in_progress.discard(topic)
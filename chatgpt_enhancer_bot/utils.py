@@ -1,15 +1,9 @@
 import os
 import random
+import re
+from collections import namedtuple
 
-
-def try_guess_topic_name(name, candidates):
-    matches = [c for c in candidates if name in c]
-    if len(matches) == 1:
-        return matches[0]
-    matches = [c for c in candidates if name.lower() in c.lower()]
-    if len(matches) == 1:
-        return matches[0]
-    return None
+from telegram.utils.helpers import escape_markdown
 
 
 def get_secrets():
@@ -51,50 +45,197 @@ def split_to_code_blocks(text):
     return blocks
 
 
+MAX_MESSAGE_LENGTH = 4096  # telegram limit
+SPLIT_SEPARATORS = ('\n\n', '\n', ' ')  # preferred split points, best first
+_LANGUAGE_TAG_RE = re.compile(r'[\w+#.-]+\n')
+
+# a command response with inline buttons: menu is {button label: command to run}
+MenuResponse = namedtuple('MenuResponse', ['text', 'menu'])
+# a message of a response. plain_text - to send instead if telegram can't parse the markdown
+FormattedMessage = namedtuple('FormattedMessage', ['text', 'is_markdown', 'plain_text'])
+CODE_ESCAPED_CHARS = '\\`'  # escaped inside code blocks in MarkdownV2
+
+
+def escape_code(text):
+    """ Escape the text of a code block for MarkdownV2 """
+    return escape_markdown(text, version=2, entity_type='pre')
+
+
+def _fit_escaped(text, limit):
+    """ :return: length of the longest prefix of the code that is at most `limit` long once escaped """
+    length = 0
+    for i, char in enumerate(text):
+        length += 2 if char in CODE_ESCAPED_CHARS else 1
+        if length > limit:
+            return i
+    return len(text)
+
+
+def _find_split(text, limit):
+    """ :return: length of the first part - ends at a paragraph, line or word boundary when there's one """
+    for separator in SPLIT_SEPARATORS:
+        i = text.rfind(separator, 0, limit)
+        if i > limit // 4:
+            return i + len(separator)
+    return limit
+
+
+def split_block(block, max_length=MAX_MESSAGE_LENGTH):
+    """
+    Split a block from `split_to_code_blocks` into blocks that fit into a message.
+    Each part of a code block keeps the language tag and is rendered with its own fences, so fences stay balanced.
+    Parts of code fit once escaped for markdown. The parts only depend on the text before them
+    :return: list of blocks
+    """
+    text = block['text']
+    language_tag = ''
+    limit = max_length
+    if block['is_code_block']:
+        match = _LANGUAGE_TAG_RE.match(text)
+        if match:
+            language_tag = match.group()
+            text = text[len(language_tag):]
+        limit -= len(language_tag) + 6  # fences
+    parts = []
+    while True:
+        fits = _fit_escaped(text, limit) if block['is_code_block'] else min(len(text), limit)
+        if fits == len(text):
+            break
+        split = _find_split(text, fits)
+        parts.append(text[:split])
+        text = text[split:]
+    parts.append(text)
+    return [{'text': language_tag + part, 'is_code_block': block['is_code_block']} for part in parts if part]
+
+
+def format_message(text, max_length=MAX_MESSAGE_LENGTH):
+    """
+    Split a response into telegram messages: code blocks as markdown, every message under `max_length`
+    :return: List[FormattedMessage]
+    """
+    return merge_blocks(split_to_code_blocks(text), max_length)
+
+
+def merge_blocks(blocks, max_length=MAX_MESSAGE_LENGTH):
+    """
+    Merge adjacent blocks from `split_to_code_blocks` into as few messages as fit into `max_length`,
+    splitting the blocks that are too long by themselves.
+    A message with a code block is sent as markdown - its plain text parts and its code are escaped
+    :return: List[FormattedMessage]
+    """
+    messages = []
+    group = []
+    for block in (part for block in blocks for part in split_block(block, max_length)):
+        if group and len(_render_group(group + [block])[0]) > max_length:
+            messages.append(_render_group(group))
+            group = []
+        group.append(block)
+    if group:
+        messages.append(_render_group(group))
+    return messages
+
+
+def _render_group(blocks):
+    plain_text = ''.join(f"```{block['text']}```" if block['is_code_block'] else block['text'] for block in blocks)
+    if not any(block['is_code_block'] for block in blocks):
+        return FormattedMessage(plain_text, False, plain_text)
+    text = ''.join(f"```{escape_code(block['text'])}```" if block['is_code_block']
+                   else escape_markdown(block['text'], version=2) for block in blocks)
+    return FormattedMessage(text, True, plain_text)
+
+
+class CodeBlockSplitter:
+    """
+    Incremental `split_to_code_blocks` - for text that arrives in chunks, e.g. a streamed completion.
+    Gives the same blocks as split_to_code_blocks of the whole text, but each block is known to be finished
+    as soon as its closing fence arrives
+    """
+
+    def __init__(self):
+        self.blocks = []  # finished blocks
+        self.is_code_block = False
+        self.current = ''
+        self._backticks = ''  # trailing backticks of the last chunk - may be the start of a fence
+
+    def feed(self, text):
+        """
+        :return: list of blocks finished by this chunk
+        """
+        num_finished = len(self.blocks)
+        parts = (self._backticks + text).split("```")
+        for part in parts[:-1]:
+            self.current += part
+            self._finish_block()
+        tail = parts[-1]
+        stripped = tail.rstrip('`')
+        self._backticks = tail[len(stripped):]
+        self.current += stripped
+        return self.blocks[num_finished:]
+
+    def close(self):
+        """
+        End of the text
+        :return: list with the last block, if any
+        """
+        num_finished = len(self.blocks)
+        self.current += self._backticks
+        self._backticks = ''
+        self._finish_block()
+        return self.blocks[num_finished:]
+
+    def get_current_block(self):
+        """ The block in progress, None if it's empty """
+        text = self.current + self._backticks
+        if not text:
+            return None
+        return {"text": text, "is_code_block": self.is_code_block}
+
+    def _finish_block(self):
+        if self.current:
+            self.blocks.append({"text": self.current, "is_code_block": self.is_code_block})
+        self.current = ''
+        self.is_code_block = not self.is_code_block
+
+
+_KEY_RE = re.compile(r'(?:^|\s)([A-Za-z_]\w*)=')
+
+
+class QuerySyntaxError(RuntimeError):
+    """ A message that can't be parsed as a command """
+
+
 def parse_query(query: str):
-    """format: "/command arg text key1=arg1 key2=arg2\n Long text arg" """
+    """
+    Parse a command message in one pass over its first line
+    format: "/command arg text key1=arg1 key2=arg2\n Long text arg"
+    The text before the first key= is one argument, a value runs until the next key=,
+    the lines after the first one are the last argument - as is, '=' is not special there
+    :return: command, args, kwargs
+    :raise QuerySyntaxError:
+    """
+    line, _, text = query.strip().partition('\n')
+    if not line.startswith('/'):
+        raise QuerySyntaxError(f"Commands start with '/': {line!r}")
+    command, _, line = line.partition(' ')
+    if '@' in command:
+        command = command.split('@', 1)[0]  # "/command@bot_name" in group chats
     args = []
     kwargs = {}
-    query = query.strip()
-
-    if '\n' in query:
-        query, text = query.split('\n', 1)
-        if text.strip():
-            args.append(text.strip())
-
-    if query.startswith('/'):
-        if len(query.split()) == 1:
-            return query, args, kwargs
-        command, query = query.split(maxsplit=1)
-    else:
-        raise RuntimeError(f"command not included? {query}")
-
-    if '=' not in query:
-        args = [query] + args
-        return command, args, kwargs
-
-    parts = query.strip().split('=')
-
-    # parse arg
-    part = parts[0].strip()
-    if ' ' in part:
-        arg, key = part.rsplit(maxsplit=1)
-        arg = arg.strip()
-        if arg:
-            args = [arg] + args
-    else:
-        key = part
-
-    # todo: rework all this. What if someone uses commands for code?
-    #  Let's only allow kwargs in the first line of the message
-    # parse kwargs
-    for part in parts[1:-1]:
-        if len(part.split()) > 1:
-            value, next_key = part.rsplit(maxsplit=1)
-            kwargs[key] = value.strip()
-            key = next_key
-        else:
-            raise RuntimeError(f"Invalid query: {query}")
-    kwargs[key] = parts[-1].strip()
 
+    # [arg, key1, value1, key2, value2, ...]
+    parts = _KEY_RE.split(line) if '=' in line else (line,)
+    arg = parts[0].strip()
+    if arg:
+        args.append(arg)
+    for i in range(1, len(parts), 2):
+        key, value = parts[i], parts[i + 1].strip()
+        if not value:
+            raise QuerySyntaxError(f"Missing value for {key}=: {line!r}")
+        if key in kwargs:
+            raise QuerySyntaxError(f"{key}= is given twice: {line!r}")
+        kwargs[key] = value
+
+    text = text.strip()
+    if text:
+        args.append(text)
     return command, args, kwargs
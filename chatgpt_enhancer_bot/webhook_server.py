@@ -0,0 +1,137 @@
+"""
+Webhook ingestion: telegram posts updates to a local HTTP server instead of the bot polling for them
+
+No polling interval latency and no idle request loop, and several bot processes can run behind a load balancer.
+The server checks the secret token telegram sends with every update (set with set_webhook), answers right away
+and queues the update - a bounded queue, when it's full the update is refused with 503 and telegram delivers
+it again later. Worker threads pass the queued updates to `handle_update`.
+"""
+import hmac
+import json
+import logging
+import queue
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+WEBHOOK_HOST = '127.0.0.1'  # behind a reverse proxy doing TLS. '0.0.0.0' to accept connections from anywhere
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/telegram'
+MAX_QUEUED_UPDATES = 1000
+MAX_UPDATE_SIZE = 1 << 20  # bytes
+UPDATE_WORKERS = 2
+
+
+def generate_secret_token():
+    """ Allowed characters for telegram: A-Z, a-z, 0-9, _ and - """
+    return secrets.token_urlsafe(32)
+
+
+class _UpdateRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'ChatGPTEnhancerBot'
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        if self.path != webhook.path:
+            return self._respond(404)
+        token = self.headers.get(SECRET_TOKEN_HEADER, '')
+        if webhook.secret_token is not None and not hmac.compare_digest(token, webhook.secret_token):
+            webhook.num_rejected += 1
+            return self._respond(403)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_UPDATE_SIZE:
+            return self._respond(413)
+        try:
+            update = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self._respond(400)
+        self._respond(200 if webhook.put(update) else 503)
+
+    def _respond(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class WebhookServer:
+    def __init__(self, handle_update, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH, secret_token=None,
+                 max_queued=MAX_QUEUED_UPDATES, workers=UPDATE_WORKERS):
+        """
+        :param handle_update: called with every update, a dict decoded from the json telegram sent
+        :param port: 0 - any free port, see `address`
+        :param secret_token: the token given to set_webhook - requests without it are refused. None - no check
+        :param max_queued: updates waiting for a worker, more are refused until the queue drains
+        :param workers: threads calling handle_update
+        """
+        self._handle_update = handle_update
+        self.path = path
+        self.secret_token = secret_token
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._server = ThreadingHTTPServer((host, port), _UpdateRequestHandler)
+        self._server.daemon_threads = True
+        self._server.webhook = self
+        self._threads = [threading.Thread(target=self._server.serve_forever, name='webhook-server', daemon=True)]
+        self._threads += [threading.Thread(target=self._work, name=f'webhook-worker-{i}', daemon=True)
+                          for i in range(workers)]
+        self.num_received = 0
+        self.num_refused = 0
+        self.num_rejected = 0
+        self.max_depth = 0
+
+    @property
+    def address(self):
+        """ (host, port) the server listens on """
+        return self._server.server_address[:2]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, update):
+        """ :return: False if the queue is full """
+        try:
+            self._queue.put_nowait(update)
+        except queue.Full:
+            self.num_refused += 1
+            logger.warning("Webhook update queue is full, update refused")
+            return False
+        self.num_received += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    def _work(self):
+        while True:
+            update = self._queue.get()
+            try:
+                if update is None:
+                    return
+                self._handle_update(update)
+            except Exception:
+                logger.exception("Failed to handle a webhook update")
+            finally:
+                self._queue.task_done()
+
+    def stats(self):
+        return {
+            'webhook_updates': self.num_received,
+            'webhook_queued': self._queue.qsize(),
+            'webhook_max_queued': self.max_depth,
+            'webhook_refused': self.num_refused,
+            'webhook_rejected': self.num_rejected,
+        }
+
+    def stop(self):
+        """ Stop receiving, handle the updates already queued """
+        self._server.shutdown()
+        self._server.server_close()
+        workers = self._threads[1:]
+        for _ in workers:
+            self._queue.put(None)
+        for thread in workers:
+            thread.join()
@@ -0,0 +1,98 @@
+"""
+Command parsing and dispatch: the single pass parse_query and the dispatch table vs the previous versions
+Run from the repo root: python -m dev.benchmarks.command_dispatch_benchmark
+"""
+import timeit
+
+from chatgpt_enhancer_bot.openai_chatbot import telegram_commands_registry
+from chatgpt_enhancer_bot.utils import parse_query
+from tests.test_parse_query import PARSE_QUERY_CASES
+
+NUMBER = 20000
+REPEAT = 5  # the best of - the rest is noise of the machine
+
+
+def legacy_parse_query(query: str):
+    """ parse_query before the single pass tokenizer """
+    args = []
+    kwargs = {}
+    query = query.strip()
+
+    if '\n' in query:
+        query, text = query.split('\n', 1)
+        if text.strip():
+            args.append(text.strip())
+
+    if query.startswith('/'):
+        if len(query.split()) == 1:
+            return query, args, kwargs
+        command, query = query.split(maxsplit=1)
+    else:
+        raise RuntimeError(f"command not included? {query}")
+
+    if '=' not in query:
+        args = [query] + args
+        return command, args, kwargs
+
+    parts = query.strip().split('=')
+
+    # parse arg
+    part = parts[0].strip()
+    if ' ' in part:
+        arg, key = part.rsplit(maxsplit=1)
+        arg = arg.strip()
+        if arg:
+            args = [arg] + args
+    else:
+        key = part
+
+    # todo: rework all this. What if someone uses commands for code?
+    #  Let's only allow kwargs in the first line of the message
+    # parse kwargs
+    for part in parts[1:-1]:
+        if len(part.split()) > 1:
+            value, next_key = part.rsplit(maxsplit=1)
+            kwargs[key] = value.strip()
+            key = next_key
+        else:
+            raise RuntimeError(f"Invalid query: {query}")
+    kwargs[key] = parts[-1].strip()
+
+    return command, args, kwargs
+
+
+class Bot:
+    def set_max_tokens(self, max_tokens):
+        return int(max_tokens)
+
+
+def legacy_dispatch(bot, prompt):
+    command, qargs, qkwargs = legacy_parse_query(prompt)
+    method = bot.__getattribute__(telegram_commands_registry.get_function(command))
+    return method(*qargs, **qkwargs)
+
+
+def dispatch(bot, prompt):
+    name, qargs, qkwargs = parse_query(prompt)
+    command = telegram_commands_registry.get_command(name)
+    args, kwargs = command.bind(qargs, qkwargs)
+    return Bot.set_max_tokens(bot, *args, **kwargs)  # command.func would change the real bot config
+
+
+def main():
+    queries = [query for query, _ in PARSE_QUERY_CASES]
+    for query, expected in PARSE_QUERY_CASES:
+        assert parse_query(query) == legacy_parse_query(query) == expected, query
+    for name, func in [('legacy parse_query', legacy_parse_query), ('parse_query', parse_query)]:
+        seconds = min(timeit.repeat(lambda: [func(query) for query in queries], number=NUMBER, repeat=REPEAT))
+        print(f"{name}: {seconds / NUMBER / len(queries) * 1e6:.2f} us per query")
+
+    bot = Bot()
+    prompt = "/set_max_tokens 256"
+    for name, func in [('legacy dispatch', legacy_dispatch), ('dispatch table', dispatch)]:
+        seconds = min(timeit.repeat(lambda: func(bot, prompt), number=NUMBER, repeat=REPEAT))
+        print(f"{name}: {seconds / NUMBER * 1e6:.2f} us per command")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+/search latency on a 100k message history: words, phrases and a topic filter. Also the size of the index snapshot
+and the time to load it
+Run from the repo root: python -m dev.benchmarks.search_benchmark
+"""
+import itertools
+import os
+import random
+import tempfile
+import time
+
+from chatgpt_enhancer_bot.history_storage import HistoryStorage
+from chatgpt_enhancer_bot.search_index import SearchIndex
+
+NUM_MESSAGES = 100000
+NUM_TOPICS = 500
+VOCABULARY_SIZE = 20000
+NUM_QUERIES = 200
+
+
+def make_messages(rng):
+    # zipf-like word frequencies, as in natural text
+    vocabulary = [f"w{i}" for i in range(VOCABULARY_SIZE)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(VOCABULARY_SIZE)))
+
+    def text(length):
+        return ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=length))
+
+    return [(f"topic-{rng.randrange(NUM_TOPICS)}", text(rng.randint(5, 30)), text(rng.randint(20, 200)), str(i))
+            for i in range(NUM_MESSAGES)], vocabulary
+
+
+class MemoryHistory(HistoryStorage):
+    """ The history in a dict - the index is measured, not the disk """
+
+    def __init__(self, messages):
+        self.topics = {}
+        for topic, prompt, response, timestamp in messages:
+            self.topics.setdefault(topic, []).append((prompt, response, timestamp))
+
+    def list_topics(self, limit=None):
+        return list(self.topics)
+
+    def count_messages(self, topic):
+        return len(self.topics[topic])
+
+    def get_history_range(self, topic, start, end):
+        return self.topics[topic][start:end]
+
+
+def measure(index, queries, **kwargs):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query, **kwargs)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000
+
+
+def main():
+    rng = random.Random(0)
+    messages, vocabulary = make_messages(rng)
+    history = MemoryHistory(messages)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'search.json')
+        start = time.perf_counter()
+        len(SearchIndex(history, path))
+        print(f"indexed {NUM_MESSAGES} messages in {time.perf_counter() - start:.1f}s, "
+              f"snapshot {os.path.getsize(path) / 2 ** 20:.1f}MB")
+        start = time.perf_counter()
+        index = SearchIndex(history, path)
+        len(index)
+        print(f"loaded in {time.perf_counter() - start:.1f}s")
+
+    # words from the common head and the rare tail, as people search for both
+    words = [' '.join(rng.choice(vocabulary[:2000]) for _ in range(rng.randint(1, 3))) for _ in range(NUM_QUERIES)]
+    common = [' '.join(rng.choice(vocabulary[:20]) for _ in range(2)) for _ in range(NUM_QUERIES)]
+    phrases = []
+    for _ in range(NUM_QUERIES):
+        tokens = rng.choice(messages)[2].split()
+        i = rng.randrange(len(tokens) - 1)
+        phrases.append(f'"{tokens[i]} {tokens[i + 1]}"')
+
+    for name, queries, kwargs in [('words', words, {}), ('common words', common, {}), ('phrases', phrases, {}),
+                                  ('words in a topic', words, {'topic': 'topic-1'})]:
+        # the first search for a common word builds its impact list, later ones reuse it
+        for run in ('first', 'again'):
+            p50, p99 = measure(index, queries, **kwargs)
+            print(f"{name} ({run}): p50 {p50:.2f}ms, p99 {p99:.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
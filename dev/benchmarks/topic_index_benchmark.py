@@ -0,0 +1,34 @@
+"""
+Fuzzy /switch_topic lookup in a user with 3000 topics - a misspelled word of a name
+Run from the repo root: python -m dev.benchmarks.topic_index_benchmark
+"""
+import random
+import timeit
+
+from chatgpt_enhancer_bot.topic_index import TopicIndex
+
+NUM_TOPICS = 3000
+NUM_WORDS = 300
+NUM_QUERIES = 20
+NUMBER = 20
+REPEAT = 5  # the best of - the rest is noise of the machine
+
+
+def make_topics(rng):
+    """ :return: Tuple(topic names like '2023Jan05-banana-3', the words of the names) """
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(4, 9)))
+             for _ in range(NUM_WORDS)]
+    return [f"2023Jan{i % 28:02d}-{rng.choice(words)}-{i}" for i in range(NUM_TOPICS)], words
+
+
+def main():
+    rng = random.Random(0)
+    topics, words = make_topics(rng)
+    index = TopicIndex(topics)
+    queries = [word[:-1] + 'x' for word in rng.sample(words, NUM_QUERIES)]
+    seconds = min(timeit.repeat(lambda: [index.search(query) for query in queries], number=NUMBER, repeat=REPEAT))
+    print(f"{NUM_TOPICS} topics: {seconds / NUMBER / len(queries) * 1e3:.3f} ms per lookup")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,5 @@
+from chatgpt_enhancer_bot.cli import make_argument_parser, get_main_kwargs
 from chatgpt_enhancer_bot.main import main
 
 if __name__ == '__main__':
-    import argparse
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--expensive", action="store_true",
-                        help="use expensive calculation - 'text-davinci-003' model instead of 'text-ada:001' ")
-    args = parser.parse_args()
-
-    main(expensive=args.expensive)
\ No newline at end of file
+    main(**get_main_kwargs(make_argument_parser().parse_args()))
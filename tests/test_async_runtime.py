@@ -0,0 +1,84 @@
+import threading
+import time
+
+from chatgpt_enhancer_bot.async_runtime import AsyncRuntime
+from chatgpt_enhancer_bot.rate_limiter import OpenAIScheduler
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_chat_slots_bound_concurrency():
+    runtime = AsyncRuntime(max_concurrent_chats=2, local_workers=2)
+    running = []
+    max_running = []
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def slow_chat():
+        with lock:
+            running.append(1)
+            max_running.append(len(running))
+        release.wait(5)
+        with lock:
+            running.pop()
+        return 'answer'
+
+    futures = [runtime.submit(runtime.run_chat(slow_chat)) for _ in range(6)]
+    wait_until(lambda: runtime.stats()['in_flight_chats'] == 2 and runtime.stats()['waiting_chats'] == 4)
+
+    # local work is not stuck behind the chats - they are all still running or waiting
+    assert runtime.submit(runtime.run_blocking(lambda: 'topics')).result(timeout=5) == 'topics'
+    assert not any(f.done() for f in futures)
+
+    release.set()
+    assert [f.result(timeout=5) for f in futures] == ['answer'] * 6
+    assert max(max_running) == 2
+    runtime.stop()
+
+
+def test_stop_waits_for_handlers():
+    runtime = AsyncRuntime(max_concurrent_chats=1, local_workers=1)
+    done = []
+
+    async def handler():
+        await runtime.run_chat(time.sleep, 0.05)
+        done.append(True)
+
+    runtime.submit(handler())
+    runtime.stop()
+    assert done == [True]
+
+
+def hold_turn(scheduler, user, entered, release):
+    with scheduler.user_turn(user):
+        entered.set()
+        release.wait(5)
+
+
+def test_waiting_turn_holds_no_chat_slot():
+    runtime = AsyncRuntime(max_concurrent_chats=1, local_workers=1)
+    scheduler = OpenAIScheduler()
+
+    def chat(user):
+        with scheduler.user_turn(user):  # a serialized ChatBot method - in the turn taken by the handler already
+            return user
+
+    # an earlier message of alice is still being answered
+    entered, release = threading.Event(), threading.Event()
+    thread = threading.Thread(target=hold_turn, args=(scheduler, 'alice', entered, release))
+    thread.start()
+    entered.wait()
+    alice = runtime.submit(runtime.run_chat(chat, 'alice', user_turn=scheduler.user_turn_async('alice')))
+    wait_until(lambda: scheduler.get_user_queue_depth('alice') == 2)  # waits for its turn
+    bob = runtime.submit(runtime.run_chat(chat, 'bob', user_turn=scheduler.user_turn_async('bob')))
+    assert bob.result(timeout=1) == 'bob'  # the only slot is not taken by alice's waiting message
+    assert not alice.done()
+    release.set()
+    assert alice.result(timeout=1) == 'alice'
+    thread.join()
+    runtime.stop()
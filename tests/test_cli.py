@@ -0,0 +1,24 @@
+import ast
+import os
+
+from chatgpt_enhancer_bot.cli import make_argument_parser, get_main_kwargs
+from chatgpt_enhancer_bot.context_selection import DEFAULT_CONTEXT_STRATEGY
+
+
+def get_main_parameters():
+    # main.py reads secrets.txt on import - the signature of main() is read from the source
+    path = os.path.join(os.path.dirname(__file__), '..', 'chatgpt_enhancer_bot', 'main.py')
+    tree = ast.parse(open(path).read())
+    main = next(node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name == 'main')
+    return {arg.arg for arg in main.args.args}
+
+
+def test_argument_parser():
+    parser = make_argument_parser()
+    kwargs = get_main_kwargs(parser.parse_args([]))
+    assert kwargs['context_strategy'] == DEFAULT_CONTEXT_STRATEGY and kwargs['streaming']
+    assert set(kwargs) <= get_main_parameters()
+
+    args = parser.parse_args(['--context-strategy', 'relevance', '--no-streaming', '--mode', 'webhook'])
+    kwargs = get_main_kwargs(args)
+    assert (kwargs['context_strategy'], kwargs['streaming'], kwargs['mode']) == ('relevance', False, 'webhook')
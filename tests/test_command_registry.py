@@ -0,0 +1,62 @@
+import pytest
+
+from chatgpt_enhancer_bot.command_registry import CommandRegistry
+
+registry = CommandRegistry()
+
+
+class Bot:
+    @registry.register(['/set_limit', '/sl'], group='configs')
+    def set_limit(self, limit: int, strict: bool = False, scale=1.):
+        """ Set the limit """
+        return limit, strict, scale
+
+
+def test_dispatch_table():
+    command = registry.dispatch_table['/sl']
+    assert command is registry.dispatch_table['/set_limit']
+    assert command.group == 'configs' and command.description == 'Set the limit'
+    with pytest.raises(TypeError):
+        registry.dispatch_table['/other'] = command  # read only
+
+    args, kwargs = command.bind(['10'], {'strict': 'yes', 'scale': '0.5'})
+    assert command.func(Bot(), *args, **kwargs) == (10, True, 0.5)
+
+
+@pytest.mark.parametrize("args,kwargs,error", [
+    ([], {}, "Missing limit"),
+    (['ten'], {}, "Invalid limit: 'ten' is not int"),
+    (['1'], {'strict': 'maybe'}, "Invalid strict"),
+    (['1'], {'other': '2'}, "Unexpected argument other"),
+])
+def test_bind_errors(args, kwargs, error):
+    with pytest.raises(RuntimeError, match=error) as e:
+        registry.dispatch_table['/set_limit'].bind(args, kwargs)
+    assert 'Usage: /set_limit limit [strict=False] [scale=1.0]' in str(e.value)
+
+
+def test_one_command_per_function():
+    registry = CommandRegistry()
+
+    class Bot:
+        @registry.register(['/new_topic', '/nt'], group='topics')
+        def new_topic(self):
+            """ Start a new topic """
+
+        @registry.register(group='basic')
+        def start(self):
+            """ Start the bot """
+
+    assert registry.list_commands() == ('/start', '/new_topic', '/nt')  # by group
+    assert registry.get_help_text() == "Available commands:\n/start: Start the bot\n/new_topic, /nt: Start a new topic\n"
+    assert [c.command for c in registry.get_bot_commands()] == ['start', 'new_topic', 'nt']
+    assert registry.list_group('topics') == (registry.dispatch_table['/nt'],)
+    assert registry.find_by_prefix('/n') == ['/new_topic', '/nt']
+
+    # derived data is rebuilt after a change
+    registry.update({'/new': 'new_topic'})
+    assert registry.find_by_prefix('/n') == ['/new', '/new_topic', '/nt']
+    assert "/new_topic, /nt, /new: Start a new topic" in registry.get_help_text()
+    registry.add_command('help', ['/help'], "Show help", 'basic')
+    assert registry.list_commands()[:2] == ('/start', '/help')
+    assert len(registry.get_bot_commands()) == 5
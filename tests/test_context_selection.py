@@ -0,0 +1,48 @@
+import pytest
+
+from chatgpt_enhancer_bot.context_selection import select_relevant_turns, make_relevance_query
+from chatgpt_enhancer_bot.openai_chatbot import ChatBot
+from chatgpt_enhancer_bot.search_index import SearchHit
+from chatgpt_enhancer_bot.token_budget import count_turn_tokens
+
+
+def test_select_relevant_turns():
+    hits = [SearchHit('a', 'p2', 'r2', 't2', 9.), SearchHit('a', 'p1', 'r1 ' * 50, 't1', 8.),
+            SearchHit('a', 'p0', 'r0', 't0', 5.), SearchHit('a', 'p3', 'r3', 't3', 2.)]
+    budget = count_turn_tokens('p2', 'r2') + count_turn_tokens('p0', 'r0')
+    selected, used = select_relevant_turns(hits, budget)
+    # p1 doesn't fit, p3 is too weak a match next to the best one - the chosen ones go in the order they happened
+    assert [hit.prompt for hit in selected] == ['p0', 'p2'] and used == budget
+    selected, _ = select_relevant_turns(hits, budget, exclude={('a', 'p2', 'r2', 't2')})
+    assert [hit.prompt for hit in selected] == ['p0']
+    assert select_relevant_turns([SearchHit('a', 'p', 'r', 't', 0.5)], budget) == ([], 0)
+
+
+def test_make_relevance_query():
+    assert make_relevance_query('How do I "sort" a list? Sort it!') == 'how do i sort a list it'
+
+
+def test_relevance_strategy(tmp_path):
+    bot = ChatBot(conversations_history_path=str(tmp_path / 'history.json'), summarize_every=None,
+                  history_word_limit=100)
+    bot._record_history('my postgres password is in vault under db/prod', 'noted')
+    for i in range(30):
+        bot._record_history(f'chatter {i}', f'small talk {i}')
+    prompt = 'where is the postgres password?'
+
+    context, _ = bot._make_chat_prompt(prompt)
+    assert 'vault' not in context and 'chatter 29' in context  # the latest turns only
+
+    with pytest.raises(ValueError):
+        bot.set_context_strategy('random')
+    bot.set_context_strategy('relevance')
+    relevant_context, _ = bot._make_chat_prompt(prompt)
+    assert 'vault' in relevant_context
+    assert 'chatter 29' in relevant_context and 'chatter 28' in relevant_context and 'chatter 27' not in relevant_context
+    assert len(relevant_context) < len(context)
+
+    # other topics only when asked to
+    bot.add_new_topic('Infra')
+    assert 'vault' not in bot._make_chat_prompt(prompt)[0]
+    bot.set_context_strategy('relevance', all_topics=True)
+    assert 'vault' in bot._make_chat_prompt(prompt)[0]
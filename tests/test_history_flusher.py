@@ -0,0 +1,55 @@
+import pytest
+
+from chatgpt_enhancer_bot.history_flusher import HistoryFlusher
+from chatgpt_enhancer_bot.history_storage import JsonHistoryStorage, SQLiteHistoryStorage
+
+
+class RecordingTarget:
+    def __init__(self):
+        self.batches = []
+
+    def write_batch(self, items, fsync=False):
+        self.batches.append(items)
+
+
+def test_group_commit():
+    flusher = HistoryFlusher(flush_interval=10)
+    targets = [RecordingTarget(), RecordingTarget()]
+    for i in range(10):
+        flusher.submit(targets[i % 2], i)
+    flusher.flush()
+    assert targets[0].batches == [[0, 2, 4, 6, 8]]
+    assert targets[1].batches == [[1, 3, 5, 7, 9]]
+    flusher.close()
+
+
+def test_close_drains_the_queue():
+    flusher = HistoryFlusher(flush_interval=10, max_batch=3)
+    target = RecordingTarget()
+    for i in range(10):
+        flusher.submit(target, i)
+    flusher.close()
+    assert sum(target.batches, []) == list(range(10))
+    with pytest.raises(RuntimeError):
+        flusher.submit(target, 11)
+
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite'])
+def test_write_behind_storage(tmp_path, backend):
+    flusher = HistoryFlusher(flush_interval=10)
+
+    def make_storage():
+        if backend == 'json':
+            return JsonHistoryStorage(str(tmp_path / 'history.json'), flusher=flusher, compact_every=7)
+        return SQLiteHistoryStorage(str(tmp_path / 'history.sqlite3'), user='user', flusher=flusher)
+
+    storage = make_storage()
+    storage.add_topic('a')
+    for i in range(20):
+        storage.record('a', f'p{i}', 'r', f't{i:02}')
+    # changes are visible before they are written
+    assert [p for p, r, t in storage.get_history('a', 3)] == ['p17', 'p18', 'p19']
+    assert len(storage.get_history('a')) == 20
+    flusher.close()
+
+    assert len(make_storage().get_history('a')) == 20
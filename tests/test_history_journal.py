@@ -0,0 +1,66 @@
+import json
+
+from chatgpt_enhancer_bot.history_journal import HistoryJournal, OP_MESSAGE, OP_NEW_TOPIC, OP_RENAME
+
+
+def test_replay(tmp_path):
+    path = str(tmp_path / 'history.json')
+    journal = HistoryJournal(path)
+    history = journal.load(default={'General': []})
+    journal.append(OP_MESSAGE, topic='General', prompt='hi', response='hello', timestamp='t1')
+    journal.append(OP_NEW_TOPIC, topic='cats')
+    journal.append(OP_MESSAGE, topic='cats', prompt='meow', response='purr', timestamp='t2')
+    journal.append(OP_RENAME, topic='cats', new_name='kittens')
+    journal.close()
+
+    history = HistoryJournal(path).load(default={'General': []})
+    assert history == {'General': [('hi', 'hello', 't1')], 'kittens': [('meow', 'purr', 't2')]}
+
+
+def test_torn_last_record_is_dropped(tmp_path):
+    path = str(tmp_path / 'history.json')
+    journal = HistoryJournal(path)
+    journal.load(default={'General': []})
+    journal.append(OP_MESSAGE, topic='General', prompt='hi', response='hello', timestamp='t1')
+    journal.close()
+    with open(journal.journal_path, 'a') as f:
+        f.write('{"op": "message", "seq": 2, "topic": "Gen')
+
+    journal = HistoryJournal(path)
+    history = journal.load(default={'General': []})
+    assert history == {'General': [('hi', 'hello', 't1')]}
+    # the journal is usable after recovery
+    journal.append(OP_MESSAGE, topic='General', prompt='again', response='yes', timestamp='t2')
+    journal.close()
+    assert len(HistoryJournal(path).load()['General']) == 2
+
+
+def test_compaction(tmp_path):
+    path = str(tmp_path / 'history.json')
+    journal = HistoryJournal(path, compact_every=2)
+    history = journal.load(default={'General': []})
+    for i in range(2):
+        history['General'].append((f'p{i}', f'r{i}', f't{i}'))
+        journal.append(OP_MESSAGE, topic='General', prompt=f'p{i}', response=f'r{i}', timestamp=f't{i}')
+    assert journal.needs_compaction
+    journal.compact(history)
+    assert not journal.needs_compaction
+    assert open(journal.journal_path).read() == ''
+
+    # a crash before the journal was truncated doesn't replay records twice
+    journal.append(OP_MESSAGE, topic='General', prompt='p2', response='r2', timestamp='t2')
+    journal.close()
+    with open(journal.journal_path) as f:
+        extra = f.read()
+    with open(journal.journal_path, 'w') as f:
+        f.write(json.dumps(dict(op=OP_MESSAGE, seq=1, topic='General', prompt='p0', response='r0', timestamp='t0')))
+        f.write('\n' + extra)
+    history = HistoryJournal(path).load()
+    assert [p for p, r, t in history['General']] == ['p0', 'p1', 'p2']
+
+
+def test_legacy_snapshot(tmp_path):
+    path = tmp_path / 'history.json'
+    path.write_text(json.dumps({'General': [['hi', 'hello', 't1']]}))
+    history = HistoryJournal(str(path)).load()
+    assert history == {'General': [['hi', 'hello', 't1']]}
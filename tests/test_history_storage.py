@@ -0,0 +1,133 @@
+import json
+
+import pytest
+
+from chatgpt_enhancer_bot.history_storage import JsonHistoryStorage, SQLiteHistoryStorage, INDEX_SNAPSHOT_VERSION
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def make_storage(request, tmp_path):
+    def factory(user='user'):
+        if request.param == 'json':
+            return JsonHistoryStorage(str(tmp_path / f'history_{user}.json'))
+        return SQLiteHistoryStorage(str(tmp_path / 'history.sqlite3'), user=user)
+
+    return factory
+
+
+def test_topics(make_storage):
+    storage = make_storage()
+    assert storage.list_topics() == []
+    for topic in ['a', 'b', 'c']:
+        storage.add_topic(topic)
+    assert 'b' in storage
+    assert storage.list_topics() == ['a', 'b', 'c']
+    assert storage.list_topics(2) == ['b', 'c']
+
+    storage.rename_topic('a', 'd')
+    assert 'a' not in storage
+    assert storage.list_topics() == ['b', 'c', 'd']
+
+
+def test_history(make_storage):
+    storage = make_storage()
+    storage.add_topic('a')
+    for i in range(5):
+        storage.record('a', f'p{i}', f'r{i}', f'2023-01-0{i + 1}')
+    assert storage.get_history('a', 2) == [('p3', 'r3', '2023-01-04'), ('p4', 'r4', '2023-01-05')]
+    assert len(storage.get_history('a')) == 5
+    storage.rename_topic('a', 'b')
+    assert len(storage.get_history('b', 0)) == 5
+    with pytest.raises(KeyError):
+        storage.get_history('a')
+
+
+def test_persistence_and_isolation(make_storage):
+    storage = make_storage('alice')
+    storage.add_topic('a')
+    storage.record('a', 'p', 'r', 't')
+    storage.close()
+
+    assert make_storage('alice').get_history('a') == [('p', 'r', 't')]
+    assert make_storage('bob').list_topics() == []
+
+
+def test_json_topics_are_loaded_lazily(tmp_path):
+    path = str(tmp_path / 'history.json')
+    storage = JsonHistoryStorage(path, max_loaded_topics=2, compact_every=10)
+    for topic in ['a', 'b', 'c']:
+        storage.add_topic(topic)
+        for i in range(5):
+            storage.record(topic, f'{topic}{i}', 'r', f't{i}')
+    storage.close()
+
+    storage = JsonHistoryStorage(path, max_loaded_topics=2)
+    assert not storage._loaded
+    assert storage.get_topic_info('a') == {'count': 5, 'last_activity': 't4'}
+    assert [p for p, r, t in storage.get_history('a')] == [f'a{i}' for i in range(5)]
+    storage.get_history('b')
+    storage.get_history('c')
+    assert list(storage._loaded) == ['b', 'c']
+
+    storage.rename_topic('a', 'd')
+    storage.record('d', 'd5', 'r', 't5')
+    storage.compact()
+    storage.close()
+    storage = JsonHistoryStorage(path)
+    assert storage.list_topics() == ['b', 'c', 'd']
+    assert len(storage.get_history('d')) == 6
+
+
+def test_json_crash_during_compaction(tmp_path, monkeypatch):
+    path = str(tmp_path / 'history.json')
+    storage = JsonHistoryStorage(path)
+    storage.add_topic('a')
+    storage.record('a', 'p0', 'r', 't0')
+    storage.compact()
+    storage.record('a', 'p1', 'r', 't1')
+    storage.record('a', 'p2', 'r', 't2')
+
+    def crash(*args, **kwargs):
+        raise OSError("crash before the snapshot is written")
+
+    # the topic file gets p1 and p2, the snapshot and the journal stay as they were
+    monkeypatch.setattr(storage._journal, 'finish_compaction', crash)
+    with pytest.raises(OSError):
+        storage.compact()
+
+    storage = JsonHistoryStorage(path)
+    assert [p for p, r, t in storage.get_history('a')] == ['p0', 'p1', 'p2']
+    storage.record('a', 'p3', 'r', 't3')
+    storage.compact()
+    storage.close()
+    assert [p for p, r, t in JsonHistoryStorage(path).get_history('a')] == ['p0', 'p1', 'p2', 'p3']
+
+
+def test_json_legacy_snapshot_migration(tmp_path):
+    path = tmp_path / 'history.json'
+    path.write_text(json.dumps({'General': [['hi', 'hello', 't1']]}))
+    storage = JsonHistoryStorage(str(path))
+    assert storage.get_history('General') == [('hi', 'hello', 't1')]
+    assert json.loads(path.read_text())['version'] == INDEX_SNAPSHOT_VERSION
+    assert JsonHistoryStorage(str(path)).get_history('General') == [('hi', 'hello', 't1')]
+
+
+def test_summary(make_storage):
+    storage = make_storage()
+    storage.add_topic('a')
+    assert storage.get_summary('a') == ('', 0)
+    storage.set_summary('a', 'short', 3)
+    storage.rename_topic('a', 'b')
+    storage.close()
+    assert make_storage().get_summary('b') == ('short', 3)
+
+
+def test_history_range(make_storage):
+    storage = make_storage()
+    storage.add_topic('a')
+    for i in range(10):
+        storage.record('a', f'q{i}', f'a{i}', f'2023-01-01 00:00:{i:02}')
+    assert storage.count_messages('a') == 10
+    assert [m[0] for m in storage.get_history_range('a', 3, 6)] == ['q3', 'q4', 'q5']
+    assert [m[0] for m in storage.get_history_range('a', 8, 20)] == ['q8', 'q9']
+    assert storage.get_history_range('a', 0, 10) == storage.get_history('a')
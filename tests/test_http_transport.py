@@ -0,0 +1,43 @@
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from chatgpt_enhancer_bot.http_transport import PooledSession
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_GET(self):
+        body = b'ok'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+
+
+def test_connections_are_reused(server_url):
+    session = PooledSession(pool_size=2)
+    for _ in range(5):
+        assert session.get(server_url, timeout=600).text == 'ok'
+    session.close()  # what openai does to its sessions - the pool is kept
+    assert session.get(server_url).text == 'ok'
+
+    stats = session.stats()
+    assert stats['http_requests'] == 6
+    assert stats['http_connections_opened'] == 1
+    assert stats['http_idle_connections'] == 1
+    session.shutdown()
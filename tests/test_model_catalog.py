@@ -0,0 +1,63 @@
+import threading
+import types
+
+import pytest
+
+from chatgpt_enhancer_bot.model_catalog import ModelCatalog
+
+
+def make_models(*ids):
+    return [types.SimpleNamespace(id=model_id, owned_by='openai') for model_id in ids]
+
+
+def test_seeded_catalog_refreshes_in_background(tmp_path):
+    seed_path = tmp_path / 'models_list.txt'
+    seed_path.write_text('text-ada-001\ntext-davinci-003\n')
+    calls = []
+    slow_network = threading.Event()
+
+    def list_models():
+        calls.append(1)
+        slow_network.wait()
+        return make_models('text-davinci-003', 'gpt-new')
+
+    catalog = ModelCatalog(list_models, seed_path=str(seed_path))
+    assert catalog.get_ids() == ['text-ada-001', 'text-davinci-003']  # answered from the seed right away
+    slow_network.set()
+    catalog.wait_for_refresh()
+    assert 'gpt-new' in catalog
+    assert 'text-ada-001' not in catalog
+    assert catalog.get('gpt-new').owned_by == 'openai'
+    assert len(calls) == 1  # fresh data - no more calls
+
+
+def test_model_info_of_seeded_model_is_fetched(tmp_path):
+    seed_path = tmp_path / 'models_list.txt'
+    seed_path.write_text('text-davinci-003\n')
+    calls = []
+
+    def list_models():
+        calls.append(1)
+        return make_models('text-davinci-003')
+
+    catalog = ModelCatalog(list_models, seed_path=str(seed_path))
+    assert catalog.get('text-davinci-003').id == 'text-davinci-003'
+    for _ in range(3):
+        with pytest.raises(KeyError):
+            catalog.get('unknown')
+    assert len(calls) == 1  # unknown models are not looked up until the data expires
+
+    catalog._expires = 0.
+    with pytest.raises(KeyError):
+        catalog.get('unknown')
+    assert len(calls) == 2
+
+
+def test_failed_refresh_keeps_data():
+    def list_models():
+        raise ConnectionError()
+
+    catalog = ModelCatalog(list_models, ttl=0)
+    assert 'text-davinci-003' in catalog  # bundled models_list.txt
+    catalog.wait_for_refresh()
+    assert 'text-davinci-003' in catalog
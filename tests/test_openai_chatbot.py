@@ -1,6 +1,11 @@
+import threading
+import types
+
 import pytest
 
+from chatgpt_enhancer_bot import openai_chatbot
 from chatgpt_enhancer_bot.openai_chatbot import ChatBot
+from chatgpt_enhancer_bot.rate_limiter import OpenAIScheduler
 
 
 @pytest.fixture
@@ -20,3 +25,140 @@ def test_help(chatbot_fixture):
     res = bot.help('/help')
     expected_result = ChatBot.help.__doc__
     assert expected_result == res
+
+
+def test_chat_stream(tmp_path, monkeypatch):
+    events = ["[", "B]: Hel", "lo ```co", "de```"]
+    completion = types.SimpleNamespace(create=lambda **kwargs: ({'choices': [{'text': e}]} for e in events))
+    monkeypatch.setattr(openai_chatbot, 'openai_wrapper', types.SimpleNamespace(
+        api=types.SimpleNamespace(Completion=completion)))
+    bot = ChatBot(conversations_history_path=str(tmp_path / 'history.json'))
+
+    chunks = list(bot.chat_stream('hi'))
+
+    assert ''.join(chunks) == "Hello ```code```"
+    assert chunks[0] == "Hel"  # the bot token is not shown
+    assert bot.get_history(limit=1)[-1][:2] == ('hi', "Hello ```code```")
+
+
+def test_chat_stream_keeps_spaces_and_releases_turn(tmp_path, monkeypatch):
+    events = ["[B]: Hello ", "world", "!"]
+    completion = types.SimpleNamespace(create=lambda **kwargs: ({'choices': [{'text': e}]} for e in events))
+    monkeypatch.setattr(openai_chatbot, 'openai_wrapper', types.SimpleNamespace(
+        api=types.SimpleNamespace(Completion=completion)))
+    scheduler = OpenAIScheduler()
+    bot = ChatBot(conversations_history_path=str(tmp_path / 'history.json'), user='a', scheduler=scheduler)
+
+    assert ''.join(bot.chat_stream('hi')) == "Hello world!"
+
+    # the consumer fails after the first chunk - closing the stream ends the turn of the user
+    stream = bot.chat_stream('hi again')
+    next(stream)
+    assert scheduler.get_user_queue_depth('a') == 1
+    stream.close()
+    assert scheduler.get_user_queue_depth('a') == 0
+
+
+class QueryConfig(types.SimpleNamespace):
+    def update(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def test_chat_stream_sends_the_query_config(tmp_path, monkeypatch):
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        return iter([{'choices': [{'text': '[B]: 42', 'index': 0}]}, {'choices': [{'text': 'other', 'index': 1}]}])
+
+    monkeypatch.setattr(openai_chatbot, 'openai_wrapper', types.SimpleNamespace(
+        api=types.SimpleNamespace(Completion=types.SimpleNamespace(create=create))))
+    config = QueryConfig(model='text-davinci-003', temperature=0.5, max_tokens=256, top_p=1., n=2,
+                         presence_penalty=0.6, frequency_penalty=0.3, stop=['[H]:'], user=None)
+    bot = ChatBot(conversations_history_path=str(tmp_path / 'history.json'), query_config=config)
+
+    # command kwargs come as strings and override the config
+    assert ''.join(bot.chat_stream('hi', temperature='0.7', top_p='0.9')) == '42'  # the first completion only
+    kwargs = calls[0]
+    kwargs.pop('prompt')
+    assert kwargs == {'stream': True, 'model': 'text-davinci-003', 'temperature': 0.7, 'max_tokens': 256,
+                      'top_p': 0.9, 'n': 2, 'presence_penalty': 0.6, 'frequency_penalty': 0.3, 'stop': ['[H]:']}
+
+
+class OverlapWrapper:
+    """ Naming waits for the answer to be asked, the answer for the naming - only done at the same time they finish """
+    TIMEOUT = 5  # seconds - a deadlock if the requests are made one after the other
+
+    def __init__(self):
+        self.naming_started = threading.Event()
+        self.answer_started = threading.Event()
+        self.release_naming = threading.Event()  # naming returns only after it
+        self.overlapped = []
+
+    def query_cheap(self, prompt, config=None, **kwargs):
+        self.naming_started.set()
+        self.overlapped.append(self.answer_started.wait(self.TIMEOUT))
+        self.release_naming.wait(self.TIMEOUT)
+        return " Physics\n"
+
+    def query(self, prompt, config=None, **kwargs):
+        self.answer_started.set()
+        self.overlapped.append(self.naming_started.wait(self.TIMEOUT))
+        return "[B]: 42"
+
+
+def test_question_names_topic_in_parallel(tmp_path, monkeypatch):
+    wrapper = OverlapWrapper()
+    wrapper.release_naming.set()
+    monkeypatch.setattr(openai_chatbot, 'openai_wrapper', wrapper)
+    bot = ChatBot(conversations_history_path=str(tmp_path / 'history.json'))
+
+    res = bot.question('What is the answer to the great question?')
+
+    assert wrapper.overlapped == [True, True]  # each request started before the other one finished
+    assert res == "Active topic: Physics\n42"
+    assert bot.get_history('Physics')[0][:2] == ('What is the answer to the great question?', '42')
+
+
+def test_question_naming_timeout(tmp_path, monkeypatch):
+    wrapper = OverlapWrapper()
+    monkeypatch.setattr(openai_chatbot, 'openai_wrapper', wrapper)
+    monkeypatch.setattr(openai_chatbot, 'TOPIC_NAMING_TIMEOUT', 0.01)
+    bot = ChatBot(conversations_history_path=str(tmp_path / 'history.json'))
+
+    try:
+        res = bot.question('What is the question to the great answer?')
+    finally:
+        wrapper.release_naming.set()  # the name comes only after the question is answered
+
+    topic = bot.list_topics(1)[0]
+    assert res == f"Active topic: {topic}\n42"
+    assert topic != 'Physics'
+    assert len(bot.get_history(topic)) == 1
+
+
+def test_history_pages(tmp_path):
+    bot = ChatBot(conversations_history_path=str(tmp_path / 'history.json'))
+    for i in range(25):
+        bot._history.record('General', f'q{i}', 'answer ' * i, f'2023-01-01 00:00:{i:02d}')
+
+    page = bot.get_history_command(limit=10)
+    assert page.text.startswith('General, messages 16-25 of 25')
+    assert '[Human]: q24' in page.text and '[Human]: q14' not in page.text
+    assert list(page.menu) == ['⬅ Older']
+    assert all(len(data.encode()) <= 64 for data in page.menu.values())
+
+    older = bot.get_history_page_command(page.menu['⬅ Older'].split()[1])
+    assert older.text.startswith('General, messages 6-15 of 25')
+    assert set(older.menu) == {'⬅ Older', 'Newer ➡'}
+    newer = bot.get_history_page_command(older.menu['Newer ➡'].split()[1])
+    assert newer.text == page.text
+
+    # long messages - fewer of them on a page, nothing is skipped
+    bot._history.record('General', 'huge', 'x' * 10000, '2023-01-01 00:01:00')
+    page = bot.get_history_command(limit=10)
+    assert len(page.text) <= 4096
+    assert page.text.startswith('General, messages 26-26 of 26')
+    older = bot.get_history_page_command(page.menu['⬅ Older'].split()[1])
+    assert older.text.startswith('General, messages ') and '-25 of 26' in older.text.splitlines()[0]
+    assert len(older.text) <= 4096
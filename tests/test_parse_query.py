@@ -1,9 +1,8 @@
 import pytest
 
-from chatgpt_enhancer_bot.utils import parse_query
+from chatgpt_enhancer_bot.utils import parse_query, QuerySyntaxError
 
-
-@pytest.mark.parametrize("query,expected", [
+PARSE_QUERY_CASES = [
     ("/command", ("/command", [], {})),
     ("/command a", ("/command", ["a"], {})),
     ("/command\na", ("/command", ["a"], {})),
@@ -13,7 +12,25 @@ from chatgpt_enhancer_bot.utils import parse_query
     ("/command\na k3==d", ("/command", ["a k3==d"], {})),
     ("/command test\na k3==d", ("/command", ["test", "a k3==d"], {})),
     ("/command test k1=x k2=y\na k3==d", ("/command", ["test", "a k3==d"], {"k1": "x", "k2": "y"})),
-])
+]
+
+
+@pytest.mark.parametrize("query,expected", PARSE_QUERY_CASES)
 def test_parse_query(query, expected):
     res = parse_query(query)
     assert res == expected
+
+
+@pytest.mark.parametrize("query,expected", [
+    ("/command@my_bot a", ("/command", ["a"], {})),
+    ("/command a b k1=two words", ("/command", ["a b"], {"k1": "two words"})),
+    ("/question is 2+2=4", ("/question", ["is 2+2=4"], {})),
+])
+def test_parse_query_values(query, expected):
+    assert parse_query(query) == expected
+
+
+@pytest.mark.parametrize("query", ["command a", "/command k1= k2=b", "/command k1=a k1=b"])
+def test_parse_query_errors(query):
+    with pytest.raises(QuerySyntaxError):
+        parse_query(query)
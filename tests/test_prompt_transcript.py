@@ -0,0 +1,39 @@
+from chatgpt_enhancer_bot.prompt_transcript import TopicTranscript
+from chatgpt_enhancer_bot.token_budget import TokenPrefixSums
+
+
+def render_turn(prompt, response):
+    return f"[H]: {prompt}\n[B]: {response}\n"
+
+
+def naive_render(history, budget):
+    depth = TokenPrefixSums(history).depth_for_budget(budget)
+    return ''.join(render_turn(p, r) for p, r, t in history[len(history) - depth:])
+
+
+def test_transcript_matches_naive_rendering():
+    history = []
+    transcript = TopicTranscript(render_turn)
+    loads = []
+
+    def load_history(limit):
+        loads.append(limit)
+        return history[-limit:]
+
+    for i in range(30):
+        # turns of varying length - the window grows and shrinks
+        turn = (f"prompt {i} " + "word " * (i % 7), f"response {i}", "")
+        history.append(turn)
+        transcript.append(*turn[:2])
+        for budget in [0, 40, 150]:
+            text, depth = transcript.render(budget, load_history)
+            assert text == naive_render(history, budget)
+    assert len(transcript.segments) < len(history)
+
+
+def test_transcript_from_existing_history():
+    history = [(f"prompt {i}", f"response {i}", "") for i in range(10)]
+    transcript = TopicTranscript(render_turn, history)
+    text, depth = transcript.render(10 ** 6, lambda limit: history[-limit:])
+    assert depth == 10
+    assert text == naive_render(history, 10 ** 6)
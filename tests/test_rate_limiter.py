@@ -0,0 +1,140 @@
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from chatgpt_enhancer_bot.rate_limiter import TokenBucket, OpenAIScheduler
+
+
+def test_token_bucket_debt():
+    bucket = TokenBucket(60, capacity=2)  # 1 per second
+    now = bucket.updated
+    assert bucket.reserve(1, now) == 0
+    assert bucket.reserve(1, now) == 0
+    assert bucket.reserve(1, now) == 1
+    assert bucket.reserve(1, now) == 2  # waits for the earlier reservation too
+    assert bucket.reserve(1, now + 10) == 0  # refilled, capped by capacity
+
+
+def test_acquire_waits_for_tokens_per_minute():
+    now = [100.]
+    sleeps = []
+    scheduler = OpenAIScheduler(requests_per_minute=6000, tokens_per_minute=60000, clock=lambda: now[0],
+                                sleep=sleeps.append)
+    assert scheduler.acquire(60000) == 0
+    assert scheduler.acquire(100) == pytest.approx(0.1)  # 1000 tokens per second
+    now[0] += 1.
+    assert scheduler.acquire(100) == 0  # the debt is paid off
+    assert sleeps == [pytest.approx(0.1)]
+    assert scheduler.stats()['requests'] == 3
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_user_turns_are_fifo_and_reentrant():
+    scheduler = OpenAIScheduler()
+    order = []
+
+    def turn(i):
+        with scheduler.user_turn('alice'):
+            with scheduler.user_turn('alice'):  # nested command, e.g. chat -> add_new_topic
+                order.append(i)
+
+    # an earlier turn of alice keeps the others waiting, they take their tickets one after another
+    entered, release = threading.Event(), threading.Event()
+    holder = threading.Thread(target=hold_turn, args=(scheduler, 'alice', entered, release))
+    holder.start()
+    entered.wait()
+    threads = []
+    for i in range(5):
+        threads.append(threading.Thread(target=turn, args=(i,)))
+        threads[-1].start()
+        wait_until(lambda: scheduler.get_user_queue_depth('alice') == i + 2)
+    assert order == []
+    release.set()
+    for thread in threads + [holder]:
+        thread.join()
+
+    assert order == list(range(5))
+    assert scheduler.get_user_queue_depth('alice') == 0
+    assert scheduler.stats()['user_turns'] == 6
+
+
+def test_users_do_not_wait_for_each_other():
+    scheduler = OpenAIScheduler()
+    with scheduler.user_turn('alice'):
+        done = []
+        thread = threading.Thread(target=lambda: done.append(scheduler.user_turn('bob').__enter__()))
+        thread.start()
+        thread.join(timeout=1)
+        assert len(done) == 1
+
+
+def test_reused_thread_waits_for_its_turn():
+    # a pooled thread runs another turn of the user while an earlier one is still open (a suspended stream)
+    scheduler = OpenAIScheduler()
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def stream():
+        with scheduler.user_turn('alice'):
+            yield 'chunk'
+
+    first = stream()
+    assert executor.submit(contextvars.copy_context().run, next, first).result() == 'chunk'
+
+    def second():
+        with scheduler.user_turn('alice'):
+            return 'second'
+
+    future = executor.submit(contextvars.copy_context().run, second)
+    time.sleep(0.05)
+    assert not future.done()  # not a nested turn - the same thread, but not the same context
+    first.close()
+    assert future.result(timeout=1) == 'second'
+    assert scheduler.get_user_queue_depth('alice') == 0
+    executor.shutdown()
+
+
+def hold_turn(scheduler, user, entered, release):
+    with scheduler.user_turn(user):
+        entered.set()
+        release.wait(5)
+
+
+def test_async_turns():
+    scheduler = OpenAIScheduler()
+    loop = asyncio.new_event_loop()
+    order = []
+
+    async def turn(i, delay=0.):
+        async with scheduler.user_turn_async('alice'):
+            with scheduler.user_turn('alice'):  # nested, in the same context
+                order.append(i)
+            await asyncio.sleep(delay)
+
+    async def run():
+        tasks = [asyncio.ensure_future(turn(i)) for i in range(3)]
+        await asyncio.sleep(0.01)
+        assert order == [] and scheduler.get_user_queue_depth('alice') == 4
+        tasks[1].cancel()  # cancelled while waiting - skipped
+        release.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # an earlier turn of alice, in another thread
+    entered, release = threading.Event(), threading.Event()
+    thread = threading.Thread(target=hold_turn, args=(scheduler, 'alice', entered, release))
+    thread.start()
+    entered.wait()
+    loop.run_until_complete(run())
+    thread.join()
+    loop.close()
+    assert order == [0, 2]
+    assert scheduler.get_user_queue_depth('alice') == 0
@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+
+from chatgpt_enhancer_bot.resilience import (ResilientCaller, CircuitOpenError, is_transient, get_retry_after,
+                                             BACKOFF_CAP)
+
+
+class RateLimitError(Exception):
+    def __init__(self, retry_after=None):
+        super().__init__('rate limited')
+        self.headers = {'Retry-After': retry_after} if retry_after is not None else {}
+
+
+class InvalidRequestError(Exception):
+    pass
+
+
+def make_flaky(errors, result='answer'):
+    calls = []
+
+    def func():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    return func, calls
+
+
+def test_error_classification():
+    assert is_transient(RateLimitError())
+    assert is_transient(TimeoutError())
+    assert not is_transient(InvalidRequestError())
+    assert get_retry_after(RateLimitError('2')) == 2.
+    assert get_retry_after(RateLimitError()) is None
+    assert get_retry_after(RateLimitError('86400')) == BACKOFF_CAP
+
+
+def test_retries_transient_errors():
+    sleeps = []
+    caller = ResilientCaller(max_retries=3, sleep=sleeps.append)
+    func, calls = make_flaky([RateLimitError('1.5'), RateLimitError()])
+
+    assert caller.call('model', func) == 'answer'
+    assert len(calls) == 3
+    assert sleeps[0] == 1.5  # Retry-After is respected
+    assert 0 <= sleeps[1] <= 2  # jittered backoff
+    assert caller.stats()['retries'] == 2
+    assert caller.stats()['error_rate'] == 0
+
+
+def test_does_not_retry_other_errors():
+    caller = ResilientCaller(max_retries=3, sleep=lambda delay: None)
+    func, calls = make_flaky([InvalidRequestError()])
+    with pytest.raises(InvalidRequestError):
+        caller.call('model', func)
+    assert len(calls) == 1
+
+
+def test_circuit_breaker_per_model():
+    caller = ResilientCaller(max_retries=0, failure_threshold=2, reset_timeout=0.05, sleep=lambda delay: None)
+    func, calls = make_flaky([RateLimitError(), RateLimitError()])
+    for _ in range(2):
+        with pytest.raises(RateLimitError):
+            caller.call('davinci', func)
+    with pytest.raises(CircuitOpenError):
+        caller.call('davinci', func)
+    assert len(calls) == 2
+    assert caller.stats()['open_circuits'] == 'davinci'
+    assert caller.call('ada', func) == 'answer'  # other models are not affected
+
+    time.sleep(0.05)
+    assert caller.call('davinci', func) == 'answer'  # trial request closes the circuit
+    assert caller.stats()['open_circuits'] == ''
+
+
+def test_hedged_request():
+    caller = ResilientCaller(hedge=True)
+    for _ in range(20):
+        caller.call('model', lambda: 'fast')
+    release = threading.Event()
+    calls = []
+
+    def sometimes_slow():
+        calls.append(1)
+        if len(calls) == 1:
+            release.wait(5)  # the original request hangs until the hedge has answered
+            return 'original'
+        return 'hedge'
+
+    try:
+        assert caller.call('model', sometimes_slow) == 'hedge'
+    finally:
+        release.set()
+    assert len(calls) == 2
+    assert caller.stats()['hedged_requests'] == 1
+    assert caller.stats()['hedge_wins'] == 1
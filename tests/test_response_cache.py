@@ -0,0 +1,56 @@
+import types
+
+import pytest
+
+from chatgpt_enhancer_bot.response_cache import ResponseCache, make_cache_key, is_deterministic
+
+
+@pytest.fixture
+def config():
+    return types.SimpleNamespace(model='text-davinci-003', temperature=0, max_tokens=100)
+
+
+def test_cache_key(config):
+    key = make_cache_key('query', 'what is X?', config, {})
+    assert key == make_cache_key('query', '  what is X?  \n', config, {})
+    assert key != make_cache_key('query_cheap', 'what is X?', config, {})
+    assert key != make_cache_key('query', 'what is X?', config, {'max_tokens': 10})
+    assert key != make_cache_key('edit', 'what is X?', config, {'instruction': 'fix'})
+
+
+def test_is_deterministic(config):
+    assert is_deterministic(config, {})
+    assert not is_deterministic(config, {'temperature': '0.5'})
+    config.temperature = 0.7
+    assert not is_deterministic(config, {})
+    assert is_deterministic(config, {'temperature': '0'})
+
+
+def test_memory_lru():
+    cache = ResponseCache(memory_size=2)
+    cache.set('a', '1')
+    cache.set('b', '2')
+    assert cache.get('a') == '1'
+    cache.set('c', '3')  # evicts 'b' - least recently used
+    assert cache.get('b') is None
+    assert cache.get('c') == '3'
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 1
+
+
+def test_disk_store_and_ttl(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    cache = ResponseCache(path)
+    cache.set('a', '1')
+    assert ResponseCache(path).get('a') == '1'
+    assert ResponseCache(path, ttl=-1).get('a') is None
+    assert len(ResponseCache(path)) == 0
+
+
+def test_disk_size_eviction(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite3'), memory_size=1, max_entries=10)
+    for i in range(100):
+        cache.set(str(i), str(i))
+    assert len(cache) == 10
+    assert cache.get('99') == '99'
+    assert cache.get('0') is None
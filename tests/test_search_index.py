@@ -0,0 +1,201 @@
+import json
+import math
+import random
+
+from chatgpt_enhancer_bot import search_index
+from chatgpt_enhancer_bot.history_flusher import HistoryFlusher
+from chatgpt_enhancer_bot.history_journal import HistoryJournal
+from chatgpt_enhancer_bot.history_storage import JsonHistoryStorage
+from chatgpt_enhancer_bot.openai_chatbot import ChatBot
+from chatgpt_enhancer_bot.search_index import (SearchIndex, parse_search_query, make_snippet, tokenize, compile_phrase,
+                                               contains_phrase, encode_posting, decode_posting)
+
+MESSAGES = [
+    ('Coding', 'how to sort a list in python', 'use sorted(list) or list.sort()', '2023-01-01T00:00:00'),
+    ('Coding', 'python error handling', 'wrap it in try / except, handling errors explicitly', '2023-01-01T00:01:00'),
+    ('Cooking', 'how to sort lentils', 'pick out the stones by hand', '2023-01-01T00:02:00'),
+    ('Cooking', 'best pasta sauce', 'tomato, garlic and basil. Handling the garlic: do not burn it', '2023-01-01T00:03:00'),
+]
+
+
+def record(history, index, topic, prompt, response, timestamp):
+    if topic not in history:
+        history.add_topic(topic)
+    history.record(topic, prompt, response, timestamp)
+    index.add(topic, history.count_messages(topic) - 1, prompt, response)
+
+
+def make_index(tmp_path, path=None):
+    history = JsonHistoryStorage(str(tmp_path / 'history.json'))
+    index = SearchIndex(history, path)
+    for message in MESSAGES:
+        record(history, index, *message)
+    return history, index
+
+
+def test_parse_search_query():
+    assert parse_search_query('python "error handling" Sort') == (['python', 'error', 'handling', 'sort'],
+                                                                  [['error', 'handling']])
+
+
+def test_bm25_ranking(tmp_path):
+    _, index = make_index(tmp_path)
+    hits = index.search('python sort')
+    assert hits[0].prompt == 'how to sort a list in python'  # both words
+    assert {hit.prompt for hit in hits[1:]} == {'python error handling', 'how to sort lentils'}
+    assert hits[0].topic == 'Coding' and hits[0].score > hits[1].score
+    assert index.search('nonexistent') == []
+
+
+def test_phrase_and_topic_filter(tmp_path):
+    _, index = make_index(tmp_path)
+    assert [hit.prompt for hit in index.search('"error handling"')] == ['python error handling']
+    assert [hit.prompt for hit in index.search('"handling error"')] == []
+    assert [hit.prompt for hit in index.search('"garlic do"')] == ['best pasta sauce']  # words, not characters
+    assert [hit.prompt for hit in index.search('sort', topic='Cooking')] == ['how to sort lentils']
+    assert index.search('sort', topic='Gardening') == []
+
+
+def brute_force_scores(messages, terms):
+    docs = [tokenize(prompt) + tokenize(response) for _, prompt, response, _ in messages]
+    avg_length = sum(map(len, docs)) / len(docs)
+    scores = []
+    for tokens in docs:
+        score = 0.
+        for term in terms:
+            df = sum(term in doc for doc in docs)
+            tf = tokens.count(term)
+            if tf:
+                idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+                norm = search_index.K1 * (1 - search_index.B + search_index.B * len(tokens) / avg_length)
+                score += idf * tf * (search_index.K1 + 1) / (tf + norm)
+        scores.append(score)
+    return scores
+
+
+def test_impact_lists_exact(tmp_path, monkeypatch):
+    # common terms are read through impact lists - the results are the same as scoring every message
+    monkeypatch.setattr(search_index, 'IMPACT_LIST_MIN_DOCS', 20)
+    monkeypatch.setattr(search_index, 'IMPACT_LIST_STEP', 4)
+    rng = random.Random(0)
+    words = [f'w{i}' for i in range(30)]
+    messages = [('General', ' '.join(rng.choices(words, k=rng.randint(1, 5))),
+                 ' '.join(rng.choices(words, k=rng.randint(1, 30))), str(i)) for i in range(300)]
+    history = JsonHistoryStorage(str(tmp_path / 'history.json'))
+    history.add_topic('General')
+    for message in messages[:200]:
+        history.record(*message)
+    index = SearchIndex(history)
+    index.search('w0')  # indexes the history, builds a list - the next messages are added after it
+    for message in messages[200:]:
+        record(history, index, *message)
+    for query in ['w0', 'w1 w2', 'w3 w4 w5']:
+        scores = brute_force_scores(messages, query.split())
+        hits = index.search(query, limit=5)
+        assert [round(hit.score, 9) for hit in hits] == sorted((round(score, 9) for score in scores),
+                                                               reverse=True)[:5]
+
+
+def test_persisted(tmp_path):
+    path = str(tmp_path / 'search.json')
+    history, index = make_index(tmp_path, path)
+    assert len(index) == len(MESSAGES)
+    history.rename_topic('Cooking', 'Food')
+    index.rename_topic('Cooking', 'Food')
+
+    loaded = SearchIndex(history, path)
+    assert len(loaded) == len(MESSAGES)
+    assert [hit.topic for hit in loaded.search('lentils')] == ['Food']
+    assert loaded.search('lentils', topic='Cooking') == []
+
+    # the snapshot has the postings, the text is only in the history
+    index._compact()
+    with open(path) as f:
+        snapshot = f.read()
+    assert 'lentils' in json.loads(snapshot)['topics']['postings'] and 'pick out the stones' not in snapshot
+    loaded = SearchIndex(history, path)
+    assert [hit.response for hit in loaded.search('"sort lentils"')] == ['pick out the stones by hand']
+
+
+def test_catches_up_with_history(tmp_path):
+    path = str(tmp_path / 'search.json')
+    history, index = make_index(tmp_path, path)
+    history.record('Coding', 'what is a monad', 'a monoid in the category of endofunctors', 't')
+
+    # the index missed a message, and is loaded on first use
+    loaded = SearchIndex(history, path)
+    loaded.add('Coding', 2, 'what is a monad', 'a monoid in the category of endofunctors')
+    assert not loaded._loaded  # recording a message doesn't load the index
+    assert [hit.prompt for hit in loaded.search('monad')] == ['what is a monad']
+    assert len(loaded) == len(MESSAGES) + 1
+    loaded.add('Coding', 2, 'what is a monad', 'a monoid in the category of endofunctors')  # indexed already
+    assert len(loaded) == len(MESSAGES) + 1
+
+    # an index of the older format, with the text of the messages, is built again
+    HistoryJournal(path).compact([list(message) for message in MESSAGES])
+    assert len(SearchIndex(history, path)) == len(MESSAGES) + 1
+
+
+def test_rename_before_load(tmp_path):
+    path = str(tmp_path / 'search.json')
+    history, index = make_index(tmp_path, path)
+    assert len(index) == len(MESSAGES)
+    index.close()
+
+    loaded = SearchIndex(history, path)
+    history.rename_topic('Cooking', 'Food')
+    loaded.rename_topic('Cooking', 'Food')
+    assert not loaded._loaded
+    assert [hit.topic for hit in loaded.search('lentils')] == ['Food']
+    assert len(loaded) == len(MESSAGES)  # not indexed again under the new name
+    assert [hit.topic for hit in SearchIndex(history, path).search('lentils')] == ['Food']
+
+
+def test_write_behind(tmp_path):
+    path = str(tmp_path / 'search.json')
+    flusher = HistoryFlusher(flush_interval=10)
+    history = JsonHistoryStorage(str(tmp_path / 'history.json'), flusher=flusher)
+    index = SearchIndex(history, path, flusher=flusher)
+    for message in MESSAGES:
+        record(history, index, *message)
+    assert len(index) == len(MESSAGES)
+    index._compact()
+    record(history, index, 'Coding', 'how to sort a dict', 'sorted(d.items())', 't')
+    index.flush()
+
+    loaded = SearchIndex(history, path)
+    assert {hit.prompt for hit in loaded.search('sort', topic='Coding')} == {'how to sort a dict',
+                                                                             'how to sort a list in python'}
+    flusher.close()
+
+
+def test_encode_posting():
+    posting = {0: 2, 3: 1, 7: 3, 9: 1}
+    assert encode_posting(posting, 9) == ([0, 3, 4], [0, 2, 7, 3])
+    assert decode_posting(*encode_posting(posting, 10)) == posting
+
+
+def test_contains_phrase():
+    pattern = compile_phrase(['a', 'b'])
+    assert contains_phrase(pattern, 'x a, b y')
+    assert not contains_phrase(pattern, 'xa b') and not contains_phrase(pattern, 'a bc')
+    assert contains_phrase(compile_phrase(['a', 'a']), 'ba a a')  # after a false match
+
+
+def test_make_snippet():
+    text = 'a' * 1000 + ' python ' + 'b' * 1000
+    snippet = make_snippet(text, 'python', length=100)
+    assert 'python' in snippet and len(snippet) <= 102
+
+
+def test_search_command(tmp_path):
+    bot = ChatBot(conversations_history_path=str(tmp_path / 'history.json'))
+    bot._history.record('General', 'what is a monad', 'a monoid in the category of endofunctors', '2023-01-01')
+    # a new bot indexes the history it finds
+    bot = ChatBot(conversations_history_path=str(tmp_path / 'history.json'))
+    assert 'endofunctors' in bot.search_command('monad')
+
+    bot._record_history('what is a functor', 'a mapping between categories')
+    bot.rename_topic('Category theory')
+    assert bot.search_command('functor', topic='Category theory').startswith('Category theory (')
+    assert bot.search_command('burrito') == 'Nothing found for burrito'
@@ -0,0 +1,45 @@
+import pytest
+
+from chatgpt_enhancer_bot import semantic_cache
+from chatgpt_enhancer_bot.semantic_cache import SemanticCache, MinHasher, normalize_prompt, get_shingles
+
+
+def test_normalize_prompt():
+    assert normalize_prompt("What's   X?") == normalize_prompt("what is x") == "what is x"
+
+
+def test_near_duplicates_hit():
+    cache = SemanticCache(threshold=0.8)
+    cache.set('What is a monad in Haskell?', 'A monad is...')
+    assert cache.get("what's a monad in haskell") == 'A monad is...'
+    assert cache.get('What is a monoid in Haskell?') is None
+    assert cache.get('What is a functor in Scala?') is None
+    assert cache.stats()['semantic_hits'] == 1
+    assert cache.stats()['semantic_hit_rate'] == pytest.approx(1 / 3)
+
+
+def test_context_must_match():
+    cache = SemanticCache()
+    cache.set('what is it?', 'a cat', context='history about cats')
+    assert cache.get('what is it?', context='history about dogs') is None
+    assert cache.get('What is it', context='history about cats') == 'a cat'
+
+
+def test_eviction_and_ttl():
+    cache = SemanticCache(max_entries=2)
+    for animal in ['cat', 'dog', 'horse']:
+        cache.set(f'tell me about the {animal}', animal)
+    assert len(cache) == 2
+    assert cache.get('tell me about the cat') is None
+    assert cache.get('tell me about the horse') == 'horse'
+
+    cache.ttl = -1
+    assert cache.get('tell me about the horse') is None
+    assert len(cache) < 2  # expired candidates are dropped
+
+
+def test_signature_without_numpy(monkeypatch):
+    shingles = get_shingles('what is a monad')
+    with_numpy = MinHasher().signature(shingles)
+    monkeypatch.setattr(semantic_cache, 'np', None)
+    assert MinHasher().signature(shingles) == with_numpy
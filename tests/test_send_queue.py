@@ -0,0 +1,76 @@
+import threading
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+from chatgpt_enhancer_bot.send_queue import SendQueue
+from chatgpt_enhancer_bot.utils import merge_blocks, split_to_code_blocks
+
+
+def test_per_chat_pacing_and_order():
+    queue = SendQueue(global_rate=1000, chat_rate=20)  # 50ms between sends to a chat
+    sent = []
+    lock = threading.Lock()
+
+    def send(chat_id, text):
+        with lock:
+            sent.append((chat_id, text, time.monotonic()))
+        return text
+
+    futures = [queue.submit(chat_id, send, chat_id, i) for i in range(3) for chat_id in ('a', 'b')]
+    assert [f.result(timeout=5) for f in futures] == [0, 0, 1, 1, 2, 2]
+
+    for chat_id in ('a', 'b'):
+        times = [t for c, _, t in sent if c == chat_id]
+        assert [text for c, text, _ in sent if c == chat_id] == [0, 1, 2]
+        assert all(later - earlier >= 0.045 for earlier, later in zip(times, times[1:]))
+    queue.close()
+    assert queue.stats()['sent'] == 6
+
+
+def test_chats_do_not_wait_for_each_other():
+    queue = SendQueue(global_rate=1000, chat_rate=20)
+    release = threading.Event()
+    stuck = queue.submit('a', release.wait, 5)
+    queued = queue.submit('a', lambda: 'a')
+    # the send to a is in progress, the next one of a waits for it - b is sent meanwhile
+    assert queue.submit('b', lambda: 'b').result(timeout=5) == 'b'
+    assert not stuck.done() and not queued.done()
+    release.set()
+    assert queued.result(timeout=5) == 'a'
+    queue.close()
+
+
+def test_retry_after_is_honored():
+    queue = SendQueue(global_rate=1000, chat_rate=1000)
+    attempts = []
+
+    def flaky_send():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise RetryAfter(0.05)
+        return 'sent'
+
+    assert queue.submit('a', flaky_send).result(timeout=1) == 'sent'
+    assert attempts[1] - attempts[0] >= 0.05
+    assert queue.stats()['retry_after'] == 1
+    queue.close()
+
+
+def test_errors_reach_the_future():
+    queue = SendQueue()
+    with pytest.raises(ValueError):
+        queue.submit('a', int, 'not a number').result(timeout=1)
+    queue.close()
+
+
+def test_merge_blocks():
+    blocks = split_to_code_blocks("Here is the code: ```print(1)``` that's it.")
+    assert merge_blocks(blocks) == [("Here is the code: ```print(1)``` that's it\\.", True,
+                                     "Here is the code: ```print(1)``` that's it.")]
+    assert merge_blocks(split_to_code_blocks("just text")) == [("just text", False, "just text")]
+    assert len(merge_blocks(blocks, max_length=20)) == 3
+    # MarkdownV2 needs backslashes and backticks escaped inside code too
+    text, is_markdown, plain_text = merge_blocks(split_to_code_blocks('```re.sub(r"\\d", "`")```'))[0]
+    assert text == '```re.sub(r"\\\\d", "\\`")```' and plain_text == '```re.sub(r"\\d", "`")```'
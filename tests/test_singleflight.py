@@ -0,0 +1,83 @@
+import threading
+import time
+
+import pytest
+
+from chatgpt_enhancer_bot.singleflight import SingleFlight
+
+
+def run_concurrently(func, n):
+    results = [None] * n
+
+    def target(i):
+        try:
+            results[i] = func()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_identical_calls_are_coalesced():
+    flight = SingleFlight()
+    calls = []
+
+    def slow_query():
+        calls.append(1)
+        time.sleep(0.05)
+        return 'answer'
+
+    results = run_concurrently(lambda: flight.do('key', slow_query), 5)
+    assert results == ['answer'] * 5
+    assert len(calls) == 1
+    assert flight.stats() == {'upstream_calls': 1, 'coalesced_calls': 4, 'in_flight': 0}
+
+    # finished calls are not shared - that's what the response cache is for
+    assert flight.do('key', slow_query) == 'answer'
+    assert len(calls) == 2
+
+
+def test_errors_reach_all_waiters():
+    flight = SingleFlight()
+
+    def failing_query():
+        time.sleep(0.05)
+        raise RuntimeError('rate limit')
+
+    results = run_concurrently(lambda: flight.do('key', failing_query), 3)
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert flight.in_flight() == 0
+
+
+def test_waiters_retry_after_interrupted_call():
+    flight = SingleFlight()
+    started = threading.Event()
+
+    class Interrupted(BaseException):
+        pass
+
+    def interrupted_query():
+        started.set()
+        time.sleep(0.05)
+        raise Interrupted()
+
+    leader = threading.Thread(target=lambda: pytest.raises(Interrupted, flight.do, 'key', interrupted_query))
+    leader.start()
+    started.wait()
+    assert flight.do('key', lambda: 'answer') == 'answer'
+    leader.join()
+
+
+def test_waiter_timeout():
+    flight = SingleFlight()
+    thread = threading.Thread(target=flight.do, args=('key', time.sleep, 0.1))
+    thread.start()
+    time.sleep(0.01)
+    with pytest.raises(TimeoutError):
+        flight.do('key', time.sleep, 0.1, timeout=0.01)
+    thread.join()
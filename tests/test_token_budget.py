@@ -0,0 +1,30 @@
+import pytest
+
+from chatgpt_enhancer_bot.token_budget import TokenPrefixSums, count_tokens, count_turn_tokens
+
+
+@pytest.mark.parametrize("text,expected", [
+    ("", 0),
+    ("hello", 1),
+    ("hello world", 2),
+    ("Hello, world!", 4),
+])
+def test_count_tokens(text, expected):
+    assert count_tokens(text) == expected
+
+
+def test_depth_for_budget():
+    history = [(f"prompt {i}", f"response {i}", "") for i in range(10)]
+    turn_tokens = count_turn_tokens("prompt 0", "response 0")
+    sums = TokenPrefixSums(history[:5])
+    for turn in history[5:]:
+        sums.append(*turn[:2])
+
+    assert len(sums) == 10
+    assert sums.total == 10 * turn_tokens
+    assert sums.depth_for_budget(0) == 0
+    assert sums.depth_for_budget(turn_tokens - 1) == 0
+    assert sums.depth_for_budget(3 * turn_tokens) == 3
+    assert sums.depth_for_budget(3 * turn_tokens + 1) == 3
+    assert sums.depth_for_budget(100 * turn_tokens) == 10
+    assert sums.tokens_in_last(3) == 3 * turn_tokens
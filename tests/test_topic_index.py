@@ -0,0 +1,65 @@
+import random
+
+from chatgpt_enhancer_bot.openai_chatbot import ChatBot
+from chatgpt_enhancer_bot.topic_index import TopicIndex, edit_distance
+from chatgpt_enhancer_bot.utils import MenuResponse, parse_query
+
+
+def test_edit_distance():
+    assert edit_distance('banana', 'bananna', 2) == 1
+    assert edit_distance('kitten', 'sitting', 5) == 3
+    assert edit_distance('kitten', 'sitting', 1) == 2  # over the limit
+
+
+def test_search_ranking():
+    index = TopicIndex(['2023Jan05-banana-3', '2023Jan05-cherry-4', 'Physics', 'physics homework', 'General'])
+
+    assert index.search('physics')[0] == ('Physics', 1.)
+    assert [topic for topic, _ in index.search('physics')] == ['Physics', 'physics homework']
+    assert index.search('bananna')[0][0] == '2023Jan05-banana-3'  # typo
+    assert index.search('chery')[0][0] == '2023Jan05-cherry-4'
+    assert index.search('xylophone') == []
+
+    index.rename('Physics', 'Quantum physics')
+    index.remove('General')
+    assert index.search('general') == []
+    assert [topic for topic, _ in index.search('physics')] == ['Quantum physics', 'physics homework']  # the closer length first
+
+
+def test_search_many_topics():
+    # the speed is measured in dev/benchmarks/topic_index_benchmark.py
+    rng = random.Random(0)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(4, 9))) for _ in range(300)]
+    index = TopicIndex(f"2023Jan{i % 28:02d}-{rng.choice(words)}-{i}" for i in range(3000))
+    for word in rng.sample(words, 20):
+        # a misspelled word finds a topic with the word, among the many topics sharing trigrams with it
+        assert f"-{word}-" in index.search(word[:-1] + 'x')[0][0]
+
+
+def test_switch_topic_did_you_mean(tmp_path):
+    bot = ChatBot(conversations_history_path=str(tmp_path / 'history.json'))
+    bot.add_new_topic('banana bread')
+    bot.add_new_topic('banana split')
+    bot.add_new_topic('cherry pie')
+    bot.rename_topic('apple pie', topic='cherry pie')
+
+    assert bot.switch_topic('split') == 'Active topic: banana split'
+    # a typo is not switched to right away, it's suggested
+    menu = bot.switch_topic('aple')
+    assert list(menu.menu) == ['apple pie']
+    # the buttons switch by a short ref of the topic
+    assert bot.switch_topic(**parse_query(menu.menu['apple pie'])[2]) == 'Active topic: apple pie'
+    menu = bot.switch_topic('banan')
+    assert isinstance(menu, MenuResponse)
+    assert set(menu.menu) == {'banana bread', 'banana split'}
+
+
+def test_switch_topic_menu_long_names(tmp_path):
+    bot = ChatBot(conversations_history_path=str(tmp_path / 'history.json'))
+    long_name = 'a very long topic name about the migration of the billing service to postgres, part 2'
+    bot.add_new_topic(long_name)
+    bot.add_new_topic(long_name + ', again')
+    for menu in [bot.switch_topic('billing service'), bot.get_topics_menu()]:
+        assert all(len(data.encode()) <= 64 for data in menu.menu.values())  # telegram limit of callback data
+    menu = bot.get_topics_menu()
+    assert bot.switch_topic(**parse_query(menu.menu[long_name])[2]) == f'Active topic: {long_name}'
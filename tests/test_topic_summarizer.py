@@ -0,0 +1,92 @@
+from concurrent.futures import Future
+
+from chatgpt_enhancer_bot.history_storage import JsonHistoryStorage
+from chatgpt_enhancer_bot.token_budget import count_turn_tokens
+from chatgpt_enhancer_bot.topic_summarizer import TopicSummarizer, RETRY_AFTER_TURNS, RETRY_AFTER_SECONDS
+
+
+def render_turn(prompt, response):
+    return f"[H]: {prompt}\n[B]: {response}\n"
+
+
+def test_rolling_summary(tmp_path):
+    storage = JsonHistoryStorage(str(tmp_path / 'history.json'))
+    storage.add_topic('a')
+    requests = []
+
+    def summarize(request):
+        requests.append(request)
+        return f"summary {len(requests)}"
+
+    summarizer = TopicSummarizer(storage, summarize, render_turn, summarize_every=3, keep_recent_turns=2)
+    futures = []
+    for i in range(10):
+        storage.record('a', f'p{i}', f'r{i}', f't{i}')
+        future = summarizer.maybe_schedule('a', i + 1)
+        if future is not None:
+            future.result()
+            futures.append(future)
+
+    assert len(futures) == 2
+    assert storage.get_summary('a') == ('summary 2', 6)
+    # the second summary only gets the new turns and the previous summary
+    assert 'summary 1' in requests[1]
+    assert 'p2' not in requests[1] and 'p3' in requests[1] and 'p6' not in requests[1]
+
+
+class ImmediateExecutor:
+    def submit(self, func, *args):
+        future = Future()
+        future.set_result(func(*args))
+        return future
+
+
+def test_long_topic_summarized_in_chunks(tmp_path):
+    storage = JsonHistoryStorage(str(tmp_path / 'history.json'))
+    storage.add_topic('a')
+    for i in range(30):
+        storage.record('a', f'prompt {i}', 'word ' * 50, f't{i}')
+    requests = []
+
+    def summarize(request):
+        requests.append(request)
+        return f"summary {len(requests)}"
+
+    chunk_tokens = 3 * count_turn_tokens('prompt 10', 'word ' * 50)
+    summarizer = TopicSummarizer(storage, summarize, render_turn, summarize_every=3, keep_recent_turns=2,
+                                 chunk_tokens=chunk_tokens, executor=ImmediateExecutor())
+    summarizer.maybe_schedule('a', 30)
+
+    assert storage.get_summary('a') == (f'summary {len(requests)}', 28)
+    assert len(requests) == 10  # 28 turns, 3 per request
+    assert all(request.count('[H]:') <= 3 for request in requests)
+    assert 'summary 1' in requests[1] and 'prompt 3\n' in requests[1] and 'prompt 6\n' not in requests[1]
+
+
+def test_backoff_after_failure(tmp_path):
+    storage = JsonHistoryStorage(str(tmp_path / 'history.json'))
+    storage.add_topic('a')
+    for i in range(10):
+        storage.record('a', f'p{i}', f'r{i}', f't{i}')
+    requests = []
+    now = [0.]
+
+    def summarize(request):
+        requests.append(request)
+        raise RuntimeError("context length exceeded")
+
+    summarizer = TopicSummarizer(storage, summarize, render_turn, summarize_every=3, keep_recent_turns=2,
+                                 executor=ImmediateExecutor(), clock=lambda: now[0])
+    summarizer.maybe_schedule('a', 10)
+    assert len(requests) == 1 and storage.get_summary('a') == ('', 0)
+
+    # not retried on every turn
+    assert summarizer.maybe_schedule('a', 11) is None
+    # retried after enough turns
+    summarizer.maybe_schedule('a', 10 + RETRY_AFTER_TURNS)
+    assert len(requests) == 2
+    # or after a while
+    assert summarizer.maybe_schedule('a', 11 + RETRY_AFTER_TURNS) is None
+    now[0] += RETRY_AFTER_SECONDS
+    summarizer.maybe_schedule('a', 11 + RETRY_AFTER_TURNS)
+    assert len(requests) == 3
@@ -1,6 +1,6 @@
 import pytest
 
-from chatgpt_enhancer_bot.utils import split_to_code_blocks
+from chatgpt_enhancer_bot.utils import split_to_code_blocks, CodeBlockSplitter, format_message, split_block
 
 
 @pytest.mark.parametrize("text,expected", [
@@ -34,3 +34,52 @@ def test_undefined_behaviour(text, expected):
     """test that the text is split into code blocks"""
     res = split_to_code_blocks(text)
     assert expected == res
+
+
+@pytest.mark.parametrize("text", [
+    "some text ```some code``` some more text",
+    "```python\nprint(1)\n```\nand ````four backticks`` here``` end",
+    "some text```",
+    "a`b``c```d",
+])
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 100])
+def test_code_block_splitter(text, chunk_size):
+    """chunked splitting gives the same blocks as splitting the whole text"""
+    splitter = CodeBlockSplitter()
+    blocks = []
+    for i in range(0, len(text), chunk_size):
+        blocks += splitter.feed(text[i:i + chunk_size])
+    blocks += splitter.close()
+    assert blocks == split_to_code_blocks(text)
+
+
+def test_code_block_splitter_current_block():
+    splitter = CodeBlockSplitter()
+    assert splitter.feed("text ``") == []
+    assert splitter.get_current_block() == {'text': 'text ``', 'is_code_block': False}
+    assert splitter.feed("`code") == [{'text': 'text ', 'is_code_block': False}]
+    assert splitter.get_current_block() == {'text': 'code', 'is_code_block': True}
+
+
+def test_format_message_respects_length():
+    code = "python\n" + "\n".join(f"print({i})" for i in range(1000))
+    text = "Intro paragraph.\n\n" + "word " * 1000 + f"```{code}``` outro"
+    messages = format_message(text, max_length=1000)
+    assert all(len(message) <= 1000 for message, _, _ in messages)
+    code_messages = [message for message, is_markdown, _ in messages if message.startswith("```")]
+    assert len(code_messages) > 1
+    # fences are balanced and each part keeps the language tag
+    assert all(m.startswith("```python\n") and m.count("```") == 2 for m in code_messages)
+    # nothing is lost, splits are at line boundaries
+    code_parts = [m[len("```python\n"):m.rindex("```")] for m in code_messages]
+    assert "".join(code_parts) == code[len("python\n"):]
+    assert all(part.endswith("\n") for part in code_parts[:-1])
+
+
+def test_split_block_fits_escaped_code():
+    code = 'x = "\\\\"\n' * 200  # backslashes double once escaped
+    parts = split_block({'text': code, 'is_code_block': True}, max_length=100)
+    assert ''.join(part['text'] for part in parts) == code
+    assert all(len(format_message(f"```{part['text']}```", max_length=10 ** 6)[0].text) <= 100 for part in parts)
+    # the parts only depend on the text before them - a growing streamed block keeps its full parts
+    assert split_block({'text': code + 'y' * 50, 'is_code_block': True}, max_length=100)[:-2] == parts[:-1]
@@ -0,0 +1,66 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from chatgpt_enhancer_bot.webhook_server import WebhookServer, SECRET_TOKEN_HEADER
+
+UPDATE = {"update_id": 1, "message": {"message_id": 7, "date": 1672531200, "text": "hi",
+                                      "chat": {"id": 42, "type": "private"},
+                                      "from": {"id": 42, "is_bot": False, "first_name": "A", "username": "a"}}}
+
+
+def post(server, data, token='secret', path='/telegram'):
+    host, port = server.address
+    request = urllib.request.Request(f'http://{host}:{port}{path}', data=json.dumps(data).encode(),
+                                     headers={SECRET_TOKEN_HEADER: token, 'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+@pytest.fixture
+def make_server():
+    servers = []
+
+    def make(handle_update, **kwargs):
+        server = WebhookServer(handle_update, port=0, secret_token='secret', **kwargs)
+        server.start()
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.stop()
+
+
+def test_receives_updates(make_server):
+    received = []
+    server = make_server(received.append)
+
+    assert post(server, UPDATE) == 200
+    assert post(server, UPDATE, token='wrong') == 403
+    assert post(server, UPDATE, path='/other') == 404
+    server.stop()
+
+    assert received == [UPDATE]
+    assert server.stats()['webhook_rejected'] == 1
+
+
+def test_bounded_queue(make_server):
+    release = threading.Event()
+    received = []
+    server = make_server(lambda update: (release.wait(5), received.append(update)), max_queued=2, workers=1)
+
+    statuses = [post(server, dict(UPDATE, update_id=i)) for i in range(5)]
+    # one update is being handled, two wait in the queue - the rest are refused, telegram retries them
+    assert statuses.count(200) in (2, 3) and statuses[:2] == [200, 200]
+    assert 503 in statuses
+    release.set()
+    server.stop()
+    assert len(received) == statuses.count(200)
+    assert server.stats()['webhook_refused'] == statuses.count(503)